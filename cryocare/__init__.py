@@ -26,9 +26,9 @@
 
 import pwem
 import os
-from pyworkflow.utils import Environ
+import sys
 from cryocare.constants import CRYOCARE_ENV_ACTIVATION, DEFAULT_ACTIVATION_CMD, CRYOCARE_ENV_NAME, \
-    CRYOCARE_DEFAULT_VERSION, CRYOCARE_HOME, CRYOCARE_CUDA_LIB, CRYOCARE
+    CRYOCARE_DEFAULT_VERSION, CRYOCARE_HOME, CRYOCARE_CUDA_LIB, CRYOCARE, CRYOCARE_MODEL_STORE, CRYOCARE_SIMULATE
 
 _logo = "icon.png"
 _references = ['buchholz2019cryo']
@@ -44,14 +44,28 @@ class Plugin(pwem.Plugin):
         # cryoCARE does NOT need EmVar because it uses a conda environment.
         cls._defineVar(CRYOCARE_ENV_ACTIVATION, DEFAULT_ACTIVATION_CMD)
         cls._defineVar(CRYOCARE_CUDA_LIB, pwem.Config.CUDA_LIB)
+        # Optional directory in which the imported models are stored only once, named after their content hash
+        cls._defineVar(CRYOCARE_MODEL_STORE, '')
+        # Simulated backend, used to test the plugin orchestration at scale without GPUs
+        cls._defineVar(CRYOCARE_SIMULATE, 'False')
 
     @classmethod
     def getCryocareEnvActivation(cls):
         return cls.getVar(CRYOCARE_ENV_ACTIVATION)
 
+    @classmethod
+    def getModelStore(cls):
+        return cls.getVar(CRYOCARE_MODEL_STORE)
+
+    @classmethod
+    def isSimulated(cls):
+        from pyworkflow.utils import strToBoolean
+        return strToBoolean(str(cls.getVar(CRYOCARE_SIMULATE, os.environ.get(CRYOCARE_SIMULATE))))
+
     @classmethod
     def getEnviron(cls):
         """ Setup the environment variables needed to launch cryocare. """
+        from pyworkflow.utils import Environ
         environ = Environ(os.environ)
         if 'PYTHONPATH' in environ:
             # this is required for python virtual env to work
@@ -108,10 +122,61 @@ class Plugin(pwem.Plugin):
         return neededProgs
 
     @classmethod
-    def runCryocare(cls, protocol, program, args, cwd=None):
+    def getCryocareCmd(cls, program, cores=None):
+        """ Command and environment to run a cryoCARE program. If a list of cores is provided, the process is pinned
+        to them and its thread pools are sized accordingly. """
+        environ = cls.getEnviron()
+        affinity = ''
+        if cores:
+            from cryocare.resources import getThreadEnvVars, getAffinityPrefix
+            environ.update(getThreadEnvVars(len(cores)))
+            affinity = getAffinityPrefix(cores)
+        if cls.isSimulated():
+            # The stand-in programs mimic the cryoCARE ones and only need the Scipion python
+            from cryocare.simulator import getSimulatedProgram
+            cmd = f"{affinity}{sys.executable} {getSimulatedProgram(program)} "
+        else:
+            cmd = cls.getCondaActivationCmd() + " "
+            cmd += cls.getCryocareEnvActivation()
+            cmd += f" && {affinity}{program} "
+            # cmd += f" && CUDA_VISIBLE_DEVICES=%(GPU)s {program} "
+        return cmd, environ
+
+    @classmethod
+    def runCryocare(cls, protocol, program, args, cwd=None, cores=None):
         """ Run cryoCARE command from a given protocol. """
-        cmd = cls.getCondaActivationCmd() + " "
-        cmd += cls.getCryocareEnvActivation()
-        cmd += f" && {program} "
-        # cmd += f" && CUDA_VISIBLE_DEVICES=%(GPU)s {program} "
-        protocol.runJob(cmd, args, env=cls.getEnviron(), cwd=cwd, numberOfMpi=1)
+        cmd, environ = cls.getCryocareCmd(program, cores=cores)
+        protocol.runJob(cmd, args, env=environ, cwd=cwd, numberOfMpi=1)
+
+    @classmethod
+    def runCryocareJob(cls, protocol, job, program, args, cwd=None, cores=None):
+        """ Run a cryoCARE command from a given protocol, as runCryocare does, with its output written to the log
+        file of the job (a cryocare.jobs.CryocareJob), so it can be followed and stopped while it runs. Instead of
+        raising an exception if it fails, its exit code is returned. """
+        cmd, environ = cls.getCryocareCmd(program, cores=cores)
+        environ['PYTHONUNBUFFERED'] = '1'  # Followed line by line
+        return job.run(protocol, cmd, args, env=environ, cwd=cwd, numberOfMpi=1)
+
+    @classmethod
+    def runCryocareWithOutput(cls, protocol, program, args, logFile, cwd=None, cores=None, tailLines=100):
+        """ Run a cryoCARE command from a given protocol, copying its output (written to logFile) to the protocol
+        log. Instead of raising an exception if it fails, its exit code and the last lines of its output are
+        returned, so the failure can be diagnosed (e.g. out of memory). """
+        import collections
+        import threading
+        from cryocare.jobs import CryocareJob
+        job = CryocareJob(logFile)
+        tail = collections.deque(maxlen=tailLines)
+
+        def follow():
+            for line in job.readLines():
+                if line:
+                    sys.stdout.write(line)
+                    tail.append(line)
+
+        follower = threading.Thread(target=follow, daemon=True)
+        follower.start()
+        exitCode = cls.runCryocareJob(protocol, job, program, args, cwd=cwd, cores=cores)
+        follower.join()
+        sys.stdout.flush()
+        return exitCode, ''.join(tail)
@@ -0,0 +1,109 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import hashlib
+import os
+import threading
+from os.path import join, basename, splitext, exists, realpath, getsize, getmtime
+
+from cryocare.volumes import openVolume, getVolumePath, isCryocareReadable, convertToMrc
+
+# Memory used by the FFTs of each chunk of the volume
+CHUNK_BYTES = 256 * 1024 ** 2
+
+
+def _cropAxis(data, nOut, axis):
+    """Fourier crop the data along the given axis: keep the nOut lowest frequencies. The result is scaled so the
+    mean value is preserved."""
+    import numpy as np
+    nIn = data.shape[axis]
+    if nIn == nOut:
+        return data.astype(np.float32, copy=False)
+    ft = np.fft.rfft(data, axis=axis)
+    lowFreqs = [slice(None)] * data.ndim
+    lowFreqs[axis] = slice(0, nOut // 2 + 1)
+    return (np.fft.irfft(ft[tuple(lowFreqs)], n=nOut, axis=axis) * (nOut / nIn)).astype(np.float32)
+
+
+def fourierBin(inFile, outFile, factor, chunkBytes=CHUNK_BYTES):
+    """Bin the volume inFile (any of the formats of cryocare.volumes) by the given factor with Fourier cropping,
+    writing the result to the MRC file outFile. The crop is separable, so it is carried out first in XY over chunks
+    of slices and then in Z over chunks of rows. The XY binned volume (1/factor^2 the size of the input) is kept in
+    a temporary file next to outFile, so the memory is bounded by chunkBytes for volumes of any size."""
+    import mrcfile
+    import numpy as np
+    # Written to temporary files, so a cached file is always complete
+    tmpFile = '%s.%i-%i.tmp' % (outFile, os.getpid(), threading.get_ident())
+    xyFile = tmpFile + '.xy'
+    try:
+        with openVolume(inFile) as volIn:
+            data = volIn.data
+            nz, ny, nx = data.shape
+            outShape = (nz // factor, ny // factor, nx // factor)
+            voxelSize = volIn.voxelSize
+            xyBinned = np.memmap(xyFile, dtype=np.float32, mode='w+', shape=(nz, outShape[1], outShape[2]))
+            chunk = max(1, chunkBytes // (ny * nx * 16))  # Complex128 FFTs
+            for z0 in range(0, nz, chunk):
+                block = np.asarray(data[z0:z0 + chunk], dtype=np.float32)
+                xyBinned[z0:z0 + chunk] = _cropAxis(_cropAxis(block, outShape[2], 2), outShape[1], 1)
+
+        with mrcfile.new_mmap(tmpFile, shape=outShape, mrc_mode=2, overwrite=True) as mrcOut:
+            chunk = max(1, chunkBytes // (nz * outShape[2] * 16))
+            for y0 in range(0, outShape[1], chunk):
+                mrcOut.data[:, y0:y0 + chunk] = _cropAxis(xyBinned[:, y0:y0 + chunk], outShape[0], 0)
+            if voxelSize:
+                mrcOut.voxel_size = tuple(v * factor for v in voxelSize)
+            mrcOut.update_header_stats()
+        del xyBinned
+        os.replace(tmpFile, outFile)
+    finally:
+        for fn in (xyFile, tmpFile):
+            if exists(fn):
+                os.remove(fn)
+    return outFile
+
+
+def getBinnedFileName(inFile, factor, cacheDir):
+    """Name of the binned version of a file in the cache. It depends on the file contents (size and modification
+    time), so the files modified are binned again."""
+    inFile = getVolumePath(inFile)
+    key = '%s:%i:%f:%i' % (realpath(inFile), getsize(inFile), getmtime(inFile), factor)
+    keyHash = hashlib.md5(key.encode()).hexdigest()[:8]
+    return join(cacheDir, '%s_bin%i_%s.mrc' % (splitext(basename(inFile))[0], factor, keyHash))
+
+
+def getBinnedFile(inFile, factor, cacheDir):
+    """Return the binned version of inFile, from the cache if it was already generated. Not binned, the file
+    itself is returned if cryoCARE can read it, and a MRC copy otherwise."""
+    if factor == 1 and isCryocareReadable(inFile):
+        return getVolumePath(inFile)
+    outFile = getBinnedFileName(inFile, factor, cacheDir)
+    if not exists(outFile):
+        os.makedirs(cacheDir, exist_ok=True)
+        if factor == 1:
+            convertToMrc(inFile, outFile)
+        else:
+            fourierBin(inFile, outFile, factor)
+    return outFile
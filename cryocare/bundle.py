@@ -0,0 +1,129 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Self-contained bundles to run the cryoCARE programs of a protocol as a cluster array job, a task per tomogram,
+out of the host running the protocol. The protocol collects the outputs once the tasks are done."""
+import json
+import os
+import shlex
+from os.path import join, exists
+
+from cryocare import Plugin
+
+TASKS_FN = 'tasks.tsv'  # Task index --> tsId and config file
+LAUNCHER_FN = 'run_task.sh'
+CONFIGS_DIR = 'configs'
+DONE_DIR = 'done'
+CONFIG_NAME = 'task_%05d.json'
+# Variables holding the array task index in the usual schedulers: SLURM, SGE, PBS Pro and LSF
+ARRAY_INDEX_VARS = ('SLURM_ARRAY_TASK_ID', 'SGE_TASK_ID', 'PBS_ARRAY_INDEX', 'LSB_JOBINDEX')
+
+LAUNCHER_TEMPLATE = """#!/usr/bin/env bash
+# cryoCARE array job bundle: %(nTasks)i tasks of %(program)s, one per tomogram.
+# Run a task per array index, from 1 to %(nTasks)i, e.g.:
+#   sbatch --array=1-%(nTasks)i --gres=gpu:1 %(launcher)s    (SLURM)
+#   qsub -t 1-%(nTasks)i %(launcher)s                        (SGE)
+#   qsub -J 1-%(nTasks)i %(launcher)s                        (PBS Pro)
+# or one of them locally with: %(launcher)s <index>
+# Then, continue the protocol to collect the outputs.
+set -eo pipefail
+BUNDLE_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+TASK_INDEX="${1:-%(indexVars)s}"
+if [ -z "$TASK_INDEX" ]; then
+    echo "No task index given nor found in the environment of the scheduler." >&2
+    exit 2
+fi
+TASK="$(awk -F '\\t' -v i="$TASK_INDEX" '$1 == i {print $2 "\\t" $3}' "$BUNDLE_DIR/%(tasksFile)s")"
+if [ -z "$TASK" ]; then
+    echo "There is no task $TASK_INDEX in this bundle." >&2
+    exit 2
+fi
+TS_ID="${TASK%%%%$'\\t'*}"
+CONFIG="$BUNDLE_DIR/${TASK#*$'\\t'}"
+if [ -f "$BUNDLE_DIR/%(doneDir)s/$TASK_INDEX" ]; then
+    echo "Task $TASK_INDEX ($TS_ID) was already done."
+    exit 0
+fi
+echo "Task $TASK_INDEX: $TS_ID"
+# Environment of the cryoCARE programs
+%(environ)s
+%(cmd)s--conf "$CONFIG"
+mkdir -p "$BUNDLE_DIR/%(doneDir)s"
+echo "$TS_ID" > "$BUNDLE_DIR/%(doneDir)s/$TASK_INDEX"
+"""
+
+
+def _getEnvironLines(environ):
+    """Shell commands reproducing the changes the plugin makes to the environment of the cryoCARE programs."""
+    lines = ['unset %s' % key for key in sorted(set(os.environ) - set(environ))]
+    lines += ['export %s=%s' % (key, shlex.quote(value)) for key, value in sorted(environ.items())
+              if os.environ.get(key) != value]
+    return '\n'.join(lines)
+
+
+def writeBundle(bundleDir, program, tasks):
+    """Write a bundle to run a cryoCARE program once per task. tasks is a list of (tsId, config) and its indices
+    start at 1, as the array jobs. The paths in the configs must be absolute."""
+    os.makedirs(join(bundleDir, CONFIGS_DIR), exist_ok=True)
+    with open(join(bundleDir, TASKS_FN), 'w') as f:
+        for index, (tsId, config) in enumerate(tasks, start=1):
+            configFile = join(CONFIGS_DIR, CONFIG_NAME % index)
+            with open(join(bundleDir, configFile), 'w') as fConfig:
+                json.dump(config, fConfig, indent=2)
+            f.write('%i\t%s\t%s\n' % (index, tsId, configFile))
+    cmd, environ = Plugin.getCryocareCmd(program)
+    launcher = join(bundleDir, LAUNCHER_FN)
+    with open(launcher, 'w') as f:
+        f.write(LAUNCHER_TEMPLATE % {'nTasks': len(tasks),
+                                     'program': program,
+                                     'launcher': LAUNCHER_FN,
+                                     'indexVars': ''.join('${%s:-' % var for var in ARRAY_INDEX_VARS) +
+                                                  '}' * len(ARRAY_INDEX_VARS),
+                                     'tasksFile': TASKS_FN,
+                                     'doneDir': DONE_DIR,
+                                     'environ': _getEnvironLines(environ),
+                                     'cmd': cmd})
+    os.chmod(launcher, 0o755)
+    return launcher
+
+
+def readTasks(bundleDir):
+    """Tasks of a bundle: list of (index, tsId, config)."""
+    tasks = []
+    with open(join(bundleDir, TASKS_FN)) as f:
+        for line in f:
+            index, tsId, configFile = line.rstrip('\n').split('\t')
+            with open(join(bundleDir, configFile)) as fConfig:
+                tasks.append((int(index), tsId, json.load(fConfig)))
+    return tasks
+
+
+def isTaskDone(bundleDir, index):
+    return exists(join(bundleDir, DONE_DIR, str(index)))
+
+
+def getPendingTasks(bundleDir):
+    """Tasks of a bundle whose launcher has not finished successfully."""
+    return [task for task in readTasks(bundleDir) if not isTaskDone(bundleDir, task[0])]
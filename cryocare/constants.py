@@ -34,12 +34,30 @@ CRYOCARE_ENV_NAME = '%s-%s' % (CRYOCARE, CRYOCARE_DEFAULT_VERSION)
 CRYOCARE_ENV_ACTIVATION = 'CRYOCARE_ENV_ACTIVATION'
 DEFAULT_ACTIVATION_CMD = 'conda activate %s' % CRYOCARE_ENV_NAME
 CRYOCARE_CUDA_LIB = 'CRYOCARE_CUDA_LIB'
+CRYOCARE_MODEL_STORE = 'CRYOCARE_MODEL_STORE'  # Site-wide de-duplicated model store directory
+CRYOCARE_SIMULATE = 'CRYOCARE_SIMULATE'  # Use the stand-in cryoCARE programs, which do not need GPUs nor TF
 
 TRAIN_DATA_DIR = 'train_data'
 TRAIN_DATA_FN = 'train_data.npz'
+TRAIN_COORDS_FN = 'train_coords.npz'  # Patch coordinates of the coordinate-based training datasets
+TRAIN_DATA_SHARDS_FN = 'train_data.shards'  # Compressed training patches (see cryocare.shards)
+VALIDATION_DATA_SHARDS_FN = 'val_data.shards'
 VALIDATION_DATA_FN = 'val_data.npz'
 MEAN_STD_FN = 'mean_std.npz'
 TRAIN_DATA_CONFIG = 'training_data_config'
+TRAIN_DATA_MANIFEST_FN = 'train_data_manifest.json'  # Virtual concatenation of several training datasets
 CRYOCARE_MODEL = 'cryoCARE_model'
 CRYOCARE_MODEL_TGZ = CRYOCARE_MODEL + '.tar.gz'
 PREDICT_CONFIG = 'predict_config'
+PREDICT_MANIFEST = 'predict_manifest.jsonl'
+TOMO_INDEX_FN = 'tomo_index.json'  # Compact index of the input tomograms (see cryocare.tomoindex)
+TILING_FN = 'tiling.json'  # Tilings that worked for each tomogram shape (see cryocare.tiling)
+STATUS_FN = 'status.json'  # Live progress of the protocol, to be scraped by external monitoring
+TRAIN_LOG_FN = 'train.log'  # Output of cryoCARE_train.py, followed while it runs
+
+# Model archive contents and compact model metadata
+MODEL_NORM_FN = 'norm.json'
+MODEL_CONFIG_FN = 'config.json'
+MODEL_WEIGHTS_EXT = '.h5'
+MODEL_WEIGHTS_BEST_FN = 'weights_best' + MODEL_WEIGHTS_EXT
+MODEL_INFO_SUFFIX = '_info.json'
@@ -0,0 +1,117 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""cryoCARE programs run through the protocols (protocol.runJob, so with the host configuration, GPU substitution
+and environment of Scipion) with their output written to a log file, which is followed while they run."""
+import os
+import subprocess
+import threading
+import time
+
+# Seconds between the reads of the log while waiting for new output
+POLL_INTERVAL = 0.5
+# Seconds given to the program to exit once asked to stop, before killing it
+STOP_TIMEOUT = 30
+
+
+class CryocareJob:
+    """A cryoCARE command whose output is redirected to a log file. It is run (blocking) by the protocol step, as the
+    executor assigns the GPUs to the step thread, while other threads follow its log and can stop it."""
+
+    def __init__(self, logFile):
+        self.logFile = logFile
+        self._done = threading.Event()
+        open(logFile, 'w').close()  # Followed from its beginning
+
+    def run(self, protocol, cmd, args, **kwargs):
+        """Run the command through protocol.runJob and return its exit code."""
+        try:
+            protocol.runJob(cmd, '%s > %s 2>&1' % (args, self.logFile), **kwargs)
+            return 0
+        except subprocess.CalledProcessError as e:
+            return e.returncode
+        finally:
+            self._done.set()
+
+    def isDone(self):
+        return self._done.is_set()
+
+    def readLines(self, interval=POLL_INTERVAL):
+        """Lines of the log as they are written, until the command ends. An empty line is returned after each
+        interval without output, so the caller can do its checks meanwhile."""
+        with open(self.logFile) as f:
+            line = ''
+            while True:
+                done = self.isDone()  # Checked before reading, not to miss the last lines
+                chunk = f.readline()
+                if chunk:
+                    line += chunk
+                    if line.endswith('\n'):
+                        yield line
+                        line = ''
+                elif done:
+                    if line:
+                        yield line
+                    return
+                else:
+                    time.sleep(interval)
+                    yield ''
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """Stop the command and its children, found as the processes writing the log. Returns False if none is
+        running in this machine: the command is done, or it was submitted to a queue."""
+        import psutil
+        procs = [proc for proc in psutil.Process().children(recursive=True) if self._writesLog(proc)]
+        for proc in procs:
+            try:
+                proc.terminate()
+            except psutil.NoSuchProcess:
+                pass
+        # Not waited with psutil, which would reap the shell run by the protocol and hide its exit code
+        deadline = time.time() + timeout
+        while any(self._isAlive(proc) for proc in procs) and time.time() < deadline:
+            time.sleep(POLL_INTERVAL)
+        for proc in filter(self._isAlive, procs):
+            try:
+                proc.kill()
+            except psutil.NoSuchProcess:
+                pass
+        return bool(procs)
+
+    def _writesLog(self, proc):
+        import psutil
+        logFile = os.path.realpath(self.logFile)
+        try:
+            return any(openFile.path == logFile for openFile in proc.open_files())
+        except psutil.Error:
+            return False
+
+    @staticmethod
+    def _isAlive(proc):
+        import psutil
+        try:
+            return proc.status() != psutil.STATUS_ZOMBIE
+        except psutil.NoSuchProcess:
+            return False
@@ -0,0 +1,191 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Lifecycle of the intermediate data written by the protocols (binned tomograms, configs, training patches...):
+kept, removed once the outputs are registered, or removed after some days. The final products and the files
+referenced by the models and training data registered in the project are never removed, and they are kept without
+copying them (hard links or reflinks) when they have to be moved out of the intermediate data."""
+import glob
+import json
+import os
+import shutil
+import time
+from os.path import join, exists, isdir, islink, realpath, dirname, lexists
+
+from cryocare.constants import TRAIN_DATA_MANIFEST_FN
+
+# Retention policies
+KEEP_ALL = 0
+KEEP_FINAL = 1
+KEEP_DAYS = 2
+RETENTION_CHOICES = ['Keep all', 'Final products only', 'Keep for N days']
+LIFECYCLE_FN = 'lifecycle.json'  # Retention record of a protocol run, in its working directory
+DAY_SECONDS = 24 * 3600
+FICLONE = 0x40049409  # Linux ioctl to clone a file (reflink) in copy-on-write file systems (Btrfs, XFS...)
+# Plugin objects that reference files, and the attributes in which they are stored in the project database
+REFERENCING_CLASSES = ('CryocareModel', 'CryocareTrainData')
+REFERENCING_ATTRS = ('_model_file', '_train_data_dir')
+
+
+def _reflink(srcFile, dstFile):
+    import fcntl
+    with open(srcFile, 'rb') as fIn, open(dstFile, 'wb') as fOut:
+        try:
+            fcntl.ioctl(fOut.fileno(), FICLONE, fIn.fileno())
+        except OSError:
+            fOut.close()
+            os.remove(dstFile)
+            raise
+
+
+def linkFinal(srcFile, dstFile):
+    """Make a final product available as dstFile without copying its data: with a hard link or, across file
+    systems, a reflink. If none of them is supported, it is moved. The method used is returned."""
+    try:
+        os.link(realpath(srcFile), dstFile)
+        return 'hard link'
+    except OSError:
+        pass
+    try:
+        _reflink(srcFile, dstFile)
+        return 'reflink'
+    except (OSError, ImportError):
+        pass
+    os.replace(srcFile, dstFile)
+    return 'move'
+
+
+def getReclaimableSize(path):
+    """Bytes freed by removing a file or directory. The files with other hard links are not counted."""
+    def _size(fileName):
+        stat = os.lstat(fileName)
+        return stat.st_size if stat.st_nlink == 1 and not islink(fileName) else 0
+
+    if not isdir(path) or islink(path):
+        return _size(path)
+    total = 0
+    for root, _, fileNames in os.walk(path):
+        total += sum(_size(join(root, fn)) for fn in fileNames)
+    return total
+
+
+def expandProtected(paths):
+    """Real paths of the protected files and directories, including the parts of the virtual training data and
+    the tomograms the coordinate-based ones read their patches from."""
+    from cryocare.traindata import getTrainDataParts, isCoordinateBased, getCoordinateVolumes
+    protected = set()
+    for path in paths:
+        if not path:
+            continue
+        protected.add(realpath(path))
+        dataDirs = [path]
+        if exists(join(path, TRAIN_DATA_MANIFEST_FN)):
+            dataDirs = [part['path'] for part in getTrainDataParts(path)]
+            protected.update(realpath(dataDir) for dataDir in dataDirs)
+        for dataDir in dataDirs:
+            if isCoordinateBased(dataDir):
+                protected.update(realpath(fileName) for fileName in getCoordinateVolumes(dataDir))
+    return protected
+
+
+def _removePath(path, protected):
+    if not lexists(path):
+        return 0
+    real = realpath(path)
+    if any(real == p or real.startswith(p + os.sep) for p in protected):
+        return 0  # Protected or inside a protected directory
+    if isdir(path) and not islink(path):
+        if any(p.startswith(real + os.sep) for p in protected):
+            # Only the contents that are not protected are removed
+            return sum(_removePath(join(path, name), protected) for name in os.listdir(path))
+        size = getReclaimableSize(path)
+        shutil.rmtree(path)
+        return size
+    size = getReclaimableSize(path)
+    os.remove(path)
+    return size
+
+
+def removeIntermediates(paths, protectedPaths):
+    """Remove the intermediate files and directories, except the protected ones and the ones containing them. The
+    bytes reclaimed are returned."""
+    protected = expandProtected(protectedPaths)
+    return sum(_removePath(path, protected) for path in paths)
+
+
+def getReferencedPaths(projectDb):
+    """Files referenced by the models and training data registered in a project, read from its database."""
+    import sqlite3
+    if not exists(projectDb):
+        return []
+    query = ('SELECT o.value FROM Objects o JOIN Objects p ON o.parent_id = p.id '
+             'WHERE p.classname IN (%s) AND (%s) AND o.value IS NOT NULL'
+             % (', '.join('?' * len(REFERENCING_CLASSES)), ' OR '.join(['o.name LIKE ?'] * len(REFERENCING_ATTRS))))
+    with sqlite3.connect('file:%s?mode=ro' % projectDb, uri=True) as conn:
+        rows = conn.execute(query, REFERENCING_CLASSES + tuple('%.' + attr for attr in REFERENCING_ATTRS))
+        return [value for value, in rows]
+
+
+def writeRecord(workingDir, mode, paths=(), finalPaths=(), days=None, reclaimed=0):
+    """Record the retention of the intermediate data of a protocol run. Those to be kept for some days are removed
+    later by sweepExpired."""
+    record = {'mode': mode,
+              'paths': list(paths),
+              'final_paths': list(finalPaths),
+              'expires': time.time() + days * DAY_SECONDS if days is not None else None,
+              'reclaimed': reclaimed}
+    recordFile = join(workingDir, LIFECYCLE_FN)
+    tmpFile = '%s.%i.tmp' % (recordFile, os.getpid())
+    with open(tmpFile, 'w') as f:
+        json.dump(record, f, indent=2)
+    os.replace(tmpFile, recordFile)
+    return record
+
+
+def readRecord(workingDir):
+    recordFile = join(workingDir, LIFECYCLE_FN)
+    if not exists(recordFile):
+        return None
+    with open(recordFile) as f:
+        return json.load(f)
+
+
+def sweepExpired(runsDir, referencedPaths=(), exclude=None, now=None):
+    """Remove the intermediate data of the runs whose retention time is over, except their final products and the
+    referenced files. The working directories swept are returned with the bytes reclaimed."""
+    now = time.time() if now is None else now
+    swept = []
+    for recordFile in sorted(glob.glob(join(runsDir, '*', LIFECYCLE_FN))):
+        workingDir = dirname(recordFile)
+        if exclude and realpath(workingDir) == realpath(exclude):
+            continue
+        record = readRecord(workingDir)
+        if not record['paths'] or record['expires'] is None or record['expires'] > now:
+            continue
+        reclaimed = removeIntermediates(record['paths'], list(record['final_paths']) + list(referencedPaths))
+        writeRecord(workingDir, record['mode'], finalPaths=record['final_paths'],
+                    reclaimed=record['reclaimed'] + reclaimed)
+        swept.append((workingDir, reclaimed))
+    return swept
@@ -0,0 +1,92 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import datetime as dt
+import hashlib
+import json
+import os
+import threading
+from os.path import exists, getsize
+
+
+class CompletionManifest:
+    """Append-only json lines file recording the items (tsIds) completely processed by a protocol: hash of the
+    config used, output file, its size and completion time. Each record is appended with a single write once the
+    output is in its final location, so a crash leaves, at most, a partial last line, which is ignored."""
+
+    def __init__(self, fileName):
+        self._fileName = fileName
+        self._records = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._records is None:
+            self._records = {}
+            if exists(self._fileName):
+                with open(self._fileName) as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue  # Line partially written when a previous execution crashed
+                        self._records[record['id']] = record
+        return self._records
+
+    def get(self, itemId):
+        with self._lock:
+            return self._load().get(itemId, None)
+
+    def isDone(self, itemId, configHash):
+        """An item is done if it was recorded with the same config and its output is still there, untouched."""
+        record = self.get(itemId)
+        return (record is not None and record['config_hash'] == configHash and exists(record['output'])
+                and getsize(record['output']) == record['size'])
+
+    def add(self, itemId, configHash, outputFile):
+        record = {'id': itemId,
+                  'config_hash': configHash,
+                  'output': outputFile,
+                  'size': getsize(outputFile),
+                  'completed': dt.datetime.now().isoformat()}
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            self._load()
+            fd = os.open(self._fileName, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                # Do not glue the new record to a partial line left by a crash
+                if os.fstat(fd).st_size > 0 and os.pread(fd, 1, os.fstat(fd).st_size - 1) != b'\n':
+                    line = '\n' + line
+                os.write(fd, line.encode())
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._records[itemId] = record
+        return record
+
+
+def getConfigHash(config, ignoredKeys=()):
+    """Hash of the values of a config dictionary that determine the result."""
+    relevant = {key: value for key, value in config.items() if key not in ignoredKeys}
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True).encode()).hexdigest()
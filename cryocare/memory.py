@@ -0,0 +1,112 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Analytical estimation of the GPU memory required to train the cryoCARE U-Net (CSBDeep architecture: two 3D
+convolutions per level, the number of filters doubled at each level, max-pooling/up-sampling by 2, skip
+connections by concatenation and a final 1x1x1 convolution)."""
+
+FLOAT_BYTES = 4
+N_CONV_PER_DEPTH = 2
+# Forward activations are kept for the backward pass, which produces gradients of the same size
+ACTIVATION_FACTOR = 2
+# Weights, their gradients and the two Adam moments
+PARAM_FACTOR = 4
+# CUDA context, cuDNN workspaces and TensorFlow allocator fragmentation
+FRAMEWORK_OVERHEAD = 768 * 1024 ** 2
+UNET_DEPTHS = (2, 3, 4)
+MAX_BATCH_SIZE = 256
+GB = 1024 ** 3
+
+
+def _getUNetLayers(patchSize, depth, nFirst):
+    """List of (output voxels, input channels, output channels) of the convolutions of the U-Net, and list of
+    (voxels, channels) of the other layers that keep their outputs (pooling, up-sampling, concatenation)."""
+    convs = []
+    others = []
+    nChannels = 1
+    skipChannels = []
+    for i in range(depth):
+        voxels = (patchSize // 2 ** i) ** 3
+        for _ in range(N_CONV_PER_DEPTH):
+            convs.append((voxels, nChannels, nFirst * 2 ** i))
+            nChannels = nFirst * 2 ** i
+        skipChannels.append(nChannels)
+        others.append((voxels // 8, nChannels))  # Max-pooling
+    voxels = (patchSize // 2 ** depth) ** 3
+    for _ in range(N_CONV_PER_DEPTH - 1):
+        convs.append((voxels, nChannels, nFirst * 2 ** depth))
+        nChannels = nFirst * 2 ** depth
+    convs.append((voxels, nChannels, nFirst * 2 ** max(0, depth - 1)))
+    nChannels = nFirst * 2 ** max(0, depth - 1)
+    for i in reversed(range(depth)):
+        voxels = (patchSize // 2 ** i) ** 3
+        others.append((voxels, nChannels))  # Up-sampling
+        nChannels += skipChannels[i]
+        others.append((voxels, nChannels))  # Concatenation
+        for _ in range(N_CONV_PER_DEPTH - 1):
+            convs.append((voxels, nChannels, nFirst * 2 ** i))
+            nChannels = nFirst * 2 ** i
+        convs.append((voxels, nChannels, nFirst * 2 ** max(0, i - 1)))
+        nChannels = nFirst * 2 ** max(0, i - 1)
+    return convs, others
+
+
+def getUNetParams(depth, nFirst, kernSize):
+    """Number of trainable parameters of the U-Net."""
+    convs, _ = _getUNetLayers(2 ** depth, depth, nFirst)
+    nParams = sum(kernSize ** 3 * cIn * cOut + cOut for _, cIn, cOut in convs)
+    return nParams + convs[-1][2] + 1  # Final 1x1x1 convolution to a single channel
+
+
+def estimateTrainingMemory(patchSize, depth, nFirst, kernSize, batchSize):
+    """Estimated GPU memory, in bytes, required to train the U-Net with the given patches and batch size. A
+    dictionary with the parameter, activation and total memory is returned."""
+    convs, others = _getUNetLayers(patchSize, depth, nFirst)
+    voxelsPerSample = patchSize ** 3 * 2  # Input and output
+    voxelsPerSample += sum(voxels * cOut for voxels, _, cOut in convs)
+    voxelsPerSample += sum(voxels * channels for voxels, channels in others)
+    activations = ACTIVATION_FACTOR * batchSize * voxelsPerSample * FLOAT_BYTES
+    parameters = PARAM_FACTOR * getUNetParams(depth, nFirst, kernSize) * FLOAT_BYTES
+    return {'parameters': parameters,
+            'activations': activations,
+            'total': parameters + activations + FRAMEWORK_OVERHEAD}
+
+
+def getLargestBatchSize(patchSize, depth, nFirst, kernSize, memBudget, maxBatchSize=MAX_BATCH_SIZE):
+    """Largest batch size whose training fits in the memory budget (bytes), or 0 if not even one sample fits."""
+    perSample = (estimateTrainingMemory(patchSize, depth, nFirst, kernSize, 2)['activations'] -
+                 estimateTrainingMemory(patchSize, depth, nFirst, kernSize, 1)['activations'])
+    fixed = estimateTrainingMemory(patchSize, depth, nFirst, kernSize, 0)['total']
+    return int(max(0, min(maxBatchSize, (memBudget - fixed) // perSample)))
+
+
+def getDeepestUNet(patchSize, nFirst, kernSize, batchSize, memBudget, depths=UNET_DEPTHS):
+    """Deepest U-Net, among the given depths, valid for the patch size (divisible by 2^depth) whose training fits
+    in the memory budget (bytes). None is returned if none fits."""
+    for depth in sorted(depths, reverse=True):
+        if patchSize % 2 ** depth == 0 and \
+                estimateTrainingMemory(patchSize, depth, nFirst, kernSize, batchSize)['total'] <= memBudget:
+            return depth
+    return None
@@ -0,0 +1,179 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+import os
+import re
+import threading
+import time
+
+# Keras log lines printed by cryoCARE_train.py, e.g.:
+# Epoch 3/100
+# 200/200 [==============================] - 52s 260ms/step - loss: 0.1077 - val_loss: 0.1081
+EPOCH_RE = re.compile(r'Epoch (\d+)/(\d+)')
+LOSS_RE = re.compile(r'(?<!val_)loss: ([-+\w.]+)')
+VAL_LOSS_RE = re.compile(r'val_loss: ([-+\w.]+)')
+# Keras rewrites the progress bar in place with carriage returns and backspaces
+PROGBAR_SEPARATORS_RE = re.compile(r'[\r\b]+')
+
+
+class TrainingMonitor:
+    """Follow the log of a cryoCARE training, line by line as it is printed, to keep the loss history."""
+
+    def __init__(self):
+        self.epoch = 0  # Epoch being trained, starting at 1
+        self.nEpochs = None
+        self.history = {'loss': [], 'val_loss': []}
+        self.startTime = time.time()
+        self._epochStartTime = None
+        self._epochTimes = []
+
+    def parseLine(self, line):
+        """Parse a log line. True is returned if it completes an epoch (the validation loss is reported)."""
+        epochDone = False
+        for part in PROGBAR_SEPARATORS_RE.split(line):
+            match = EPOCH_RE.search(part)
+            if match:
+                self.epoch, self.nEpochs = int(match.group(1)), int(match.group(2))
+                self._epochStartTime = time.time()
+                continue
+            valLoss = VAL_LOSS_RE.search(part)
+            loss = LOSS_RE.search(part)
+            if valLoss and loss and len(self.history['val_loss']) < self.epoch:
+                self.history['loss'].append(float(loss.group(1)))
+                self.history['val_loss'].append(float(valLoss.group(1)))
+                if self._epochStartTime is not None:
+                    self._epochTimes.append(time.time() - self._epochStartTime)
+                epochDone = True
+        return epochDone
+
+    def getEpochsDone(self):
+        return len(self.history['val_loss'])
+
+    def getBestEpoch(self):
+        """Epoch, starting at 1, with the lowest validation loss, i.e. the one of the best weights saved."""
+        valLosses = self.history['val_loss']
+        return valLosses.index(min(valLosses)) + 1 if valLosses else None
+
+    def getElapsedTime(self):
+        return time.time() - self.startTime
+
+    def getStatus(self, samplesPerEpoch):
+        """Progress of the training: epoch, losses, throughput and estimated time left."""
+        status = {'epoch': self.getEpochsDone(),
+                  'epochs': self.nEpochs,
+                  'elapsed_seconds': round(self.getElapsedTime())}
+        if self.getEpochsDone():
+            status.update({'loss': self.history['loss'][-1],
+                           'val_loss': self.history['val_loss'][-1],
+                           'best_val_loss': min(self.history['val_loss']),
+                           'best_epoch': self.getBestEpoch()})
+        if self._epochTimes:
+            epochTime = sum(self._epochTimes) / len(self._epochTimes)
+            status.update({'epochs_per_minute': 60 / epochTime,
+                           'samples_per_second': samplesPerEpoch / epochTime})
+            if self.nEpochs:
+                status['eta_seconds'] = round((self.nEpochs - self.getEpochsDone()) * epochTime)
+        return status
+
+
+class EarlyStopping:
+    """Stop criteria of a training: no improvement of the validation loss (by more than minDelta) in the last
+    patience epochs, as the Keras EarlyStopping callback, or a wall-time budget (seconds) exceeded. A value of 0
+    disables the corresponding criterion."""
+
+    def __init__(self, patience=0, minDelta=0., maxTime=0.):
+        self.patience = patience
+        self.minDelta = minDelta
+        self.maxTime = maxTime
+
+    def checkLoss(self, monitor):
+        """Reason to stop according to the validation loss history, or None."""
+        if not self.patience:
+            return None
+        best = float('inf')
+        wait = 0
+        for valLoss in monitor.history['val_loss']:
+            if valLoss < best - self.minDelta:
+                best, wait = valLoss, 0
+            else:
+                wait += 1
+        if wait >= self.patience:
+            return ('the validation loss did not improve by more than %g in the last %i epochs (best %g at epoch %i)'
+                    % (self.minDelta, self.patience, min(monitor.history['val_loss']), monitor.getBestEpoch()))
+        return None
+
+    def checkTime(self, monitor):
+        """Reason to stop according to the time elapsed, or None."""
+        if self.maxTime and monitor.getElapsedTime() > self.maxTime:
+            return 'the wall-time budget of %g hours was exceeded' % (self.maxTime / 3600)
+        return None
+
+
+class ItemProgress:
+    """Throughput and estimated time left of the items (e.g. tomograms) processed by the concurrent steps of a
+    protocol. The items done by a previous execution are counted as done, but not to measure the throughput."""
+
+    def __init__(self, total, done=0):
+        self.total = total
+        self.done = done
+        self.startTime = time.time()
+        self._doneNow = 0
+        self._lock = threading.Lock()
+
+    def addDone(self, n=1):
+        with self._lock:
+            self.done += n
+            self._doneNow += n
+
+    def getStatus(self):
+        with self._lock:
+            elapsed = time.time() - self.startTime
+            status = {'done': self.done,
+                      'total': self.total,
+                      'elapsed_seconds': round(elapsed)}
+            if self._doneNow and elapsed > 0:
+                itemsPerSecond = self._doneNow / elapsed
+                status.update({'items_per_hour': 3600 * itemsPerSecond,
+                               'eta_seconds': round((self.total - self.done) / itemsPerSecond)})
+            return status
+
+
+def writeStatus(fileName, status):
+    """Write the status json file atomically, so its readers never see it half written."""
+    status = dict(status, updated=time.strftime('%Y-%m-%d %H:%M:%S'))
+    tmpFile = '%s.%i-%i.tmp' % (fileName, os.getpid(), threading.get_ident())
+    with open(tmpFile, 'w') as f:
+        json.dump(status, f, indent=2)
+    os.replace(tmpFile, fileName)
+
+
+def readStatus(fileName):
+    """Read a status json file. None is returned if it does not exist (yet)."""
+    try:
+        with open(fileName) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
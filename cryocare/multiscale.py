@@ -0,0 +1,181 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Multiscale, chunked copies of the denoised volumes with the OME-Zarr layout (OME-NGFF 0.4 multiscales on a Zarr
+v2 directory store), so the viewers and pickers that only need a binned overview or a region read only the chunks
+they show. They are written with NumPy only: the full resolution volume is read once, in slabs of a chunk, each
+slab is averaged down to every pyramid level, and the chunks of each level are written by parallel workers."""
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, exists, splitext, basename
+
+MULTISCALE_EXT = '.ome.zarr'
+PYRAMID_LEVELS = 3  # Binned by 2, 4 and 8, besides the full resolution
+CHUNK_SIZE = 64  # Side of the cubic chunks. Multiple of 2^PYRAMID_LEVELS, so the slabs are binned whole
+NGFF_VERSION = '0.4'
+ZARR_FORMAT = 2
+DTYPE = '<f4'
+WRITE_THREADS = 4
+# Attribute of the output objects with the path of their multiscale copy
+MULTISCALE_ATTR = '_multiscale'
+
+
+def getMultiscaleFile(volFile):
+    """Multiscale copy of a volume, next to it."""
+    return splitext(volFile)[0] + MULTISCALE_EXT
+
+
+def setMultiscaleAttribute(obj, path):
+    from pyworkflow.object import String
+    setattr(obj, MULTISCALE_ATTR, String(path))
+
+
+def getMultiscaleAttribute(obj):
+    """Path of the multiscale copy of an output object, or None if it has not one."""
+    value = getattr(obj, MULTISCALE_ATTR, None)
+    return value.get() if value is not None else None
+
+
+def getLevelShapes(shape, nLevels=PYRAMID_LEVELS):
+    """Shape (z, y, x) of the full resolution volume and of each binned level."""
+    shapes = [tuple(shape)]
+    for _ in range(nLevels):
+        shapes.append(tuple(-(-size // 2) for size in shapes[-1]))
+    return shapes
+
+
+def _bin2(block):
+    """Average of each 2x2x2 voxels of a block (z, y, x). The odd sides are padded with their last voxels."""
+    import numpy as np
+    block = np.pad(block, [(0, size % 2) for size in block.shape], mode='edge')
+    nz, ny, nx = block.shape
+    return block.reshape(nz // 2, 2, ny // 2, 2, nx // 2, 2).mean(axis=(1, 3, 5), dtype=np.float32)
+
+
+def _writeChunkRow(levelDir, zChunk, block, chunkSize, executor):
+    """Write the chunks of a row of chunks (up to chunkSize slices) of a level. As Zarr v2 requires, the chunks
+    at the borders are written whole, padded with the fill value."""
+    import numpy as np
+    _, ny, nx = block.shape
+
+    def writeChunk(yx):
+        yChunk, xChunk = yx
+        data = block[:, yChunk * chunkSize:(yChunk + 1) * chunkSize, xChunk * chunkSize:(xChunk + 1) * chunkSize]
+        chunk = np.zeros(3 * (chunkSize,), dtype=DTYPE)
+        chunk[:data.shape[0], :data.shape[1], :data.shape[2]] = data
+        with open(join(levelDir, '%i.%i.%i' % (zChunk, yChunk, xChunk)), 'wb') as f:
+            f.write(chunk.tobytes())
+
+    list(executor.map(writeChunk, [(yChunk, xChunk) for yChunk in range(-(-ny // chunkSize))
+                                   for xChunk in range(-(-nx // chunkSize))]))
+
+
+def _writeMetadata(path, name, shapes, voxelSize, chunkSize):
+    with open(join(path, '.zgroup'), 'w') as f:
+        json.dump({'zarr_format': ZARR_FORMAT}, f)
+    datasets = []
+    for level, shape in enumerate(shapes):
+        with open(join(path, str(level), '.zarray'), 'w') as f:
+            json.dump({'zarr_format': ZARR_FORMAT, 'shape': list(shape), 'chunks': 3 * [chunkSize],
+                       'dtype': DTYPE, 'compressor': None, 'fill_value': 0.0, 'order': 'C', 'filters': None,
+                       'dimension_separator': '.'}, f, indent=2)
+        datasets.append({'path': str(level),
+                         'coordinateTransformations': [{'type': 'scale', 'scale': 3 * [voxelSize * 2 ** level]}]})
+    multiscales = [{'version': NGFF_VERSION,
+                    'name': name,
+                    'axes': [{'name': axis, 'type': 'space', 'unit': 'angstrom'} for axis in 'zyx'],
+                    'datasets': datasets,
+                    'type': 'mean'}]
+    # The attributes are written last: they mark the copy as complete
+    with open(join(path, '.zattrs'), 'w') as f:
+        json.dump({'multiscales': multiscales}, f, indent=2)
+
+
+def writeMultiscale(volFile, path, voxelSize=None, nLevels=PYRAMID_LEVELS, chunkSize=CHUNK_SIZE,
+                    nThreads=WRITE_THREADS):
+    """Write the multiscale copy of a volume (any of the formats of cryocare.volumes). The voxel size (Å) is read
+    from the volume if not given. Each level buffers a row of chunks at most, so the memory is bounded by about
+    2 * chunkSize slices of the volume."""
+    import numpy as np
+    from cryocare.volumes import openVolume
+    if chunkSize % 2 ** nLevels:
+        raise ValueError('The chunk size (%i) must be a multiple of 2^%i.' % (chunkSize, nLevels))
+    tmpPath = '%s.%i.tmp' % (path, os.getpid())
+    shutil.rmtree(tmpPath, ignore_errors=True)
+    with openVolume(volFile) as volume, ThreadPoolExecutor(max_workers=max(1, nThreads)) as executor:
+        voxelSize = voxelSize or (volume.voxelSize[0] if volume.voxelSize else 1.)
+        shapes = getLevelShapes(volume.shape, nLevels)
+        for level in range(len(shapes)):
+            os.makedirs(join(tmpPath, str(level)))
+        pending = [[] for _ in shapes]  # Slabs of each level not written yet
+        chunkRows = [0] * len(shapes)  # Rows of chunks written of each level
+        nz = volume.shape[0]
+        for z0 in range(0, nz, chunkSize):
+            slab = np.asarray(volume.data[z0:z0 + chunkSize], dtype=np.float32)
+            for level in range(len(shapes)):
+                if level:
+                    slab = _bin2(slab)
+                pending[level].append(slab)
+                if sum(len(s) for s in pending[level]) == chunkSize or z0 + chunkSize >= nz:
+                    _writeChunkRow(join(tmpPath, str(level)), chunkRows[level], np.concatenate(pending[level]),
+                                   chunkSize, executor)
+                    pending[level] = []
+                    chunkRows[level] += 1
+    _writeMetadata(tmpPath, basename(splitext(volFile)[0]), shapes, voxelSize, chunkSize)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmpPath, path)
+    return path
+
+
+def isMultiscaleDone(path):
+    return exists(join(path, '.zattrs'))
+
+
+def readMultiscaleLevel(path, level=0, region=None):
+    """Read a level of a multiscale copy, or a region of it (tuple of slices along z, y, x), reading only the
+    chunks that overlap it."""
+    import numpy as np
+    levelDir = join(path, str(level))
+    with open(join(levelDir, '.zarray')) as f:
+        meta = json.load(f)
+    shape, chunkSize = meta['shape'], meta['chunks'][0]
+    region = region or 3 * (slice(None),)
+    bounds = [sl.indices(size)[:2] for sl, size in zip(region, shape)]
+    out = np.zeros([max(0, stop - start) for start, stop in bounds], dtype=np.float32)
+    chunkRanges = [range(start // chunkSize, -(-stop // chunkSize)) for start, stop in bounds]
+    for zc in chunkRanges[0]:
+        for yc in chunkRanges[1]:
+            for xc in chunkRanges[2]:
+                chunk = np.fromfile(join(levelDir, '%i.%i.%i' % (zc, yc, xc)), dtype=meta['dtype'])
+                chunk = chunk.reshape(meta['chunks'])
+                src, dst = [], []
+                for c, (start, stop) in zip((zc, yc, xc), bounds):
+                    lo, hi = max(start, c * chunkSize), min(stop, (c + 1) * chunkSize)
+                    src.append(slice(lo - c * chunkSize, hi - c * chunkSize))
+                    dst.append(slice(lo - start, hi - start))
+                out[tuple(dst)] = chunk[tuple(src)]
+    return out
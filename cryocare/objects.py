@@ -6,10 +6,13 @@ from pwem import EMObject
 
 
 class CryocareTrainData(EMObject):
-    def __init__(self, train_data_dir=None, patch_size=None, **kwargs):
+    """Pairs of even/odd patches to train a model. Its directory may combine several of them (see
+    cryocare.traindata)."""
+    def __init__(self, train_data_dir=None, patch_size=None, binning=None, **kwargs):
         EMObject.__init__(self, **kwargs)
         self._train_data_dir = pwobj.String(train_data_dir)
         self._patch_size = pwobj.Integer(patch_size)
+        self._binning = pwobj.Integer(binning)
 
     def getTrainDataDir(self):
         return self._train_data_dir.get()
@@ -17,15 +20,27 @@ class CryocareTrainData(EMObject):
     def getPatchSize(self):
         return self._patch_size.get()
 
+    def getBinning(self):
+        """Binning of the tomograms the patches were extracted from."""
+        return self._binning.get()
+
     def __str__(self):
         return "CryoCARE Train Data (path=%s)" % self.getTrainDataDir()
 
 
 class CryocareModel(EMObject):
-    def __init__(self, model_file=None, train_data_dir=None, **kwargs):
+    """The trained model carries its own normalization and metadata, so the training and validation
+    datasets are not needed to predict with it."""
+    def __init__(self, model_file=None, train_data_dir=None, mean=None, std=None, patch_size=None,
+                 model_hash=None, binning=None, **kwargs):
         EMObject.__init__(self, **kwargs)
         self._model_file = pwobj.String(model_file)
         self._train_data_dir = pwobj.String(train_data_dir)
+        self._mean = pwobj.Float(mean)
+        self._std = pwobj.Float(std)
+        self._patch_size = pwobj.Integer(patch_size)
+        self._model_hash = pwobj.String(model_hash)
+        self._binning = pwobj.Integer(binning)
 
     def getPath(self):
         return self._model_file.get()
@@ -33,5 +48,28 @@ class CryocareModel(EMObject):
     def getTrainDataDir(self):
         return self._train_data_dir.get()
 
+    def getMean(self):
+        return self._mean.get()
+
+    def getStd(self):
+        return self._std.get()
+
+    def getPatchSize(self):
+        return self._patch_size.get()
+
+    def getModelHash(self):
+        return self._model_hash.get()
+
+    def getBinning(self):
+        """Binning of the tomograms the model was trained with. None if unknown (e.g. imported models)."""
+        return self._binning.get()
+
+    def setModelInfo(self, modelInfo):
+        self._mean.set(modelInfo.get('mean'))
+        self._std.set(modelInfo.get('std'))
+        self._patch_size.set(modelInfo.get('patch_size'))
+        self._model_hash.set(modelInfo.get('hash'))
+        self._binning.set(modelInfo.get('binning'))
+
     def __str__(self):
         return "CryoCARE Model (path=%s)" % self.getPath()
@@ -0,0 +1,147 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Previews of the denoised volumes (central XY/XZ slices and a binned thumbnail volume), generated in background
+threads and read through a memory map, so the volumes do not have to be opened to browse the outputs."""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os.path import splitext, exists
+
+from cryocare.binning import fourierBin
+from cryocare.volumes import openVolume
+
+logger = logging.getLogger(__name__)
+
+PNG = 'png'
+JPEG = 'jpg'
+IMG_FORMATS = [PNG, JPEG]
+XY = 'xy'
+XZ = 'xz'
+THUMBNAIL = 'thumbnail'
+PREVIEW_KEYS = [XY, XZ, THUMBNAIL]
+# Attributes of the output objects with the paths of the previews
+PREVIEW_ATTRS = {XY: '_previewXY', XZ: '_previewXZ', THUMBNAIL: '_previewThumbnail'}
+THUMBNAIL_SIZE = 256  # Max. size of the thumbnail volumes along any axis
+PERCENTILES = (0.5, 99.5)  # Contrast of the slice images
+
+
+def getPreviewFiles(volFile, imgFormat=PNG):
+    """Files of the previews of a volume, next to it."""
+    base = splitext(volFile)[0]
+    return {XY: '%s_%s.%s' % (base, XY, imgFormat),
+            XZ: '%s_%s.%s' % (base, XZ, imgFormat),
+            THUMBNAIL: '%s_%s.mrc' % (base, THUMBNAIL)}
+
+
+def setPreviewAttributes(obj, previewFiles):
+    """Expose the paths of the previews on an output object."""
+    from pyworkflow.object import String
+    for key, attr in PREVIEW_ATTRS.items():
+        setattr(obj, attr, String(previewFiles[key]))
+
+
+def getPreviewAttributes(obj):
+    """Paths of the previews of an output object, or None for the ones that are not available."""
+    previewFiles = {}
+    for key, attr in PREVIEW_ATTRS.items():
+        value = getattr(obj, attr, None)
+        previewFiles[key] = value.get() if value is not None else None
+    return previewFiles
+
+
+def getThumbnailFactor(dims, maxSize=THUMBNAIL_SIZE):
+    """Smallest binning factor that makes the volume fit in maxSize along every axis."""
+    return max(1, -(-max(dims) // maxSize))
+
+
+def _toUint8(image):
+    import numpy as np
+    image = np.asarray(image, dtype=np.float32)
+    low, high = np.percentile(image, PERCENTILES)
+    if high <= low:
+        return np.zeros(image.shape, dtype=np.uint8)
+    return (np.clip((image - low) / (high - low), 0, 1) * 255).astype(np.uint8)
+
+
+def _saveImage(image, fileName):
+    from PIL import Image
+    imgFormat = 'PNG' if fileName.endswith(PNG) else 'JPEG'
+    # Written to a temporary file, so a preview is always complete
+    tmpFile = '%s.%i-%i.tmp' % (fileName, os.getpid(), threading.get_ident())
+    Image.fromarray(_toUint8(image)).save(tmpFile, format=imgFormat)
+    os.replace(tmpFile, fileName)
+
+
+def genPreviews(volFile, previewFiles, maxSize=THUMBNAIL_SIZE):
+    """Write the central XY and XZ slices of a volume and a thumbnail volume binned to fit in maxSize. Only the
+    slices are read from the memory-mapped volume, and the binning is done in chunks."""
+    with openVolume(volFile) as vol:
+        data = vol.data
+        nz, ny, nx = data.shape
+        _saveImage(data[nz // 2], previewFiles[XY])
+        _saveImage(data[:, ny // 2, :], previewFiles[XZ])
+    fourierBin(volFile, previewFiles[THUMBNAIL], getThumbnailFactor((nx, ny, nz), maxSize))
+    return previewFiles
+
+
+def arePreviewsDone(previewFiles):
+    return all(exists(fn) for fn in previewFiles.values())
+
+
+class PreviewGenerator:
+    """Generate the previews of the outputs in a small pool of background threads, off the critical path of the
+    processing. The failures are logged and reported when waiting for the pending previews, as the outputs are
+    usable anyway."""
+
+    def __init__(self, nWorkers=2, maxSize=THUMBNAIL_SIZE):
+        self._maxSize = maxSize
+        self._pool = ThreadPoolExecutor(max_workers=nWorkers, thread_name_prefix='preview')
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, volFile, previewFiles):
+        with self._lock:
+            future = self._pool.submit(genPreviews, volFile, previewFiles, self._maxSize)
+            self._futures[key] = future
+            return future
+
+    def wait(self):
+        """Wait for the pending previews. The keys of the ones that failed are returned, with the errors."""
+        with self._lock:
+            futures = dict(self._futures)
+            self._futures.clear()
+        failed = {}
+        for key, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning('The previews of %s could not be generated: %s' % (key, e))
+                failed[key] = e
+        return failed
+
+    def close(self):
+        self._pool.shutdown(wait=True)
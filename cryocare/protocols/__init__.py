@@ -25,6 +25,9 @@
 # *
 # **************************************************************************
 
+from .protocol_extract_train_data import ProtCryoCAREExtractTrainData
 from .protocol_training import ProtCryoCARETraining
 from .protocol_predict import ProtCryoCAREPrediction
+from .protocol_predict_subtomos import ProtCryoCAREPredictSubtomos
 from .protocol_load_model import ProtCryoCARELoadModel
+from .protocol_sweep import ProtCryoCARESweep
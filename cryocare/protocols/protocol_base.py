@@ -1,19 +1,46 @@
-from typing import Union
+import time
+from datetime import datetime, timedelta
+from os.path import join, exists, dirname
+from typing import Union, TYPE_CHECKING
+
+from cryocare.binning import getBinnedFile
+from cryocare.bundle import readTasks, getPendingTasks, LAUNCHER_FN
+from cryocare.constants import STATUS_FN
+from cryocare.lifecycle import (KEEP_ALL, KEEP_FINAL, KEEP_DAYS, RETENTION_CHOICES, removeIntermediates,
+                                getReferencedPaths, writeRecord, readRecord, sweepExpired)
+from cryocare.memory import FLOAT_BYTES
+from cryocare.monitor import ItemProgress, writeStatus, readStatus
+from cryocare.objects import CryocareModel, CryocareTrainData
+from cryocare.multiscale import getMultiscaleAttribute
+from cryocare.preview import getPreviewAttributes
+from cryocare.resources import getFreeSpace, measureWriteThroughput
+from cryocare.utils import getModelInfoFile
 
 from pwem.protocols import EMProtocol
 from pyworkflow import BETA
+from pyworkflow.constants import PROJECT_DBNAME
 from pyworkflow.object import Pointer
 from pyworkflow.protocol import params
-from pyworkflow.utils import Message
-from tomo.objects import SetOfTomograms
+from pyworkflow.utils import Message, prettySize, prettyDelta
+
+if TYPE_CHECKING:
+    from tomo.objects import SetOfTomograms
 
 # Inputs
+BINNED_DIR = 'binned'
+BUNDLE_DIR = 'array_job'
+BUNDLE_POLL_INTERVAL = 60  # Seconds between the checks of the array job tasks
 IN_TOMOS = 'tomos'
 IN_EVEN_TOMOS = 'evenTomos'
 IN_ODD_TOMOS = 'oddTomos'
 
 class ProtCryoCAREBase(EMProtocol):
     _devStatus = BETA
+    # Type and name of the even/odd volumes introduced
+    _inputClass = 'SetOfTomograms'
+    _inputLabel = 'tomograms'
+    # Condition to show the even/odd inputs and the params to process them, for the protocols that accept others
+    _tomosCondition = None
 
     # -------------------------- DEFINE param functions ----------------------
 
@@ -24,36 +51,90 @@ class ProtCryoCAREBase(EMProtocol):
         """
         # You need a params to belong to a section:
         form.addSection(label=Message.LABEL_INPUT)
+        self._defineAlternativeInputParams(form)
         form.addParam('areEvenOddLinked', params.BooleanParam,
                       default=False,
-                      label="Are odd-even associated to the Tomograms?")
+                      condition=self._getCondition(),
+                      label="Are odd-even associated to the %s?" % self._inputLabel.capitalize())
         form.addParam(IN_EVEN_TOMOS, params.PointerParam,
-                      pointerClass='SetOfTomograms',
-                      condition='not areEvenOddLinked',
-                      label='Even tomograms',
+                      pointerClass=self._inputClass,
+                      condition=self._getCondition('not areEvenOddLinked'),
+                      label='Even %s' % self._inputLabel,
                       allowsNull=True,
                       important=True,
-                      help='Set of tomograms reconstructed from the even frames of the tilt'
-                           'series movies.')
+                      help='Set of %s reconstructed from the even frames of the tilt'
+                           'series movies.' % self._inputLabel)
         form.addParam(IN_ODD_TOMOS, params.PointerParam,
-                      pointerClass='SetOfTomograms',
-                      condition='not areEvenOddLinked',
-                      label='Odd tomograms',
+                      pointerClass=self._inputClass,
+                      condition=self._getCondition('not areEvenOddLinked'),
+                      label='Odd %s' % self._inputLabel,
                       allowsNull=True,
                       important=True,
-                      help='Set of tomogram reconstructed from the odd frames of the tilt'
-                           'series movies.')
+                      help='Set of %s reconstructed from the odd frames of the tilt'
+                           'series movies.' % self._inputLabel)
         form.addParam(IN_TOMOS, params.PointerParam,
-                      pointerClass='SetOfTomograms',
-                      condition='areEvenOddLinked',
-                      label='Tomograms',
+                      pointerClass=self._inputClass,
+                      condition=self._getCondition('areEvenOddLinked'),
+                      label=self._inputLabel.capitalize(),
                       allowsNull=True,
                       important=True)
+        form.addParam('binning', params.IntParam,
+                      default=1,
+                      condition=self._getCondition(),
+                      label='Binning factor',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      validators=[params.GE(1)],
+                      help='If greater than 1, the even/odd tomograms are binned by this factor with Fourier '
+                           'cropping before being processed. Training on binned tomograms and predicting binned '
+                           'previews is much faster, at the cost of resolution. The binned tomograms are cached, so '
+                           'they are only generated once.')
+
+    def _defineBundleParams(self, form):
+        form.addParam('exportBundle', params.BooleanParam,
+                      default=False,
+                      label='Run as a cluster array job?',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='If yes, instead of running cryoCARE, the protocol writes a bundle (in extra/%s) with a '
+                           'config file per tomogram and a launcher script to run them as the tasks of an array job '
+                           '(see the header of %s). The protocol then waits until they are done, or fails if they '
+                           'are not after the time given, to be continued once they are.' % (BUNDLE_DIR, LAUNCHER_FN))
+        form.addParam('bundleWait', params.FloatParam,
+                      default=0,
+                      condition='exportBundle',
+                      label='Time to wait for the array job (hours)',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      validators=[params.GE(0)],
+                      help='Time the protocol waits for the tasks of the array job to be done before failing. If 0, '
+                           'it only checks them once.')
+
+    def _defineRetentionParams(self, form):
+        form.addParam('retention', params.EnumParam,
+                      choices=RETENTION_CHOICES,
+                      default=KEEP_ALL,
+                      label='Intermediate data',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='What to do with the intermediate data (binned tomograms, config files, training '
+                           'patches...) once the outputs are registered: keep it, remove it, or remove it after '
+                           'some days (by the next cryoCARE protocol run in the project after that). The outputs '
+                           'and the files referenced by the cryoCARE models and training data of the project are '
+                           'never removed.')
+        form.addParam('retentionDays', params.IntParam,
+                      default=7,
+                      condition='retention == %i' % KEEP_DAYS,
+                      label='Days to keep the intermediate data',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      validators=[params.Positive])
+
+    def _defineAlternativeInputParams(self, form):
+        """Inputs that replace the even/odd ones, defined before them to be used in _tomosCondition."""
+        pass
 
     def _validate(self):
         # As the input tomograms parameter change based on a condition, all of them must allow empty values at the
         # form level. Thus, the tomograms introduced needs to be validated here
         errorMsg = []
+        if not self._needsTomos():
+            return errorMsg
         if self.areEvenOddLinked.get():
             if not self.tomos.get():
                 errorMsg.append('If the parameter "Are odd-even associated to the Tomograms?" was set to Yes, a set '
@@ -65,10 +146,31 @@ class ProtCryoCAREBase(EMProtocol):
                                 'of even tomograms and a set of odd tomograms must be introduced.')
         return errorMsg
 
+    # --------------------------- STEPS functions ------------------------------
+    def _insertCleanupStep(self, prerequisites) -> int:
+        return self._insertFunctionStep(self.cleanIntermediateStep, prerequisites=prerequisites, needsGPU=False)
+
+    def cleanIntermediateStep(self):
+        referencedPaths = self._getReferencedPaths()
+        finalPaths = self._getFinalPaths()
+        retention = self.retention.get()
+        if retention == KEEP_FINAL:
+            reclaimed = removeIntermediates(self._getIntermediatePaths(), finalPaths + referencedPaths)
+            writeRecord(self.getWorkingDir(), retention, finalPaths=finalPaths, reclaimed=reclaimed)
+            self.info('Intermediate data removed: %s reclaimed.' % prettySize(reclaimed))
+        elif retention == KEEP_DAYS:
+            paths = [path for path in self._getIntermediatePaths() if exists(path)]
+            writeRecord(self.getWorkingDir(), retention, paths=paths, finalPaths=finalPaths,
+                        days=self.retentionDays.get())
+        # Intermediate data of the previous runs whose retention time is over
+        for workingDir, reclaimed in sweepExpired(dirname(self.getWorkingDir()), referencedPaths,
+                                                  exclude=self.getWorkingDir()):
+            self.info('Expired intermediate data of %s removed: %s reclaimed.' % (workingDir, prettySize(reclaimed)))
+
     # --------------------------- UTIL functions -----------------------------------
     def getInTomos(self,
                    even: Union[None, bool] = None,
-                   asPointer: bool = True) -> Union[Pointer, SetOfTomograms]:
+                   asPointer: bool = True) -> Union[Pointer, 'SetOfTomograms']:
         if even is None:
             attribName = IN_TOMOS
         else:
@@ -77,4 +179,124 @@ class ProtCryoCAREBase(EMProtocol):
             else:
                 attribName = IN_ODD_TOMOS
         resPointer = getattr(self, attribName)
-        return resPointer if asPointer else resPointer.get()
\ No newline at end of file
+        return resPointer if asPointer else resPointer.get()
+
+    def _getBundleDir(self) -> str:
+        return self._getExtraPath(BUNDLE_DIR)
+
+    def _waitForBundle(self) -> list:
+        """Wait for the tasks of the array job bundle to be done and return them: list of (index, tsId, config)."""
+        deadline = time.time() + self.bundleWait.get() * 3600
+        pending = getPendingTasks(self._getBundleDir())
+        while pending and time.time() < deadline:
+            time.sleep(min(BUNDLE_POLL_INTERVAL, max(0., deadline - time.time())))
+            pending = getPendingTasks(self._getBundleDir())
+        if pending:
+            raise Exception('%i tasks of the array job are not done yet (tsIds: %s). Submit %s as an array job (or '
+                            'resubmit the failed tasks) and continue the protocol once they are done.'
+                            % (len(pending), ', '.join(tsId for _, tsId, _ in pending[:10]) +
+                               (' ...' if len(pending) > 10 else ''),
+                               join(self._getBundleDir(), LAUNCHER_FN)))
+        return readTasks(self._getBundleDir())
+
+    def _getCondition(self, condition: str = None) -> Union[str, None]:
+        """Condition of a param shown with the even/odd inputs."""
+        return ' and '.join(cond for cond in (self._tomosCondition, condition) if cond) or None
+
+    def _needsTomos(self) -> bool:
+        """True if the even/odd volumes are the input of the protocol, and not the alternative ones."""
+        return True
+
+    def _getInputFile(self, fileName: str) -> str:
+        """Return the file to be processed for the given input tomogram: the binned one if binning was
+        requested."""
+        return getBinnedFile(fileName, self.binning.get(), self._getExtraPath(BINNED_DIR))
+
+    def _getInputSize(self) -> tuple:
+        """Number of even/odd pairs introduced and number of voxels of each volume (once binned)."""
+        inSet = self.getInTomos(even=None if self.areEvenOddLinked.get() else True, asPointer=False)
+        binning = self.binning.get()
+        x, y, z = inSet.getDimensions()
+        return inSet.getSize(), (x // binning) * (y // binning) * (z // binning)
+
+    def _getBinnedBytes(self) -> int:
+        """Bytes of the binned copies of the even/odd volumes."""
+        if self.binning.get() == 1 or not self._needsTomos():
+            return 0
+        nPairs, voxels = self._getInputSize()
+        return 2 * nPairs * voxels * FLOAT_BYTES
+
+    def _getExpectedBytes(self) -> int:
+        """Bytes expected to be written by the protocol."""
+        return self._getBinnedBytes()
+
+    def _validateDiskSpace(self) -> list:
+        """Check, before launching the protocol, that the files it will write fit in its file system."""
+        expectedBytes = self._getExpectedBytes()
+        freeBytes = getFreeSpace(self.getWorkingDir())
+        if expectedBytes > freeBytes:
+            return ['Not enough disk space: %s are expected to be written, but there are only %s free in the '
+                    'file system of the project.\n%s' % (prettySize(expectedBytes), prettySize(freeBytes),
+                                                          self._getDiskCostMsg(withWriteTime=True))]
+        return []
+
+    def _getDiskCostMsg(self, withWriteTime: bool = False) -> str:
+        """Bytes expected to be written and, if requested, the time to write them. The latter writes a probe file
+        to measure the throughput, so it is only done when validating the protocol, not in its summary."""
+        expectedBytes = self._getExpectedBytes()
+        msg = 'Expected disk usage: *%s*' % prettySize(expectedBytes)
+        throughput = measureWriteThroughput(self.getWorkingDir()) if withWriteTime else None
+        if throughput:
+            msg += ' (about %s writing at %s/s)' % (prettyDelta(timedelta(seconds=expectedBytes / throughput)),
+                                                   prettySize(throughput))
+        return msg + '.'
+
+    def _getIntermediatePaths(self) -> list:
+        """Files and directories that are not needed once the outputs are registered."""
+        return [self._getExtraPath(BINNED_DIR), self._getBundleDir()]
+
+    def _getFinalPaths(self) -> list:
+        """Files of the outputs of the protocol."""
+        paths = []
+        for _, output in self.iterOutputAttributes():
+            if isinstance(output, CryocareModel):
+                paths += [output.getPath(), getModelInfoFile(output.getPath()), output.getTrainDataDir()]
+            elif isinstance(output, CryocareTrainData):
+                paths.append(output.getTrainDataDir())
+            elif hasattr(output, 'iterItems'):
+                for item in output.iterItems():
+                    paths.append(item.getFileName())
+                    paths += [fn for fn in getPreviewAttributes(item).values() if fn]
+                    if getMultiscaleAttribute(item):
+                        paths.append(getMultiscaleAttribute(item))
+        return paths
+
+    def _getReferencedPaths(self) -> list:
+        """Files referenced by the models and training data registered in the project."""
+        project = self.getProject()
+        return getReferencedPaths(join(project.path, PROJECT_DBNAME)) if project else []
+
+    def _getRetentionMsg(self) -> Union[str, None]:
+        record = readRecord(self.getWorkingDir())
+        if not record:
+            return None
+        if record['paths']:
+            expires = datetime.fromtimestamp(record['expires'])
+            return 'Intermediate data kept until %s.' % expires.strftime('%Y-%m-%d %H:%M')
+        return 'Intermediate data removed: %s reclaimed.' % prettySize(record['reclaimed'])
+
+    def _addItemsDone(self, progress: ItemProgress, n: int = 1) -> None:
+        """Count items as done and update the status file with the throughput and time left."""
+        progress.addDone(n)
+        writeStatus(self._getExtraPath(STATUS_FN), progress.getStatus())
+
+    def _getItemProgressMsg(self) -> Union[str, None]:
+        status = readStatus(self._getExtraPath(STATUS_FN))
+        if not status:
+            return None
+        msg = '%i/%i %s denoised' % (status['done'], status['total'], self._inputLabel)
+        if 'items_per_hour' in status:
+            msg += ', %.1f %s/hour' % (status['items_per_hour'], self._inputLabel)
+            if status['done'] < status['total']:
+                msg += ', ETA %s' % prettyDelta(timedelta(seconds=status['eta_seconds']))
+        return msg + '.'
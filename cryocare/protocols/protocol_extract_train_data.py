@@ -0,0 +1,455 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+from enum import Enum
+from os.path import join, abspath
+
+from cryocare import Plugin
+from cryocare.bundle import writeBundle
+from cryocare.constants import TRAIN_DATA_DIR, TRAIN_DATA_FN, TRAIN_DATA_CONFIG, VALIDATION_DATA_FN, \
+    TRAIN_DATA_SHARDS_FN
+from cryocare.memory import FLOAT_BYTES
+from cryocare.objects import CryocareTrainData
+from cryocare.protocols.protocol_base import ProtCryoCAREBase
+from cryocare.resources import getAvailableCores
+from cryocare.shards import PRECISIONS, CODECS, NO_CODEC, FLOAT32, CODEC_MODULES, isCodecAvailable, \
+    readShardsHeader
+from cryocare.traindata import writeManifest, isVirtual, getTrainDataParts, extractCoordinates, isCoordinateBased, \
+    compressTrainData, isCompressed
+from cryocare.utils import checkInputTomoSetsSize
+from pyworkflow import BETA
+from pyworkflow.protocol import params, IntParam, FloatParam, Positive, LT, GT, LEVEL_ADVANCED, EnumParam
+from pyworkflow.utils import makePath, cleanPath
+
+# Tilt axis values
+X_AXIS = 0
+Y_AXIS = 1
+Z_AXIS = 2
+X_AXIS_LABEL = 'X'
+Y_AXIS_LABEL = 'Y'
+Z_AXIS_LABEL = 'Z'
+TRAIN_DATA_PARTS_DIR = 'train_data_parts'  # Training data of each tomogram, when extracted by an array job
+PART_NAME = 'part_%05d'
+COORD_BYTES = 4 * 4  # Tomogram index and origin of each patch (int32)
+
+
+class Outputobjects(Enum):
+    train_data = CryocareTrainData
+
+
+class TrainDataExtractionMixin:
+    """Params and steps to extract the training data from the even/odd tomograms introduced, shared by the protocols
+    that extract it. To be used with ProtCryoCAREBase."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._configFile = None
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineExtractionParams(self, form):
+        form.addSection(label='Config Parameters')
+        form.addParam('tilt_axis', EnumParam,
+                      label='Tilt axis of the tomograms',
+                      condition=self._getCondition(),
+                      expertLevel=params.LEVEL_ADVANCED,
+                      choices=[X_AXIS_LABEL, Y_AXIS_LABEL, Z_AXIS_LABEL],
+                      default=Y_AXIS,
+                      allowsNull=False,
+                      display=EnumParam.DISPLAY_HLIST,
+                      help='Tomograms are split along this axis to extract train and validation data separately.')
+
+        form.addParam('patch_shape', IntParam,
+                      label='Side length of the training volumes',
+                      condition=self._getCondition(),
+                      default=72,
+                      help='Corresponding sub-volumes pairs of the provided 3D shape '
+                           'are extracted from the even and odd tomograms. The higher it is,'
+                           'the higher net depth is required for training and the longer it '
+                           'takes. Its value also depends on the resolution of the input tomograms, '
+                           'being a higher patch size required for higher resolution.')
+
+        form.addParam('num_slices', IntParam,
+                      label='Number of training pairs to extract per tomogram',
+                      condition=self._getCondition(),
+                      default=1200,
+                      validators=[Positive],
+                      help='Number of sub-volumes to sample from each pair of even and odd tomograms.')
+
+        form.addParam('n_normalization_samples', IntParam,
+                      label='No. of subvolumes used for normalization per tomogram',
+                      condition=self._getCondition(),
+                      default=120,
+                      expertLevel=LEVEL_ADVANCED,
+                      validators=[Positive],
+                      help='Number of training pairs which will be used to compute mean and standard deviation '
+                           'for normalization. By default this is 10% of the number of training pairs.')
+
+        form.addParam('split', FloatParam,
+                      label='Train-Validation Split',
+                      condition=self._getCondition(),
+                      default=0.9,
+                      validators=[GT(0), LT(1)],
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Training and validation data split value.')
+        form.addParam('storeCoordinates', params.BooleanParam,
+                      label='Store the patch coordinates only?',
+                      condition=self._getCondition(),
+                      default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='If yes, the training pairs are sampled as cryoCARE does, but only their origins, the '
+                           'even/odd tomograms and their normalization are stored, instead of copying the patches. '
+                           'It saves disk space while the training data is stored, but not while training: '
+                           'cryoCARE only reads the patch files, so the training reads the patches from the '
+                           'tomograms and writes them in full when it starts, removing them once it ends. The '
+                           'even/odd (or binned) tomograms are kept as long as the training data is.')
+        form.addParam('patchPrecision', EnumParam,
+                      label='Precision of the patches stored',
+                      condition=self._getCondition('not storeCoordinates'),
+                      choices=list(PRECISIONS),
+                      default=PRECISIONS.index(FLOAT32),
+                      expertLevel=LEVEL_ADVANCED,
+                      display=EnumParam.DISPLAY_HLIST,
+                      help='The patches are extracted as float32. If float16 is chosen, they are stored with half '
+                           'the size, and the round-trip error is reported in the summary (the patches are '
+                           'normalized, so it is usually below 1e-3).')
+        form.addParam('patchCompression', EnumParam,
+                      label='Compression of the patches stored',
+                      condition=self._getCondition('not storeCoordinates'),
+                      choices=list(CODECS),
+                      default=CODECS.index(NO_CODEC),
+                      expertLevel=LEVEL_ADVANCED,
+                      display=EnumParam.DISPLAY_HLIST,
+                      help='The patches can be stored in compressed chunks, which are decompressed in parallel '
+                           'when the training data is read. zlib is always available, zstd and blosc (faster) '
+                           'require the %s packages. The training data is decompressed for cryoCARE only while '
+                           'it is training.' % ' and '.join(CODEC_MODULES.values()))
+
+    # --------------------------- STEPS functions ------------------------------
+    def _initialize(self):
+        makePath(self._getTrainDataConfDir())
+        self._configFile = join(self._getTrainDataConfDir(), TRAIN_DATA_CONFIG)
+
+    def prepareTrainingDataStep(self):
+        if self.areEvenOddLinked.get():
+            fnOdd, fnEven = self.getOddEvenLists()
+        else:
+            self._getListOfTomoNames(self.evenTomos.get())
+            fnOdd = self._getListOfTomoNames(self.oddTomos.get())
+            fnEven = self._getListOfTomoNames(self.evenTomos.get())
+        if self.binning.get() > 1:
+            self.info('Binning the tomograms by %i...' % self.binning.get())
+        # Binned, or converted to MRC if cryoCARE can not read them
+        fnEven = [self._getInputFile(fn) for fn in fnEven]
+        fnOdd = [self._getInputFile(fn) for fn in fnOdd]
+
+        config = self._getExtractionConfig(fnEven, fnOdd, self._getExtraPath('train_data'))
+        with open(self._configFile, 'w+') as f:
+            json.dump(config, f, indent=2)
+
+    def _getExtractionConfig(self, fnEven, fnOdd, path):
+        return {
+            'even': fnEven,
+            'odd': fnOdd,
+            'patch_shape': 3 * [self.patch_shape.get()],
+            'num_slices': self.num_slices.get(),
+            'split': self.split.get(),
+            'tilt_axis': self._decodeTiltAxisValue(self.tilt_axis.get()),
+            'n_normalization_samples': self.n_normalization_samples.get(),
+            'path': path
+        }
+
+    def runDataExtraction(self):
+        if self.storeCoordinates.get():
+            self._extractCoordinates()
+            return
+        # The thread pools are sized to the cores available to the protocol, which may be fewer than the machine
+        # ones (e.g. when running in a queue system)
+        Plugin.runCryocare(self, 'cryoCARE_extract_train_data.py', '--conf %s' % self._configFile,
+                           cores=getAvailableCores())
+
+    def _extractCoordinates(self):
+        with open(self._configFile) as f:
+            config = json.load(f)
+        info = extractCoordinates(config['even'], config['odd'], config['path'], config['patch_shape'][0],
+                                  config['num_slices'], config['split'], config['tilt_axis'],
+                                  config['n_normalization_samples'], nThreads=len(getAvailableCores()))
+        self.info('Coordinates of %i training and %i validation pairs stored in %s (mean %.4g, std %.4g).'
+                  % (info['train'], info['val'], config['path'], info['mean'], info['std']))
+
+    def _compressTrainData(self):
+        """Store the patches extracted with the precision and compression chosen."""
+        precision, codec = self._getPatchPrecision(), self._getPatchCompression()
+        for part in getTrainDataParts(self._getTrainDataDir()):
+            errors = compressTrainData(part['path'], precision, codec, nThreads=len(getAvailableCores()))
+            if errors:
+                self.info('Patches of %s stored as %s (%s compression). Round-trip max. error %.3g.'
+                          % (part['path'], precision, codec, self._getMaxError(errors)))
+
+    @staticmethod
+    def _getMaxError(errors):
+        return max(error['max'] for subsetErrors in errors.values() for error in subsetErrors.values())
+
+    # --------------------------- INFO functions -----------------------------------
+    def _getTrainDataSummary(self):
+        """Summary of the training data extracted."""
+        if isVirtual(self._getTrainDataDir()):
+            nParts = len(getTrainDataParts(self._getTrainDataDir()))
+            return ('Training data extracted per tomogram and combined in *%s* (%i tomograms).\n'
+                    'patch_size = *%s*\n'
+                    'binning = *%s*' % (self._getTrainDataDir(), nParts, self.patch_shape.get(), self.binning.get()))
+        elif isCoordinateBased(self._getTrainDataDir()):
+            parts = getTrainDataParts(self._getTrainDataDir())
+            return ('Coordinates of the training pairs stored in *%s* (%i training and %i validation pairs, read '
+                    'from the tomograms when used).\n'
+                    'patch_size = *%s*\n'
+                    'binning = *%s*' % (self._getTrainDataDir(), parts[0]['train'], parts[0]['val'],
+                                        self.patch_shape.get(), self.binning.get()))
+        elif isCompressed(self._getTrainDataDir()):
+            header = readShardsHeader(self._getShardsFile())
+            return ('Training pairs stored as %s (%s compression) in *%s*.\n'
+                    'Round-trip max. error = *%.3g* (RMS %.3g)\n'
+                    'patch_size = *%s*\n'
+                    'binning = *%s*' % (header['precision'], header['codec'], self._getTrainDataDir(),
+                                        self._getMaxError({'train': header['errors']}),
+                                        max(error['rms'] for error in header['errors'].values()),
+                                        self.patch_shape.get(), self.binning.get()))
+        return ("Generated training data info:\n"
+                "train_data_file = *{}*\n"
+                "validation_data_file = *{}*\n"
+                "patch_size = *{}*\n"
+                "binning = *{}*".format(
+            self._getTrainDataFile(),
+            self._getValidationDataFile(),
+            self.patch_shape.get(),
+            self.binning.get()))
+
+    def _validate(self):
+        validateMsgs = super()._validate()
+        if not validateMsgs:
+            validateMsgs += self._validateParams()
+        if not validateMsgs:
+            validateMsgs += self._validateDiskSpace()
+        return validateMsgs
+
+    def _validateParams(self):
+        """Checks of the params, once the inputs are known to be there."""
+        validateMsgs = []
+        if not self._needsTomos():
+            return validateMsgs
+        sideLength = self.patch_shape.get()
+        binning = self.binning.get()
+        if self.areEvenOddLinked.get():
+            inputTomo = self.tomos.get()
+            try:
+                self.getOddEvenLists()
+            except Exception:
+                validateMsgs.append('Even/Odd tomograms seem no to be linked to the introduced tomograms '
+                                    'at metadata level.')
+
+            xt, yt, zt = [idim // binning for idim in inputTomo.getDimensions()]
+            for idim in [xt, yt, zt]:
+                if idim <= 2 * sideLength:
+                    validateMsgs.append('X, Y and Z dimensions of the (binned) tomograms introduced must '
+                                        'satisfy the condition\n\n*dimension > 2 x SideLength*\n\n'
+                                        '(X, Y, Z) = (%i, %i, %i)\n'
+                                        'SideLength = %i\n\n' % (xt, yt, zt, sideLength))
+                    break
+        else:
+            evenTomos = self.evenTomos.get()
+            oddTomos = self.oddTomos.get()
+            xe, ye, ze = [idim // binning for idim in evenTomos.getDimensions()]
+            xo, yo, zo = [idim // binning for idim in oddTomos.getDimensions()]
+            for idim in [xe, ye, ze, xo, yo, zo]:
+                if idim <= 2 * sideLength:
+                    validateMsgs.append('X, Y and Z dimensions of the (binned) tomograms introduced must satisfy '
+                                        'the condition\n\n*dimension > 2 x SideLength*\n\n'
+                                        '(X, Y, Z) = (%i, %i, %i)\n'
+                                        'SideLength = %i\n\n' % (xe, ye, ze, sideLength))
+                    msg = checkInputTomoSetsSize(evenTomos, oddTomos)
+                    if msg:
+                        validateMsgs.append(msg)
+                    break
+
+        # Check the patch conditions
+        if sideLength % 2 != 0:
+            validateMsgs.append('Patch shape has to be an even number.')
+        codec = self._getPatchCompression()
+        if self._compressesTrainData() and not isCodecAvailable(codec):
+            validateMsgs.append('The %s compression requires the %s python package, which is not installed.'
+                                % (codec, CODEC_MODULES[codec]))
+        return validateMsgs
+
+    # --------------------------- UTIL functions -----------------------------------
+    def _getTrainDataDir(self):
+        return self._getExtraPath(TRAIN_DATA_DIR)
+
+    def _getIntermediatePaths(self):
+        return super()._getIntermediatePaths() + [self._getTrainDataConfDir()]
+
+    def _getTrainDataFile(self):
+        return join(self._getTrainDataDir(), TRAIN_DATA_FN)
+
+    def _getValidationDataFile(self):
+        return join(self._getTrainDataDir(), VALIDATION_DATA_FN)
+
+    def _getShardsFile(self):
+        return join(self._getTrainDataDir(), TRAIN_DATA_SHARDS_FN)
+
+    def _getPatchPrecision(self):
+        return PRECISIONS[self.patchPrecision.get()]
+
+    def _getPatchCompression(self):
+        return CODECS[self.patchCompression.get()]
+
+    def _compressesTrainData(self):
+        """True if the patches extracted are stored compressed or with reduced precision."""
+        return not self.storeCoordinates.get() and (self._getPatchPrecision() != FLOAT32 or
+                                                    self._getPatchCompression() != NO_CODEC)
+
+    def _getTrainDataConfDir(self):
+        return self._getExtraPath(TRAIN_DATA_CONFIG)
+
+    @staticmethod
+    def _decodeTiltAxisValue(value):
+        if value == X_AXIS:
+            return X_AXIS_LABEL
+        elif value == Y_AXIS:
+            return Y_AXIS_LABEL
+        else:
+            return Z_AXIS_LABEL
+
+    @staticmethod
+    def _getListOfTomoNames(tomoSet):
+        return [tomo.getFileName() for tomo in tomoSet]
+
+    def getOddEvenLists(self):
+        oddList = []
+        evenList = []
+        for t in self.tomos.get():
+            odd, even = t.getHalfMaps().split(',')
+            oddList.append(odd)
+            evenList.append(even)
+        return oddList, evenList
+
+    def _getExpectedBytes(self):
+        if not self._needsTomos():
+            return super()._getExpectedBytes()
+        nPairs, _ = self._getInputSize()
+        if self.storeCoordinates.get():
+            patchBytes = nPairs * self.num_slices.get() * COORD_BYTES
+        else:
+            # Train and validation pairs of patches extracted from each tomogram
+            patchBytes = nPairs * self.num_slices.get() * self.patch_shape.get() ** 3 * 2 * FLOAT_BYTES
+        return super()._getExpectedBytes() + patchBytes
+
+
+class ProtCryoCAREExtractTrainData(TrainDataExtractionMixin, ProtCryoCAREBase):
+    """Extract the pairs of even/odd sub-volumes used to train a cryoCARE network. The training data generated can
+    be used by several trainings, and combined with other ones."""
+
+    _label = 'CryoCARE Training Data Extraction'
+    _devStatus = BETA
+    _possibleOutputs = Outputobjects
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        super()._defineParams(form)
+        self._defineExtractionParams(form)
+        self._defineBundleParams(form)  # The extraction can be run as an array job
+        self._defineRetentionParams(form)
+
+    # --------------------------- STEPS functions ------------------------------
+    def _insertAllSteps(self):
+        self._initialize()
+        if self.exportBundle.get():
+            # A task per tomogram, whose training data are combined
+            self._insertFunctionStep(self.exportBundleStep, needsGPU=False)
+            self._insertFunctionStep(self.collectBundleStep, needsGPU=False)
+        else:
+            self._insertFunctionStep(self.prepareTrainingDataStep, needsGPU=False)
+            self._insertFunctionStep(self.runDataExtraction, needsGPU=False)
+        if self._compressesTrainData():
+            self._insertFunctionStep(self.compressTrainDataStep, needsGPU=False)
+        outputId = self._insertFunctionStep(self.createOutputStep, needsGPU=False)
+        self._insertCleanupStep(outputId)
+
+    def exportBundleStep(self):
+        tasks = []
+        for index, (tsId, fnEven, fnOdd) in enumerate(self._getEvenOddPairs()):
+            # The binned tomograms are generated here, as they are small compared with the input ones
+            fnEven, fnOdd = abspath(self._getInputFile(fnEven)), abspath(self._getInputFile(fnOdd))
+            partDir = abspath(self._getExtraPath(TRAIN_DATA_PARTS_DIR, PART_NAME % index))
+            tasks.append((tsId, self._getExtractionConfig([fnEven], [fnOdd], partDir)))
+        cleanPath(self._getBundleDir())
+        launcher = writeBundle(self._getBundleDir(), 'cryoCARE_extract_train_data.py', tasks)
+        self.info('Array job bundle of %i tomograms written. Submit %s as an array job (see its header).'
+                  % (len(tasks), launcher))
+
+    def collectBundleStep(self):
+        tasks = self._waitForBundle()
+        manifest = writeManifest([config['path'] for _, _, config in tasks], self._getTrainDataDir())
+        self.info('Training data of %i tomograms combined (%i training pairs).'
+                  % (len(tasks), sum(part['train'] for part in manifest['parts'])))
+
+    def compressTrainDataStep(self):
+        self._compressTrainData()
+
+    def createOutputStep(self):
+        trainData = CryocareTrainData(train_data_dir=self._getTrainDataDir(),
+                                      patch_size=self.patch_shape.get(),
+                                      binning=self.binning.get())
+        self._defineOutputs(**{Outputobjects.train_data.name: trainData})
+        if self.areEvenOddLinked.get():
+            self._defineSourceRelation(self.tomos, trainData)
+        else:
+            self._defineSourceRelation(self.oddTomos, trainData)
+            self._defineSourceRelation(self.evenTomos, trainData)
+
+    # --------------------------- INFO functions -----------------------------------
+    def _summary(self):
+        if self.isFinished():
+            summary = [self._getTrainDataSummary()]
+        else:
+            summary = [self._getDiskCostMsg()]
+        retentionMsg = self._getRetentionMsg()
+        if retentionMsg:
+            summary.append(retentionMsg)
+        return summary
+
+    def _validateParams(self):
+        validateMsgs = super()._validateParams()
+        if self.storeCoordinates.get() and self.exportBundle.get():
+            validateMsgs.append('The coordinates of the training pairs are sampled by the protocol, so they can '
+                                'not be extracted by an array job.')
+        return validateMsgs
+
+    # --------------------------- UTIL functions -----------------------------------
+    def _getEvenOddPairs(self):
+        """List of (tsId, even file, odd file) of the tomograms introduced."""
+        if self.areEvenOddLinked.get():
+            return [(tomo.getTsId(),) + tuple(reversed(tomo.getHalfMaps().split(','))) for tomo in self.tomos.get()]
+        return [(tomoEven.getTsId(), tomoEven.getFileName(), tomoOdd.getFileName())
+                for tomoEven, tomoOdd in zip(self.evenTomos.get(), self.oddTomos.get())]
@@ -1,14 +1,16 @@
 from enum import Enum
-from os.path import exists, join
+from os.path import exists
 
-from cryocare.utils import makeDatasetSymLinks, getModelName
+from cryocare import Plugin
+from cryocare.utils import getModelName, readModelInfo, writeModelInfo, checkModelInfo, checkModelArchive, \
+    storeModel, linkOrCopyFile
 from pwem.protocols import EMProtocol
 from pyworkflow import BETA
 from pyworkflow.protocol import PathParam, FileParam
 from pyworkflow.utils import Message, createLink
 
-from cryocare.constants import TRAIN_DATA_FN, VALIDATION_DATA_FN
 from cryocare.objects import CryocareModel
+from cryocare.traindata import getTrainDataParts
 
 
 class Outputobjects(Enum):
@@ -41,25 +43,36 @@ class ProtCryoCARELoadModel(EMProtocol):
                            '\t- weights_best.h5\n'
                            '\t- weights_last.h5\n')
         form.addParam('trainDataDir', FileParam,
-                      label='Directory of the prepared data for training',
-                      important=True,
-                      allowsNull=False,
-                      help='It must contain two files: train_data.npz and val_data.npz, generated when '
-                           'preparing the training data.')
+                      label='Directory of the prepared data for training (opt.)',
+                      allowsNull=True,
+                      help='Optional. The prediction only needs the model file, as it contains the normalization '
+                           'values (norm.json) required. If provided, the directory is only referenced from the '
+                           'output model, so its contents are neither copied nor linked.')
 
     def _insertAllSteps(self):
-        self._initialize()
+        self._insertFunctionStep(self.importModelStep, needsGPU=False)
         self._insertFunctionStep(self.createOutputStep, needsGPU=False)
 
-    def _initialize(self):
-        # The prediction is expecting the training and validation datasets to be in the same place as the training
-        # model, but they are located in the training data generation extra directory. Hence, a symbolic link will
-        # be created
-        makeDatasetSymLinks(self, self.trainDataDir.get())
-        createLink(join(self.trainDataModel.get()), getModelName(self))
+    def importModelStep(self):
+        # The model index is generated in a single pass over the archive. It is kept next to the imported model,
+        # so the prediction does not need to read the original archive again
+        modelFile = self.trainDataModel.get()
+        modelInfo = readModelInfo(modelFile)
+        errors = checkModelInfo(modelInfo)  # The weights are only checked here, as the archive is read in full
+        if errors:
+            raise Exception('\n'.join(errors))
+        modelStore = Plugin.getModelStore()
+        if modelStore:
+            # Identical models imported into many projects are hard linked to the same file in the store
+            linkOrCopyFile(storeModel(modelFile, modelInfo, modelStore), getModelName(self))
+        else:
+            createLink(modelFile, getModelName(self))
+        writeModelInfo(modelInfo, getModelName(self))
 
     def createOutputStep(self):
-        model = CryocareModel(model_file=getModelName(self), train_data_dir=self._getExtraPath())
+        modelInfo = readModelInfo(getModelName(self))
+        model = CryocareModel(model_file=getModelName(self), train_data_dir=self.trainDataDir.get())
+        model.setModelInfo(modelInfo)
         self._defineOutputs(**{Outputobjects.model.name: model})
 
     # --------------------------- INFO functions -----------------------------------
@@ -67,16 +80,19 @@ class ProtCryoCARELoadModel(EMProtocol):
         errors = []
         if not exists(self.trainDataModel.get()):
             errors.append('Training model introduced does not exists.')
+        else:
+            # Hashing and indexing the whole archive is left to the import step
+            errors.extend(checkModelArchive(self.trainDataModel.get()))
 
-        if not exists(self.trainDataDir.get()):
+        trainDataDir = self.trainDataDir.get()
+        if trainDataDir and not exists(trainDataDir):
             errors.append('Directory of the prepared data for training does not exists.')
-        else:
-            if not exists(join(self.trainDataDir.get(), TRAIN_DATA_FN)):
-                errors.append('No %s file was found in the introduced training model base directory.' 
-                              % TRAIN_DATA_FN)
-            if not exists(join(self.trainDataDir.get(), VALIDATION_DATA_FN)):
-                errors.append('No %s file was found in the introduced training model base directory.'
-                              % VALIDATION_DATA_FN)
+        elif trainDataDir:
+            try:
+                getTrainDataParts(trainDataDir)
+            except (OSError, ValueError, KeyError) as e:
+                errors.append('Directory of the prepared data for training does not contain cryoCARE training '
+                              'data (extracted, combined, compressed or coordinate-based):\n%s' % e)
         return errors
 
     def _summary(self):
@@ -84,5 +100,28 @@ class ProtCryoCARELoadModel(EMProtocol):
 
         if self.isFinished():
             summary.append("Loaded training model_dir = *%s*" % self.trainDataModel.get())
+            model = getattr(self, Outputobjects.model.name, None)
+            if model:
+                summary.append("Normalization (mean, std) = *(%s, %s)*" % (model.getMean(), model.getStd()))
+                summary.append("Model hash = *%s*" % model.getModelHash())
+            try:
+                parts = getTrainDataParts(self.trainDataDir.get()) if self.trainDataDir.get() else []
+            except (OSError, ValueError, KeyError):
+                parts = []  # Removed or moved since it was loaded
+            if parts:
+                summary.append("Training data = *%i* training and *%i* validation pairs"
+                               % (sum(part['train'] for part in parts), sum(part['val'] for part in parts)))
+        else:
+            modelFile = self.trainDataModel.get()
+            if modelFile and exists(modelFile):
+                try:
+                    modelInfo = readModelInfo(modelFile)
+                except (OSError, ValueError):
+                    return summary
+                config = modelInfo['config']
+                summary.append("Model files: %s" % ', '.join(m['name'] for m in modelInfo['members']))
+                summary.append("U-Net (depth, first channels, kernel size) = *(%s, %s, %s)*"
+                               % (config.get('unet_n_depth'), config.get('unet_n_first'),
+                                  config.get('unet_kern_size')))
         return summary
 
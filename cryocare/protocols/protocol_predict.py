@@ -23,25 +23,42 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
-import glob
+import hashlib
 import json
 import re
-import shutil
 from enum import Enum
-from os.path import join
+from typing import Union
+from os.path import join, basename, abspath, exists
 
+from cryocare.bundle import writeBundle
+from cryocare.manifest import CompletionManifest, getConfigHash
+from cryocare.memory import FLOAT_BYTES
+from cryocare.monitor import ItemProgress
+from cryocare.multiscale import (MULTISCALE_EXT, CHUNK_SIZE, PYRAMID_LEVELS, getMultiscaleFile, isMultiscaleDone,
+                                 setMultiscaleAttribute, writeMultiscale)
+from cryocare.preview import (PreviewGenerator, IMG_FORMATS, THUMBNAIL_SIZE, getPreviewFiles, arePreviewsDone,
+                              setPreviewAttributes)
 from cryocare.protocols.protocol_base import ProtCryoCAREBase
+from cryocare.resources import CoreAllocator
+from cryocare.slabs import DEFAULT_OVERLAP, getSlabs, extractSlab, stitchSlabs
+from cryocare.staging import ScratchStager
+from cryocare.tiling import TilingMemory, getTilingLadder, isOutOfMemory, MAX_ESCALATIONS
+from cryocare.tomoindex import getTomoIndex
 from cryocare.utils import checkInputTomoSetsSize
-from pyworkflow import BETA
+from cryocare.volumes import isCryocareReadable, getVolumePath, readVolumeDims
+from pyworkflow import BETA, Config
 from pyworkflow.object import Set
 from pyworkflow.protocol import params, StringParam, STEPS_PARALLEL
-from pyworkflow.utils import makePath
+from pyworkflow.utils import makePath, moveFile, cleanPath
 from cryocare import Plugin
 from tomo.objects import Tomogram, SetOfTomograms
-from cryocare.constants import PREDICT_CONFIG
+from cryocare.constants import PREDICT_CONFIG, PREDICT_MANIFEST, TOMO_INDEX_FN, TILING_FN
 
 DENOISED_SUFFIX = 'denoised'
 EVEN = 'even'
+ODD = 'odd'
+SLABS_SUFFIX = 'slabs'
+SLABS_CONFIG_FN = 'slabs.json'
 
 
 class Outputobjects(Enum):
@@ -60,8 +77,15 @@ tomograms followed by per-pixel averaging."""
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.sRate = None
-        self.tomoDictEven = {}
-        self.tomoDictOdd = {}
+        self._tomoIndex = {}  # tsId --> TomoDescriptor
+        self._tomoDims = {}  # tsId --> dimensions read from the header of its even tomogram
+        self._manifest = None
+        self._coreAllocator = None
+        self._stager = None
+        self._outputMoves = {}
+        self._progress = None
+        self._previewGenerator = None
+        self._tilingMemory = None
 
     # -------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -84,6 +108,92 @@ tomograms followed by per-pixel averaging."""
                       allowsNull=False,
                       help='Normally the gpu cannot handle the whole size of the tomograms, so it can be split into '
                            'n tiles per axis to process smaller volumes instead of one big at once.')
+        form.addParam('adaptiveTiling', params.BooleanParam,
+                      default=True,
+                      label='Add tiles when running out of memory?',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='If yes, a tomogram whose prediction runs out of GPU or host memory is predicted again '
+                           'with twice the tiles along the axis with the largest tiles, up to %i times. The tiling '
+                           'that worked is used from then on for the tomograms of the same shape, so each '
+                           'tomogram is predicted with the fewest tiles that fit in memory.' % MAX_ESCALATIONS)
+        form.addParam('nSlabs', params.IntParam,
+                      default=1,
+                      label='Slabs per tomogram',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      validators=[params.GE(1)],
+                      help='If greater than 1, each tomogram is split into overlapping slabs along its longest axis, '
+                           'which are denoised by concurrent predictions (as many as the threads and GPUs allow) '
+                           'and stitched, blended across the overlaps. It is meant for a few very large tomograms, '
+                           'which would keep all the workers but one idle otherwise.')
+        form.addParam('slabOverlap', params.IntParam,
+                      default=DEFAULT_OVERLAP,
+                      condition='nSlabs > 1',
+                      label='Slab overlap (px)',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      validators=[params.GE(0)],
+                      help='Pixels each slab extends beyond its boundaries with the neighbouring slabs. The denoised '
+                           'slabs are blended linearly across the overlaps, hiding the border effects of the '
+                           'network. There are fewer slabs than requested if they would be shorter than twice the '
+                           'overlap.')
+
+        form.addParam('pinCores', params.BooleanParam,
+                      default=True,
+                      label='Pin each prediction to its own CPU cores?',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='If yes, each of the concurrent predictions runs on a disjoint set of CPU cores (NUMA '
+                           'aware when possible) and its OpenMP/MKL/TensorFlow thread pools are sized accordingly. '
+                           'This avoids that the concurrent processes oversubscribe the CPU.')
+
+        form.addParam('useScratch', params.BooleanParam,
+                      default=False,
+                      label='Stage the tomograms in a local scratch?',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='If yes, the even/odd tomograms are copied in background to a local scratch directory '
+                           '(e.g. a node-local SSD) while the previous ones are being denoised, and the outputs are '
+                           'written there and moved back asynchronously. It avoids the GPU waiting for the '
+                           'tomograms to be read from slow (network) file systems.')
+        form.addParam('scratchDir', params.PathParam,
+                      default=Config.SCIPION_SCRATCH,
+                      condition='useScratch',
+                      label='Scratch directory',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Local directory in which the tomograms are staged. Its default value is the one of the '
+                           'variable SCIPION_SCRATCH.')
+        form.addParam('scratchMaxSize', params.FloatParam,
+                      default=50,
+                      condition='useScratch',
+                      label='Max. scratch size (GB)',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      validators=[params.Positive],
+                      help='The staged tomograms are evicted, least recently used first, to keep the scratch usage '
+                           'under this size.')
+        form.addParam('genPreviews', params.BooleanParam,
+                      default=True,
+                      label='Generate previews?',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='If yes, the central XY and XZ slices of each denoised tomogram and a thumbnail volume '
+                           '(binned to %i pixels at most) are written next to it in background, so the outputs '
+                           'can be browsed without opening the whole tomograms. The output set is closed before '
+                           'waiting for the last ones.' % THUMBNAIL_SIZE)
+        form.addParam('previewFormat', params.EnumParam,
+                      choices=IMG_FORMATS,
+                      default=0,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      condition='genPreviews',
+                      label='Format of the slice previews',
+                      expertLevel=params.LEVEL_ADVANCED)
+        form.addParam('multiscale', params.BooleanParam,
+                      default=False,
+                      label='Write multiscale chunked copies?',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='If yes, a copy of each denoised tomogram with the OME-Zarr layout (%s) is written next '
+                           'to it, chunked in %i px cubes and with a pyramid binned by %s. Viewers and pickers '
+                           'can then read a binned overview or a region without reading the whole tomogram. The '
+                           'output tomograms are still the MRC files, with the path of their copy.'
+                           % (MULTISCALE_EXT, CHUNK_SIZE, ', '.join(str(2 ** level)
+                                                                  for level in range(1, PYRAMID_LEVELS + 1))))
+        self._defineBundleParams(form)
+        self._defineRetentionParams(form)
 
         form.addParallelSection(threads=1, mpi=0)
         form.addHidden(params.GPU_LIST, params.StringParam,
@@ -95,76 +205,280 @@ tomograms followed by per-pixel averaging."""
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
         self._initialize()
+        if self.exportBundle.get():
+            self._insertBundleSteps()
+            return
         closeSetStepDeps = []
-        for tsId in self.tomoDictEven.keys():
-            predId = self._insertFunctionStep(self.predictStep, tsId,
-                                     prerequisites=[],
-                                     needsGPU=True)
+        for tsId in self._tomoIndex.keys():
+            predDeps = []
+            if self.binning.get() > 1:
+                predDeps.append(self._insertFunctionStep(self.binStep, tsId,
+                                                         prerequisites=[],
+                                                         needsGPU=False))
+            slabs = self._getSlabs(tsId)
+            if slabs:
+                splitId = self._insertFunctionStep(self.splitStep, tsId,
+                                                   prerequisites=predDeps,
+                                                   needsGPU=False)
+                slabIds = [self._insertFunctionStep(self.predictSlabStep, tsId, index,
+                                                    prerequisites=splitId,
+                                                    needsGPU=True)
+                           for index in range(len(slabs))]
+                predId = self._insertFunctionStep(self.stitchStep, tsId,
+                                                  prerequisites=slabIds,
+                                                  needsGPU=False)
+            else:
+                predId = self._insertFunctionStep(self.predictStep, tsId,
+                                         prerequisites=predDeps,
+                                         needsGPU=True)
             cOutId = self._insertFunctionStep(self.createOutputStep, tsId,
                                      prerequisites=predId,
                                      needsGPU=False)
             closeSetStepDeps.append(cOutId)
-        self._insertFunctionStep(self._closeOutputSet,
-                                 prerequisites=closeSetStepDeps,
-                                 needsGPU=False)
+        closeId = self._insertFunctionStep(self._closeOutputSet,
+                                           prerequisites=closeSetStepDeps,
+                                           needsGPU=False)
+        if self.genPreviews.get():
+            # Once the output set is closed, so the next protocols do not wait for the previews
+            closeId = self._insertFunctionStep(self.previewsStep,
+                                               prerequisites=closeId,
+                                               needsGPU=False)
+        if self.useScratch.get():
+            closeId = self._insertFunctionStep(self.cleanScratchStep,
+                                               prerequisites=closeId,
+                                               needsGPU=False)
+        self._insertCleanupStep(closeId)
+
+    def _insertBundleSteps(self):
+        binIds = []
+        if self.binning.get() > 1:
+            binIds = [self._insertFunctionStep(self.binStep, tsId, prerequisites=[], needsGPU=False)
+                      for tsId in self._tomoIndex.keys()]
+        exportId = self._insertFunctionStep(self.exportBundleStep, prerequisites=binIds, needsGPU=False)
+        collectId = self._insertFunctionStep(self.collectBundleStep, prerequisites=exportId, needsGPU=False)
+        closeId = self._insertFunctionStep(self._closeOutputSet, prerequisites=collectId, needsGPU=False)
+        if self.genPreviews.get():
+            closeId = self._insertFunctionStep(self.previewsStep, prerequisites=closeId, needsGPU=False)
+        self._insertCleanupStep(closeId)
 
     def _initialize(self):
         makePath(self._getPredictConfDir())
-        tomoSet = self.tomos.get() if self.areEvenOddLinked.get() else self.evenTomos.get()
+        tomoSet = self._getInTomoSet()
         self.sRate = tomoSet.getSamplingRate()
-        if self.areEvenOddLinked.get():
-            for tomo in self.tomos.get():
-                tsId = tomo.getTsId()
-                odd, even = tomo.getHalfMaps().split(',')
+        # The tsIds of the even set are used (they may be different for both sets)
+        oddSet = None if self.areEvenOddLinked.get() else self.oddTomos.get()
+        self._tomoIndex = getTomoIndex(self._getExtraPath(TOMO_INDEX_FN), tomoSet, oddSet)
 
-                oddTomo = Tomogram()
-                oddTomo.copyInfo(tomo)
-                oddTomo.setLocation(odd)
-
-                evenTomo = Tomogram()
-                evenTomo.copyInfo(tomo)
-                evenTomo.setLocation(even)
-
-                self.tomoDictEven[tsId] = evenTomo
-                self.tomoDictOdd[tsId] = oddTomo
-
-        else:
-            for tomoEven, tomoOdd in zip(self.evenTomos.get(), self.oddTomos.get()):
-                tsId = tomoEven.getTsId()  # Use the same tsId (it may be different for both sets) for both dicts
-                self.tomoDictEven[tsId] = tomoEven.clone()
-                self.tomoDictOdd[tsId] = tomoOdd.clone()
+    def binStep(self, tsId):
+        # Binned in a step of its own, so the binning of the next tomograms overlaps with the GPU predictions
+        self._getInputFile(self._tomoIndex[tsId].even)
+        self._getInputFile(self._tomoIndex[tsId].odd)
 
     def predictStep(self, tsId):
         # Generate the config file: it is in this step instead of in a convertInputStep because of the
         # GPU parallelization from Scipion and the need of declaring that convertInputStep with the
         # attribute needsGpu = True only to be able to access the gpuId assigned, which may be problematic
         # in some cases
-        self._genConfigFile(tsId)
+        progress = self._getProgress()  # Before recording any output, to count the previous ones only
+        config = self._getConfig(tsId)
+        configHash = getConfigHash(config, ignoredKeys=['gpu_id'])
+        manifest = self._getManifest()
+        if manifest.isDone(tsId, configHash):
+            self.info('Tomogram %s was already denoised with the same configuration. Skipping it.' % tsId)
+            return
+        # Remove the outputs partially written by a previous execution that crashed or was stopped
+        cleanPath(self._getOutputPath(tsId))
 
-        # Run cryoCARE
-        Plugin.runCryocare(self, 'cryoCARE_predict.py','--conf %s' % self.getConfigPath(tsId))
-        # Remove even/odd words from the output name to avoid confusion
-        origName = self._getOutputFile(tsId)
-        finalNameRe = re.compile(re.escape(EVEN), re.IGNORECASE)  # Used to do a case-insensitive replacement
-        shutil.move(origName, finalNameRe.sub('', origName))
+        stager = self._getStager()
+        if stager:
+            # Read the inputs from, and write the output to, the scratch. The next tomograms are staged meanwhile
+            config['even'], config['odd'] = stager.get(tsId, [config['even'], config['odd']])
+            config['output'] = stager.getOutputDir(tsId)
+            cleanPath(config['output'])
+            self._prefetchNext(tsId)
+
+        self._runPrediction(tsId, config, self._getProcessedShape(tsId))
+        origName = join(config['output'], basename(config['even']))
+        finalName = self._getFinalOutputName(tsId, origName)
+        if stager:
+            stager.release(tsId)
+            self._outputMoves[tsId] = stager.moveAsync(origName, finalName,
+                                                       onDone=lambda: manifest.add(tsId, configHash, finalName))
+        else:
+            moveFile(origName, finalName)
+            manifest.add(tsId, configHash, finalName)
+        self._addItemsDone(progress)
+
+    def splitStep(self, tsId):
+        if self._getManifest().isDone(tsId, self._getConfigHash(tsId)):
+            return
+        slabsDir = self._getSlabsDir(tsId)
+        # The slabs of a previous execution are reused only if they were split and denoised with the same config
+        slabsConfigFile = join(slabsDir, SLABS_CONFIG_FN)
+        slabsConfig = {'config_hash': self._getConfigHash(tsId)}
+        prevConfig = None
+        if exists(slabsConfigFile):
+            with open(slabsConfigFile) as f:
+                prevConfig = json.load(f)
+        if prevConfig != slabsConfig:
+            cleanPath(slabsDir)
+            makePath(slabsDir)
+            with open(slabsConfigFile, 'w') as f:
+                json.dump(slabsConfig, f)
+        tomo = self._tomoIndex[tsId]
+        for index, slab in enumerate(self._getSlabs(tsId)):
+            for half, inFile in ((EVEN, self._getInputFile(tomo.even)), (ODD, self._getInputFile(tomo.odd))):
+                slabFile = self._getSlabFile(tsId, index, half)
+                if not exists(slabFile):
+                    extractSlab(inFile, slabFile, slab)
+
+    def predictSlabStep(self, tsId, index):
+        if self._getManifest().isDone(tsId, self._getConfigHash(tsId)):
+            return
+        denoisedFile = self._getSlabFile(tsId, index, DENOISED_SUFFIX)
+        if exists(denoisedFile):
+            self.info('Slab %i of %s was already denoised. Skipping it.' % (index, tsId))
+            return
+        name = '%s_slab%02d' % (tsId, index)
+        config = self._getConfig(tsId)
+        config['even'] = self._getSlabFile(tsId, index, EVEN)
+        config['odd'] = self._getSlabFile(tsId, index, ODD)
+        config['output'] = join(self._getSlabsDir(tsId), name)
+        cleanPath(config['output'])
+        slab = self._getSlabs(tsId)[index]
+        self._runPrediction(name, config, slab.getShape(self._getProcessedShape(tsId)))
+        moveFile(join(config['output'], basename(config['even'])), denoisedFile)
+        cleanPath(config['output'])
+
+    def stitchStep(self, tsId):
+        progress = self._getProgress()  # Before recording any output, to count the previous ones only
+        configHash = self._getConfigHash(tsId)
+        manifest = self._getManifest()
+        if manifest.isDone(tsId, configHash):
+            self.info('Tomogram %s was already denoised with the same configuration. Skipping it.' % tsId)
+            return
+        slabs = self._getSlabs(tsId)
+        cleanPath(self._getOutputPath(tsId))
+        makePath(self._getOutputPath(tsId))
+        # Named as cryoCARE names the output of the whole tomogram
+        finalName = self._getFinalOutputName(tsId, self._getInputFile(self._tomoIndex[tsId].even))
+        stitchSlabs([self._getSlabFile(tsId, index, DENOISED_SUFFIX) for index in range(len(slabs))], slabs,
+                    self._getProcessedShape(tsId), finalName)
+        manifest.add(tsId, configHash, finalName)
+        cleanPath(self._getSlabsDir(tsId))
+        self._addItemsDone(progress)
 
     def createOutputStep(self, tsId: str):
+        if tsId in self._outputMoves:
+            self._outputMoves.pop(tsId).result()  # Wait for the output to be moved back from the scratch
+        if self._getManifest().get(tsId) is None:
+            raise Exception('No denoised tomogram was recorded for %s. The prediction may have been interrupted '
+                            'before its output was moved from the scratch. Please, restart the protocol.' % tsId)
+        if self.multiscale.get():
+            self._writeMultiscale(tsId)
         with self._lock:
             outTomos = self._getOutputSetOfTomograms()
-            inTomo = self.tomoDictEven[tsId]
-            outTomo = self._genOutputTomogram(inTomo)
+            outTomo = self._genOutputTomogram(tsId)
             outTomos.append(outTomo)
             outTomos.update(outTomo)
             outTomos.write()
             self._store(outTomos)
+        if self.genPreviews.get():
+            self._getPreviewGenerator().submit(tsId, self._getOutputFile(tsId), self._getPreviewFiles(tsId))
+
+    def exportBundleStep(self):
+        tasks = []
+        for tsId in self._tomoIndex.keys():
+            if self._getManifest().get(tsId) is not None:
+                continue  # Already denoised
+            # The GPU is the one the scheduler makes visible to the task
+            config = self._getConfig(tsId, gpuId=0)
+            config['n_tiles'] = self._getTilingMemory().getStart(self._getProcessedShape(tsId), config['n_tiles'])
+            for key in ('path', 'even', 'odd', 'output'):
+                config[key] = abspath(config[key])
+            cleanPath(config['output'])
+            makePath(config['output'])
+            tasks.append((tsId, config))
+        cleanPath(self._getBundleDir())
+        launcher = writeBundle(self._getBundleDir(), 'cryoCARE_predict.py', tasks)
+        self.info('Array job bundle of %i tomograms written. Submit %s as an array job (see its header).'
+                  % (len(tasks), launcher))
+
+    def collectBundleStep(self):
+        progress = self._getProgress()
+        manifest = self._getManifest()
+        tasks = [task for task in self._waitForBundle() if manifest.get(task[1]) is None]  # Not collected yet
+        for _, tsId, config in tasks:
+            origName = join(config['output'], basename(config['even']))
+            if not exists(origName):
+                raise Exception('The task of %s is done, but its output %s is missing.' % (tsId, origName))
+            finalName = self._getFinalOutputName(tsId, origName)
+            moveFile(origName, finalName)
+            configHash = getConfigHash(self._getConfig(tsId, gpuId=0), ignoredKeys=['gpu_id'])
+            manifest.add(tsId, configHash, finalName)
+        self._addItemsDone(progress, len(tasks))
+        # Registered in bulk, skipping the ones registered by a previous execution
+        outTomos = self._getOutputSetOfTomograms()
+        registered = {tomo.getTsId() for tomo in outTomos.iterItems()}
+        for inTomo in self._getInTomoSet().iterItems():
+            tsId = inTomo.getTsId()
+            if tsId in self._tomoIndex and tsId not in registered:
+                if self.multiscale.get():
+                    self._writeMultiscale(tsId)
+                outTomos.append(self._genOutputTomogram(tsId, inTomo))
+        outTomos.write()
+        self._store(outTomos)
+
+    def previewsStep(self):
+        # Wait for the previews generated in background, and generate the ones missing (e.g. if the protocol was
+        # continued, or the tomograms were denoised by an array job)
+        generator = self._getPreviewGenerator()
+        for tsId in self._tomoIndex.keys():
+            previewFiles = self._getPreviewFiles(tsId)
+            if self._getManifest().get(tsId) is not None and not arePreviewsDone(previewFiles):
+                generator.submit(tsId, self._getOutputFile(tsId), previewFiles)
+        failed = generator.wait()
+        generator.close()
+        if failed:
+            self.info('The previews of %i tomograms could not be generated: %s'
+                      % (len(failed), ', '.join(sorted(failed))))
+
+    def cleanScratchStep(self):
+        stager = self._getStager()
+        if stager:
+            stager.close()
 
     # --------------------------- INFO functions -----------------------------------
     def _summary(self) -> list:
         """ Summarize what the protocol has done"""
         summary = []
-
+        progressMsg = self._getItemProgressMsg()
+        if progressMsg:
+            summary.append(progressMsg)
         if self.isFinished():
             summary.append("Tomogram denoising finished.")
+            if self.binning.get() > 1:
+                summary.append("The tomograms were binned by %i (preview)." % self.binning.get())
+            if self.genPreviews.get():
+                summary.append("Previews (central XY/XZ slices and thumbnail volume) written next to the denoised "
+                               "tomograms.")
+            if self.multiscale.get():
+                summary.append("Multiscale chunked copies (OME-Zarr, %s) written next to the denoised tomograms."
+                               % MULTISCALE_EXT)
+            if self.nSlabs.get() > 1:
+                summary.append("The tomograms were split into up to %i slabs along their longest axis, denoised "
+                               "concurrently and blended across overlaps of %i px."
+                               % (self.nSlabs.get(), self.slabOverlap.get()))
+            nTiles = [int(i) for i in self.n_tiles.get().split()]
+            for shapeKey, shapeTiles in self._getTilingMemory().getAll().items():
+                if shapeTiles != nTiles:
+                    summary.append("Tomograms of shape %s (z, y, x) denoised with n_tiles %s, as they ran out of "
+                                   "memory with fewer tiles." % (shapeKey, ' '.join(map(str, shapeTiles))))
+        else:
+            summary.append(self._getDiskCostMsg())
+        retentionMsg = self._getRetentionMsg()
+        if retentionMsg:
+            summary.append(retentionMsg)
         return summary
 
     def _validate(self) -> list:
@@ -180,34 +494,100 @@ tomograms followed by per-pixel averaging."""
             msg = checkInputTomoSetsSize(self.evenTomos.get(), self.oddTomos.get())
             if msg:
                 validateMsgs.append(msg)
+        if self.useScratch.get() and not self.scratchDir.get():
+            validateMsgs.append('A scratch directory is required to stage the tomograms.')
+        if self.useScratch.get() and self.exportBundle.get():
+            validateMsgs.append('The tomograms can not be staged in a scratch when they are denoised by an array '
+                                'job.')
+        if self.nSlabs.get() > 1 and (self.useScratch.get() or self.exportBundle.get()):
+            validateMsgs.append('The tomograms can not be split into slabs when they are staged in a scratch or '
+                                'denoised by an array job.')
+        if not validateMsgs:
+            validateMsgs += self._validateDiskSpace()
 
         return validateMsgs
 
+    def _warnings(self) -> list:
+        warnMsgs = []
+        modelBinning = self.model.get().getBinning() if self.model.get() else None
+        if modelBinning is not None and modelBinning != self.binning.get():
+            warnMsgs.append('The model was trained with tomograms binned by %i, but the tomograms to denoise will be '
+                            'binned by %i.' % (modelBinning, self.binning.get()))
+        return warnMsgs
+
     # --------------------------- UTIL functions -----------------------------------
-    def _genConfigFile(self, tsId: str) -> None:
-        evenTomo = self.tomoDictEven[tsId]
-        oddTomo = self.tomoDictOdd[tsId]
-        # We do this to accept both GPU specified as '0' 1 2 3' or '0,1,2,3':
-        gpuId = self._stepsExecutor.getGpuList()
-        gpuId = gpuId[0]
+    def _getConfig(self, tsId: str, gpuId: int = None) -> dict:
+        tomo = self._tomoIndex[tsId]
+        if gpuId is None:
+            # We do this to accept both GPU specified as '0' 1 2 3' or '0,1,2,3':
+            gpuId = self._stepsExecutor.getGpuList()
+            gpuId = gpuId[0]
         config = {
             'path': self.model.get().getPath(),
-            'even': evenTomo.getFileName(),
-            'odd': oddTomo.getFileName(),
+            'even': self._getInputFile(tomo.even),
+            'odd': self._getInputFile(tomo.odd),
             'n_tiles': [int(i) for i in self.n_tiles.get().split()],
             'output': self._getOutputPath(tsId),
             'overwrite': False,
-            'gpu_id': gpuId
+            'gpu_id': gpuId,
+            'model_hash': self.model.get().getModelHash()  # Not used by cryoCARE, but identifies the model used
         }
+        return config
+
+    def _getExpectedBytes(self) -> int:
+        nPairs, voxels = self._getInputSize()
+        outBytes = nPairs * voxels * FLOAT_BYTES  # Denoised tomograms
+        if self.multiscale.get():
+            # Each level of the pyramid is 1/8 of the previous one
+            outBytes += outBytes * sum(8 ** -level for level in range(PYRAMID_LEVELS + 1))
+        if self.nSlabs.get() > 1:
+            # Even, odd and denoised slabs of a tomogram, removed once stitched
+            outBytes += 3 * voxels * FLOAT_BYTES
+        return super()._getExpectedBytes() + int(outBytes)
+
+    def _genConfigFile(self, tsId: str, config: dict) -> None:
         with open(self.getConfigPath(tsId), 'w+') as f:
             json.dump(config, f, indent=2)
 
+    def _runPrediction(self, name: str, config: dict, shape: Union[tuple, None]) -> None:
+        """Run cryoCARE with the given config, with more tiles each time it runs out of memory."""
+        tilingMemory = self._getTilingMemory()
+        nTiles = tilingMemory.getStart(shape, config['n_tiles'])
+        ladder = getTilingLadder(nTiles, shape) if self.adaptiveTiling.get() else [nTiles]
+        for i, nTiles in enumerate(ladder):
+            config['n_tiles'] = nTiles
+            self._genConfigFile(name, config)
+            with self._getCoreAllocator().allocate() as cores:
+                exitCode, output = Plugin.runCryocareWithOutput(self, 'cryoCARE_predict.py',
+                                                                '--conf %s' % self.getConfigPath(name),
+                                                                self._getLogPath(name),
+                                                                cores=cores if self.pinCores.get() else None)
+            if exitCode == 0:
+                tilingMemory.remember(shape, nTiles)
+                return
+            if not isOutOfMemory(output, exitCode) or i == len(ladder) - 1:
+                raise Exception('cryoCARE prediction of %s failed with exit code %i (n_tiles %s). See the log for '
+                                'details.' % (name, exitCode, nTiles))
+            self.info('cryoCARE ran out of memory predicting %s with n_tiles %s. Retrying with %s.'
+                      % (name, nTiles, ladder[i + 1]))
+            cleanPath(config['output'])  # Partial output
+
     def _getPredictConfDir(self) -> str:
         return self._getExtraPath(PREDICT_CONFIG)
 
     def getConfigPath(self, tsId) -> str:
         return join(self._getPredictConfDir(), '%s_%s.json' % (PREDICT_CONFIG, tsId))
 
+    def _getLogPath(self, tsId) -> str:
+        """Output of the cryoCARE prediction, copied to the protocol log."""
+        return join(self._getPredictConfDir(), '%s_%s.log' % (PREDICT_CONFIG, tsId))
+
+    def _getIntermediatePaths(self) -> list:
+        # The directory of each tomogram only keeps its denoised tomogram and previews, as they are protected
+        return (super()._getIntermediatePaths() + [self._getPredictConfDir(), self._getExtraPath(TOMO_INDEX_FN)] +
+                [self._getOutputPath(tsId) for tsId in self._tomoIndex.keys()] +
+                [self._getSlabsDir(tsId) for tsId in self._tomoIndex.keys()])
+
     def _getOutputPath(self, tsId) -> str:
         """cryoCARE will generate a new folder for each tomogram denoised. Apart from that, if the
         tomograms were imported, the 'Even_' word can be included in the tsId, as in that case it will be
@@ -216,15 +596,133 @@ tomograms followed by per-pixel averaging."""
         outPathRe = re.compile(re.escape(EVEN), re.IGNORECASE)  # Used to carry out a case-insensitive replacement
         return outPathRe.sub('', outPath)
 
+    def _getFinalOutputName(self, tsId: str, origName: str) -> str:
+        """Remove even/odd words from the output name to avoid confusion. cryoCARE names the output as the even
+        input."""
+        finalNameRe = re.compile(re.escape(EVEN), re.IGNORECASE)  # Used to do a case-insensitive replacement
+        return join(self._getOutputPath(tsId), finalNameRe.sub('', basename(origName)))
+
+    def _getSlabs(self, tsId: str) -> list:
+        """Slabs the tomogram is split into, if more than one (none if its shape is unknown)."""
+        shape = self._getProcessedShape(tsId)
+        if self.nSlabs.get() <= 1 or shape is None:
+            return []
+        slabs = getSlabs(shape, self.nSlabs.get(), self.slabOverlap.get())
+        return slabs if len(slabs) > 1 else []
+
+    def _getSlabsDir(self, tsId: str) -> str:
+        return self._getExtraPath('%s_%s' % (tsId, SLABS_SUFFIX))
+
+    def _getSlabFile(self, tsId: str, index: int, suffix: str) -> str:
+        return join(self._getSlabsDir(tsId), 'slab%02d_%s.mrc' % (index, suffix))
+
+    def _getConfigHash(self, tsId: str) -> str:
+        """Hash of the config of a tomogram split into slabs: the slabs are part of it."""
+        config = self._getConfig(tsId, gpuId=0)
+        config['slabs'] = [slab.toList() for slab in self._getSlabs(tsId)]
+        return getConfigHash(config, ignoredKeys=['gpu_id'])
+
+    def _getCoreAllocator(self) -> CoreAllocator:
+        with self._lock:
+            if self._coreAllocator is None:
+                # Scipion runs numberOfThreads - 1 steps concurrently when using more than one thread
+                nThreads = self.numberOfThreads.get()
+                self._coreAllocator = CoreAllocator(nThreads - 1 if nThreads > 1 else 1)
+        return self._coreAllocator
+
+    def _getStager(self) -> Union[ScratchStager, None]:
+        if not self.useScratch.get():
+            return None
+        with self._lock:
+            if self._stager is None:
+                # A directory per protocol run, as several ones may share the scratch
+                runHash = hashlib.md5(abspath(self.getWorkingDir()).encode()).hexdigest()[:12]
+                self._stager = ScratchStager(join(self.scratchDir.get(), 'cryocare-%s' % runHash),
+                                             self.scratchMaxSize.get() * 1024 ** 3)
+        return self._stager
+
+    def _prefetchNext(self, tsId: str) -> None:
+        """Stage the tomograms that will be denoised by the next concurrent steps."""
+        if self.binning.get() > 1:
+            return  # The binned tomograms are small and may not have been generated yet
+        tsIds = list(self._tomoIndex.keys())
+        nThreads = self.numberOfThreads.get()
+        nextTsIds = tsIds[tsIds.index(tsId) + 1: tsIds.index(tsId) + 1 + max(1, nThreads - 1)]
+        for nextTsId in nextTsIds:
+            files = [self._tomoIndex[nextTsId].even, self._tomoIndex[nextTsId].odd]
+            if self._getManifest().get(nextTsId) is not None or not all(isCryocareReadable(fn) for fn in files):
+                continue  # Already denoised, or to be converted first
+            self._stager.prefetch(nextTsId, [getVolumePath(fn) for fn in files])
+
+    def _getPreviewGenerator(self) -> PreviewGenerator:
+        with self._lock:
+            if self._previewGenerator is None:
+                self._previewGenerator = PreviewGenerator()
+        return self._previewGenerator
+
+    def _getPreviewFiles(self, tsId: str) -> dict:
+        return getPreviewFiles(self._getOutputFile(tsId), IMG_FORMATS[self.previewFormat.get()])
+
+    def _getTilingMemory(self) -> TilingMemory:
+        with self._lock:
+            if self._tilingMemory is None:
+                self._tilingMemory = TilingMemory(self._getExtraPath(TILING_FN))
+        return self._tilingMemory
+
+    def _getProcessedShape(self, tsId: str) -> Union[tuple, None]:
+        """Shape (z, y, x) of the tomogram to be denoised, once binned. None if it is unknown."""
+        dims = self._tomoDims.get(tsId)
+        if dims is None:
+            # Read on demand, as the index only has the dimensions of the set (the ones of its first tomogram)
+            descriptor = self._tomoIndex[tsId]
+            dims = self._tomoDims[tsId] = readVolumeDims(descriptor.even) or descriptor.dims
+        if not dims:
+            return None
+        return tuple(size // self.binning.get() for size in reversed(dims))
+
+    def _getManifest(self) -> CompletionManifest:
+        with self._lock:
+            if self._manifest is None:
+                self._manifest = CompletionManifest(self._getExtraPath(PREDICT_MANIFEST))
+        return self._manifest
+
+    def _getProgress(self) -> ItemProgress:
+        with self._lock:
+            if self._progress is None:
+                # The tomograms denoised by a previous execution are counted as done
+                tsIds = self._tomoIndex.keys()
+                self._progress = ItemProgress(len(tsIds), sum(1 for tsId in tsIds if self._getManifest().get(tsId)))
+        return self._progress
+
     def _getOutputFile(self, tsId) -> str:
-        return glob.glob(join(self._getOutputPath(tsId), '*'))[0]  # Only one file is contained in each dir
+        return self._getManifest().get(tsId)['output']
 
-    def _genOutputTomogram(self, inTomo: Tomogram) -> Tomogram:
+    def _getInTomoSet(self) -> SetOfTomograms:
+        """Set of the tomograms introduced (the even ones if the half maps are not associated)."""
+        return self.tomos.get() if self.areEvenOddLinked.get() else self.evenTomos.get()
+
+    def _genOutputTomogram(self, tsId: str, inTomo: Tomogram = None) -> Tomogram:
+        """Output tomogram of a tsId. The input one is only read from the input set here, if not provided."""
+        if inTomo is None:
+            inTomo = self._getInTomoSet()[self._tomoIndex[tsId].objId]
         tomo = Tomogram()
         tomo.copyInfo(inTomo)
-        tomo.setLocation(self._getOutputFile(inTomo.getTsId()))
+        tomo.setLocation(self._getOutputFile(tsId))
+        tomo.setSamplingRate(self._getOutputSamplingRate())
+        if self.genPreviews.get():
+            setPreviewAttributes(tomo, self._getPreviewFiles(tsId))
+        if self.multiscale.get():
+            setMultiscaleAttribute(tomo, getMultiscaleFile(self._getOutputFile(tsId)))
         return tomo
 
+    def _writeMultiscale(self, tsId: str) -> None:
+        multiscaleFile = getMultiscaleFile(self._getOutputFile(tsId))
+        if not isMultiscaleDone(multiscaleFile):  # E.g. written before the protocol was continued
+            writeMultiscale(self._getOutputFile(tsId), multiscaleFile, voxelSize=self._getOutputSamplingRate())
+
+    def _getOutputSamplingRate(self) -> float:
+        return self.sRate * self.binning.get()
+
     def _getOutputSetOfTomograms(self) -> SetOfTomograms:
         outTomograms = getattr(self, self._possibleOutputs.tomograms.name, None)
         if outTomograms:
@@ -234,6 +732,7 @@ tomograms followed by per-pixel averaging."""
             inSetPointer = self.getInTomos(asPointer=True, even=even)
             outTomograms = SetOfTomograms.create(self._getPath(), template='tomograms%s.sqlite')
             outTomograms.copyInfo(inSetPointer.get())
+            outTomograms.setSamplingRate(self._getOutputSamplingRate())
             outTomograms.setStreamState(Set.STREAM_OPEN)
             self._defineOutputs(**{self._possibleOutputs.tomograms.name: outTomograms})
             if self.areEvenOddLinked.get():
@@ -0,0 +1,297 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+import os
+from enum import Enum
+from os.path import join
+
+from cryocare import Plugin
+from cryocare.constants import PREDICT_CONFIG, PREDICT_MANIFEST
+from cryocare.manifest import CompletionManifest, getConfigHash
+from cryocare.memory import FLOAT_BYTES
+from cryocare.monitor import ItemProgress
+from cryocare.protocols.protocol_base import ProtCryoCAREBase
+from cryocare.protocols.protocol_predict import DENOISED_SUFFIX
+from cryocare.utils import checkInputTomoSetsSize
+from cryocare.volumes import getMrcName
+from pyworkflow import BETA
+from pyworkflow.object import Set
+from pyworkflow.protocol import params, StringParam, STEPS_PARALLEL
+from pyworkflow.utils import makePath, cleanPath
+from tomo.objects import SubTomogram, SetOfSubTomograms
+
+BATCH = 'batch_%05d'
+
+
+class Outputobjects(Enum):
+    subtomograms = SetOfSubTomograms
+
+
+class ProtCryoCAREPredictSubtomos(ProtCryoCAREBase):
+    """Denoise a set of subtomograms with a trained cryoCARE model. The subtomograms are denoised in batches,
+loading the model once per batch, and the denoised subtomograms keep the metadata (coordinates, transformations...)
+of the input ones."""
+
+    _label = 'CryoCARE Subtomogram Prediction'
+    _devStatus = BETA
+    _possibleOutputs = Outputobjects
+    _inputClass = 'SetOfSubTomograms'
+    _inputLabel = 'subtomograms'
+    stepsExecutionMode = STEPS_PARALLEL
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.sRate = None
+        self._batches = []  # Lists of (subtomogram id, even file, odd file)
+        self._manifest = None
+        self._progress = None
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        """ Define the input parameters that will be used.
+        Params:
+            form: this is the form to be populated with sections and params.
+        """
+        super()._defineParams(form)
+        form.addParam('model', params.PointerParam,
+                      pointerClass='CryocareModel',
+                      label="cryoCARE Model",
+                      important=True,
+                      allowsNull=False,
+                      help='Select a trained cryoCARE model.')
+        form.addParam('n_tiles', StringParam,
+                      label="Number of tiles",
+                      default='1 1 1',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Number of tiles per axis in which each subtomogram is split to be processed. The '
+                           'subtomograms are usually small enough to be processed at once.')
+        form.addParam('batchSize', params.IntParam,
+                      default=500,
+                      label='Subtomograms per batch',
+                      validators=[params.Positive],
+                      help='The subtomograms are denoised in batches by a single cryoCARE process each, so the '
+                           'model is loaded once per batch instead of once per subtomogram. The batches are '
+                           'distributed among the GPUs and threads.')
+        self._defineRetentionParams(form)
+
+        form.addParallelSection(threads=1, mpi=0)
+        form.addHidden(params.GPU_LIST, params.StringParam,
+                       default='0',
+                       expertLevel=params.LEVEL_ADVANCED,
+                       label="Choose GPU IDs",
+                       help="GPU ID, normally it is 0.")
+
+    # --------------------------- STEPS functions ------------------------------
+    def _insertAllSteps(self):
+        self._initialize()
+        closeSetStepDeps = []
+        for batchInd in range(len(self._batches)):
+            predId = self._insertFunctionStep(self.predictBatchStep, batchInd,
+                                              prerequisites=[],
+                                              needsGPU=True)
+            cOutId = self._insertFunctionStep(self.createOutputStep, batchInd,
+                                              prerequisites=predId,
+                                              needsGPU=False)
+            closeSetStepDeps.append(cOutId)
+        closeId = self._insertFunctionStep(self._closeOutputSet,
+                                           prerequisites=closeSetStepDeps,
+                                           needsGPU=False)
+        self._insertCleanupStep(closeId)
+
+    def _initialize(self):
+        makePath(self._getPredictConfDir())
+        inSet = self._getInSet()
+        self.sRate = inSet.getSamplingRate()
+        # The items are listed in id order, so each batch corresponds to a range of ids of the input set
+        if self.areEvenOddLinked.get():
+            items = []
+            for subtomo in inSet.iterItems(orderBy='id'):
+                odd, even = subtomo.getHalfMaps().split(',')
+                items.append((subtomo.getObjId(), even, odd))
+        else:
+            items = [(even.getObjId(), even.getFileName(), odd.getFileName())
+                     for even, odd in zip(self.evenTomos.get().iterItems(orderBy='id'),
+                                          self.oddTomos.get().iterItems(orderBy='id'))]
+        batchSize = self.batchSize.get()
+        self._batches = [items[i:i + batchSize] for i in range(0, len(items), batchSize)]
+
+    def predictBatchStep(self, batchInd: int):
+        progress = self._getProgress()  # Before recording any output, to count the previous ones only
+        batchId = BATCH % batchInd
+        config = self._getConfig(batchInd)
+        configHash = getConfigHash(config, ignoredKeys=['gpu_id'])
+        manifest = self._getManifest()
+        if manifest.isDone(batchId, configHash):
+            self.info('Batch %s was already denoised with the same configuration. Skipping it.' % batchId)
+            return
+        cleanPath(config['output'])
+        # cryoCARE names the outputs as the even inputs, so they are linked with unique names
+        inDir = self._getBatchPath(batchInd, 'in')
+        cleanPath(inDir)
+        for half in ('even', 'odd'):
+            makePath(join(inDir, half))
+        for objId, even, odd in self._batches[batchInd]:
+            os.symlink(os.path.abspath(self._getInputFile(even)), join(inDir, 'even', self._getItemName(objId, even)))
+            os.symlink(os.path.abspath(self._getInputFile(odd)), join(inDir, 'odd', self._getItemName(objId, even)))
+        with open(self._getConfigPath(batchInd), 'w+') as f:
+            json.dump(config, f, indent=2)
+
+        Plugin.runCryocare(self, 'cryoCARE_predict.py', '--conf %s' % self._getConfigPath(batchInd))
+        cleanPath(inDir)
+        manifest.add(batchId, configHash, config['output'])
+        self._addItemsDone(progress, len(self._batches[batchInd]))
+
+    def createOutputStep(self, batchInd: int):
+        batch = self._batches[batchInd]
+        outDir = self._getManifest().get(BATCH % batchInd)['output']
+        itemNames = {objId: self._getItemName(objId, even) for objId, even, _ in batch}
+        inSet = self._getInSet()
+        with self._lock:
+            outSubtomos = self._getOutputSetOfSubtomograms()
+            where = 'id >= %i AND id <= %i' % (batch[0][0], batch[-1][0])
+            for subtomo in inSet.iterItems(orderBy='id', where=where):
+                outSubtomo = self._genOutputSubtomogram(subtomo, join(outDir, itemNames[subtomo.getObjId()]))
+                outSubtomos.append(outSubtomo)
+            outSubtomos.write()
+            self._store(outSubtomos)
+
+    # --------------------------- INFO functions -----------------------------------
+    def _summary(self) -> list:
+        summary = []
+        progressMsg = self._getItemProgressMsg()
+        if progressMsg:
+            summary.append(progressMsg)
+        if self.isFinished():
+            summary.append('%i subtomograms denoised in batches of %i.'
+                           % (getattr(self, Outputobjects.subtomograms.name).getSize(), self.batchSize.get()))
+        else:
+            summary.append(self._getDiskCostMsg())
+        retentionMsg = self._getRetentionMsg()
+        if retentionMsg:
+            summary.append(retentionMsg)
+        return summary
+
+    def _validate(self) -> list:
+        validateMsgs = super()._validate()
+        if not self.areEvenOddLinked.get() and self.evenTomos.get() and self.oddTomos.get():
+            msg = checkInputTomoSetsSize(self.evenTomos.get(), self.oddTomos.get())
+            if msg:
+                validateMsgs.append(msg)
+        if not validateMsgs:
+            validateMsgs += self._validateDiskSpace()
+        return validateMsgs
+
+    # --------------------------- UTIL functions -----------------------------------
+    def _getInSet(self):
+        return self.tomos.get() if self.areEvenOddLinked.get() else self.evenTomos.get()
+
+    def _getConfig(self, batchInd: int) -> dict:
+        batch = self._batches[batchInd]
+        inDir = self._getBatchPath(batchInd, 'in')
+        gpuId = self._stepsExecutor.getGpuList()[0]
+        return {
+            'path': self.model.get().getPath(),
+            'even': [join(inDir, 'even', self._getItemName(objId, even)) for objId, even, _ in batch],
+            'odd': [join(inDir, 'odd', self._getItemName(objId, even)) for objId, even, _ in batch],
+            'n_tiles': [int(i) for i in self.n_tiles.get().split()],
+            'output': self._getBatchPath(batchInd, DENOISED_SUFFIX),
+            'overwrite': False,
+            'gpu_id': gpuId,
+            'model_hash': self.model.get().getModelHash(),  # Not used by cryoCARE, but identifies the model used
+            'inputs': [self._getInputFile(even) for _, even, _ in batch]  # Identifies the subtomograms linked
+        }
+
+    def _getExpectedBytes(self) -> int:
+        nPairs, voxels = self._getInputSize()
+        return super()._getExpectedBytes() + nPairs * voxels * FLOAT_BYTES  # Denoised subtomograms
+
+    @staticmethod
+    def _getItemName(objId: int, fileName: str) -> str:
+        return '%06d_%s' % (objId, getMrcName(fileName))
+
+    def _getIntermediatePaths(self) -> list:
+        # The denoised subtomograms are protected, so only the rest of the batch directories is removed
+        return (super()._getIntermediatePaths() + [self._getPredictConfDir()] +
+                [self._getBatchPath(batchInd) for batchInd in range(len(self._batches))])
+
+    def _getBatchPath(self, batchInd: int, *paths) -> str:
+        return self._getExtraPath(BATCH % batchInd, *paths)
+
+    def _getPredictConfDir(self) -> str:
+        return self._getExtraPath(PREDICT_CONFIG)
+
+    def _getConfigPath(self, batchInd: int) -> str:
+        return join(self._getPredictConfDir(), '%s_%s.json' % (PREDICT_CONFIG, BATCH % batchInd))
+
+    def _getManifest(self) -> CompletionManifest:
+        with self._lock:
+            if self._manifest is None:
+                self._manifest = CompletionManifest(self._getExtraPath(PREDICT_MANIFEST))
+        return self._manifest
+
+    def _getProgress(self) -> ItemProgress:
+        with self._lock:
+            if self._progress is None:
+                # The batches denoised by a previous execution are counted as done
+                self._progress = ItemProgress(sum(len(batch) for batch in self._batches),
+                                              sum(len(batch) for batchInd, batch in enumerate(self._batches)
+                                                  if self._getManifest().get(BATCH % batchInd)))
+        return self._progress
+
+    def _genOutputSubtomogram(self, inSubtomo: SubTomogram, fileName: str) -> SubTomogram:
+        # The clone keeps the coordinate, transformation, acquisition and tomogram of the input subtomogram
+        subtomo = inSubtomo.clone()
+        subtomo.setLocation(fileName)
+        if subtomo.hasHalfMaps():
+            subtomo.setHalfMaps([])
+        binning = self.binning.get()
+        if binning > 1:
+            subtomo.setSamplingRate(self.sRate * binning)
+            if subtomo.hasTransform():
+                # The shifts are expressed in pixels
+                matrix = subtomo.getTransform().getMatrix()
+                matrix[:3, 3] /= binning
+                subtomo.getTransform().setMatrix(matrix)
+        return subtomo
+
+    def _getOutputSetOfSubtomograms(self) -> SetOfSubTomograms:
+        outSubtomos = getattr(self, Outputobjects.subtomograms.name, None)
+        if outSubtomos:
+            outSubtomos.enableAppend()
+        else:
+            inSetPointer = self.tomos if self.areEvenOddLinked.get() else self.evenTomos
+            outSubtomos = SetOfSubTomograms.create(self._getPath(), template='subtomograms%s.sqlite')
+            outSubtomos.copyInfo(inSetPointer.get())
+            outSubtomos.setSamplingRate(self.sRate * self.binning.get())
+            outSubtomos.setStreamState(Set.STREAM_OPEN)
+            self._defineOutputs(**{Outputobjects.subtomograms.name: outSubtomos})
+            if self.areEvenOddLinked.get():
+                self._defineSourceRelation(inSetPointer, outSubtomos)
+            else:
+                self._defineSourceRelation(self.evenTomos, outSubtomos)
+                self._defineSourceRelation(self.oddTomos, outSubtomos)
+            self._defineSourceRelation(self.model, outSubtomos)
+        return outSubtomos
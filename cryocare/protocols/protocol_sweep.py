@@ -0,0 +1,233 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import csv
+import itertools
+import json
+import pickle
+import random
+from os.path import join, exists
+
+from cryocare.constants import CRYOCARE_MODEL, CRYOCARE_MODEL_TGZ, STATUS_FN
+from cryocare.lifecycle import KEEP_ALL, linkFinal
+from cryocare.memory import estimateTrainingMemory, getUNetParams, GB, FLOAT_BYTES
+from cryocare.protocols.protocol_training import ProtCryoCARETraining, MODEL_WEIGHTS_COPIES
+from cryocare.utils import getModelName
+from pyworkflow.protocol import params, STEPS_PARALLEL
+from pyworkflow.utils import makePath
+
+SWEEP_DIR = 'sweep'
+CONFIG_NAME = 'config_%03d'
+RESULTS_FN = 'sweep_results.csv'
+TRAIN_CONFIG_FN = 'train_config.json'
+HISTORY_FN = 'history.dat'
+# Sweep modes
+GRID = 0
+RANDOM = 1
+# Hyperparameters swept, as named in the cryoCARE training config
+SWEPT_PARAMS = ['unet_n_depth', 'unet_n_first', 'learning_rate', 'batch_size']
+RESULT_FIELDS = ['config'] + SWEPT_PARAMS + ['epochs', 'best_epoch', 'best_val_loss', 'final_loss']
+
+
+class ProtCryoCARESweep(ProtCryoCARETraining):
+    """Train several cryoCARE models with different hyperparameters on the same training data, which is extracted
+only once, and output the one with the lowest validation loss. The trainings are run concurrently over the GPUs
+selected."""
+
+    _label = 'CryoCARE Hyperparameter Sweep'
+    stepsExecutionMode = STEPS_PARALLEL
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        super()._defineParams(form)
+        form.addSection(label='Sweep')
+        form.addParam('sweepMode', params.EnumParam,
+                      choices=['Grid', 'Random'],
+                      default=GRID,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label='Sweep mode',
+                      help='Grid: all the combinations of the values below are trained.\n'
+                           'Random: a number of those combinations, picked at random, are trained.')
+        form.addParam('nConfigs', params.IntParam,
+                      default=4,
+                      condition='sweepMode == %i' % RANDOM,
+                      validators=[params.Positive],
+                      label='Number of configurations',
+                      help='Number of combinations of hyperparameters trained.')
+        form.addParam('randomSeed', params.IntParam,
+                      default=0,
+                      condition='sweepMode == %i' % RANDOM,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Random seed')
+        form.addParam('sweepDepths', params.StringParam,
+                      default='2 3',
+                      label='U-Net depths',
+                      help='Space separated values. If empty, the U-Net depth of the U-Net Parameters tab is used. '
+                           'The patch size must be divisible by 2^depth.')
+        form.addParam('sweepNFirst', params.StringParam,
+                      default='',
+                      label='Numbers of initial feature channels',
+                      help='Space separated values. If empty, the value of the U-Net Parameters tab is used.')
+        form.addParam('sweepLearningRates', params.StringParam,
+                      default='0.0004 0.0001',
+                      label='Learning rates',
+                      help='Space separated values. If empty, the value of the Training Parameters tab is used.')
+        form.addParam('sweepBatchSizes', params.StringParam,
+                      default='',
+                      label='Batch sizes',
+                      help='Space separated values. If empty, the value of the Training Parameters tab is used.')
+        form.addParallelSection(threads=1, mpi=0)
+
+    # --------------------------- STEPS functions ------------------------------
+    def _insertAllSteps(self):
+        self._initialize()
+        trainDataId = self._insertTrainDataSteps()
+        # The trainings are queued and run as the GPUs become free
+        trainIds = [self._insertFunctionStep(self.trainConfigStep, configInd, prerequisites=trainDataId,
+                                             needsGPU=True)
+                    for configInd in range(len(self._getSweepConfigs()))]
+        collectId = self._insertFunctionStep(self.collectResultsStep, prerequisites=trainIds, needsGPU=False)
+        outputId = self._insertFunctionStep(self.createOutputStep, prerequisites=collectId, needsGPU=False)
+        self._insertCleanupStep(outputId)
+
+    def trainConfigStep(self, configInd: int):
+        configDir = self._getConfigDir(configInd)
+        makePath(configDir)
+        config = self._getTrainingConfig(configDir, self._stepsExecutor.getGpuList()[0])
+        config.update(self._getSweepConfigs()[configInd])
+        configPath = join(configDir, TRAIN_CONFIG_FN)
+        with open(configPath, 'w') as f:
+            json.dump(config, f, indent=2)
+        self._train(configPath, configDir, join(configDir, STATUS_FN), logPrefix='[%s] ' % (CONFIG_NAME % configInd))
+
+    def collectResultsStep(self):
+        results = []
+        for configInd, config in enumerate(self._getSweepConfigs()):
+            with open(join(self._getConfigDir(configInd), CRYOCARE_MODEL, HISTORY_FN), 'rb') as f:
+                history = pickle.load(f)
+            valLosses = history['val_loss']
+            result = {'config': CONFIG_NAME % configInd,
+                      'epochs': len(valLosses),
+                      'best_epoch': valLosses.index(min(valLosses)) + 1,
+                      'best_val_loss': min(valLosses),
+                      'final_loss': history['loss'][-1]}
+            result.update(config)
+            results.append(result)
+        with open(self._getResultsFile(), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+            writer.writeheader()
+            writer.writerows(sorted(results, key=lambda result: result['best_val_loss']))
+
+    def createOutputStep(self):
+        best = self._readResults()[0]
+        modelFile = join(self._getExtraPath(SWEEP_DIR, best['config']), CRYOCARE_MODEL_TGZ)
+        if self.retention.get() != KEEP_ALL:
+            # Kept out of the sweep directory, which is intermediate data, without copying it
+            finalModelFile = getModelName(self)
+            self.info('Best model kept as %s (%s).' % (finalModelFile, linkFinal(modelFile, finalModelFile)))
+            modelFile = finalModelFile
+        self._registerModel(modelFile)
+        self._releaseTrainData()
+
+    # --------------------------- INFO functions -----------------------------------
+    def _summary(self):
+        summary = []
+        if exists(self._getResultsFile()):
+            summary.append('Configurations sorted by validation loss (the first one is the output model):')
+            for result in self._readResults():
+                summary.append('%s: depth %s, %s initial channels, learning rate %s, batch size %s --> best '
+                               'val. loss *%.4g* (epoch %s/%s)'
+                               % (tuple(result[field] for field in ['config'] + SWEPT_PARAMS) +
+                                  (float(result['best_val_loss']), result['best_epoch'], result['epochs'])))
+        else:
+            summary.append('%i configurations to be trained.' % len(self._getSweepConfigs()))
+        retentionMsg = self._getRetentionMsg()
+        if retentionMsg:
+            summary.append(retentionMsg)
+        return summary
+
+    def _validateParams(self):
+        validateMsgs = super()._validateParams()
+        try:
+            configs = self._getSweepConfigs()
+        except ValueError:
+            return validateMsgs + ['The values of the hyperparameters to sweep must be space separated numbers.']
+        for config in configs:
+            netDepth, patchSize = config['unet_n_depth'], self._getPatchSize()
+            if netDepth < 1 or config['unet_n_first'] < 1 or config['batch_size'] < 1:
+                validateMsgs.append('The U-Net depths, initial feature channels and batch sizes must be positive.')
+                break
+            if patchSize % 2 ** netDepth != 0:
+                validateMsgs.append('Patch shape has to be divisible by 2^depth = %i to train a U-Net of depth %i.'
+                                    % (2 ** netDepth, netDepth))
+            if self.gpuMemory.get():
+                memory = estimateTrainingMemory(patchSize, netDepth, config['unet_n_first'],
+                                                self.unet_kern_size.get(),
+                                                self._getBatchSizePerGpu(config['batch_size']))
+                if memory['total'] > self.gpuMemory.get() * GB:
+                    validateMsgs.append('The configuration %s does not fit in the GPU memory declared (%.1f GB): '
+                                        '%.2f GB estimated.' % (config, self.gpuMemory.get(), memory['total'] / GB))
+        return validateMsgs
+
+    # --------------------------- UTIL functions -----------------------------------
+    def _getSweepConfigs(self):
+        """Combinations of the hyperparameters to train, as dictionaries of cryoCARE training config values."""
+        valueLists = [self._parseValues(self.sweepDepths.get(), int, self._getUNetDepth()),
+                      self._parseValues(self.sweepNFirst.get(), int, self.unet_n_first.get()),
+                      self._parseValues(self.sweepLearningRates.get(), float, self.learning_rate.get()),
+                      self._parseValues(self.sweepBatchSizes.get(), int, self._getBatchSize())]
+        configs = [dict(zip(SWEPT_PARAMS, values)) for values in itertools.product(*valueLists)]
+        if self.sweepMode.get() == RANDOM:
+            # Seeded, so the same configurations are generated when the protocol is continued
+            configs = random.Random(self.randomSeed.get()).sample(configs, min(self.nConfigs.get(), len(configs)))
+        return configs
+
+    @staticmethod
+    def _parseValues(values, valueType, default):
+        return [valueType(value) for value in values.split()] if values and values.strip() else [default]
+
+    def _getNumberOfGpus(self):
+        # Each configuration is trained on a single GPU
+        return 1
+
+    def _getIntermediatePaths(self):
+        return super()._getIntermediatePaths() + [self._getExtraPath(SWEEP_DIR)]
+
+    def _getConfigDir(self, configInd):
+        return self._getExtraPath(SWEEP_DIR, CONFIG_NAME % configInd)
+
+    def _getResultsFile(self):
+        return self._getExtraPath(RESULTS_FN)
+
+    def _readResults(self):
+        with open(self._getResultsFile(), newline='') as f:
+            return list(csv.DictReader(f))
+
+    def _getExpectedBytes(self):
+        # A model per configuration
+        configs = self._getSweepConfigs()
+        maxParams = max(getUNetParams(config['unet_n_depth'], config['unet_n_first'], self.unet_kern_size.get())
+                        for config in configs)
+        return super()._getExpectedBytes() + len(configs) * MODEL_WEIGHTS_COPIES * FLOAT_BYTES * maxParams
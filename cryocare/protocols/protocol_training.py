@@ -1,44 +1,65 @@
 import glob
 import json
 import operator
+import sys
+import threading
+from datetime import timedelta
 from enum import Enum
-from os.path import join
-import numpy as np
-
+from functools import partial
+from os.path import join, exists
+
+from cryocare.jobs import CryocareJob
+from cryocare.lifecycle import KEEP_ALL, KEEP_FINAL
+from cryocare.memory import estimateTrainingMemory, getLargestBatchSize, getDeepestUNet, getUNetParams, GB, \
+    FLOAT_BYTES
+from cryocare.monitor import TrainingMonitor, EarlyStopping, writeStatus, readStatus
 from cryocare.protocols.protocol_base import ProtCryoCAREBase
-from cryocare.utils import checkInputTomoSetsSize, getModelName
+from cryocare.protocols.protocol_extract_train_data import TrainDataExtractionMixin
+from cryocare.shards import SHARDS_EXT
+from cryocare.traindata import getTrainDataNorm, getTrainDataParts, writeManifest, materializeTrainData, \
+    removeMaterializedData, needsMaterialization, loadTrainDataFile
+from cryocare.utils import getModelName, genModelInfo, writeModelInfo
 from pyworkflow import BETA
-from pyworkflow.protocol import params, IntParam, FloatParam, Positive, LT, GT, GE, LEVEL_ADVANCED, EnumParam
-from pyworkflow.utils import makePath, moveFile
+from pyworkflow.object import String
+from pyworkflow.protocol import params, IntParam, FloatParam, Positive, GT, GE, LEVEL_ADVANCED
+from pyworkflow.utils import moveFile, prettyDelta
 
 from cryocare import Plugin
-from cryocare.constants import TRAIN_DATA_DIR, TRAIN_DATA_FN, TRAIN_DATA_CONFIG, VALIDATION_DATA_FN, CRYOCARE_MODEL
+from cryocare.constants import TRAIN_DATA_DIR, CRYOCARE_MODEL, CRYOCARE_MODEL_TGZ, MODEL_NORM_FN, \
+    MODEL_WEIGHTS_BEST_FN, STATUS_FN, TRAIN_LOG_FN
 from cryocare.objects import CryocareModel
 
-# Tilt axis values
-X_AXIS = 0
-Y_AXIS = 1
-Z_AXIS = 2
-X_AXIS_LABEL = 'X'
-Y_AXIS_LABEL = 'Y'
-Z_AXIS_LABEL = 'Z'
+DEFAULT_BATCH_SIZE = 16
+# Minimum batch size considered when both the batch size and the U-Net depth are chosen automatically
+MIN_AUTO_BATCH_SIZE = 4
+# Copies of the weights written: weights_best.h5 and weights_last.h5, and both again in the model archive
+MODEL_WEIGHTS_COPIES = 4
+# Seconds between the checks of the wall-time budget while waiting for the training log
+MONITOR_INTERVAL = 1
+# Training states reported in the status file
+STATE_RUNNING = 'running'
+STATE_STOPPED = 'stopped'
+STATE_FINISHED = 'finished'
+STATE_FAILED = 'failed'
 
 
 class Outputobjects(Enum):
     model = CryocareModel
 
 
-class ProtCryoCARETraining(ProtCryoCAREBase):
-    """Operate the data to make it be expressed as expected by cryoCARE net."""
+class ProtCryoCARETraining(TrainDataExtractionMixin, ProtCryoCAREBase):
+    """Operate the data to make it be expressed as expected by cryoCARE net. The training data is extracted from
+    the even/odd tomograms introduced, or the one extracted previously is used."""
 
     _label = 'CryoCARE Training'
     _devStatus = BETA
     _possibleOutputs = Outputobjects
+    _tomosCondition = 'not useTrainData'
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self._configFile = None
         self._configPath = None
+        self.trainingEnd = String()  # Why and when the training stopped, if stopped early
 
     # -------------------------- DEFINE param functions ----------------------
 
@@ -48,52 +69,14 @@ class ProtCryoCARETraining(ProtCryoCAREBase):
             form: this is the form to be populated with sections and params.
         """
         super()._defineParams(form)
+        self._defineExtractionParams(form)
+        self._defineRetentionParams(form)
         # form.addParam('gpus', params.StringParam,
         #               default='0',
         #               label="Choose GPU IDs",
         #               help="GPU IDs. The training supports parallelization over multiple GPUs "
         #                    "since cryoCARE version 0.3.0")
 
-        form.addSection(label='Config Parameters')
-        form.addParam('tilt_axis', EnumParam,
-                      label='Tilt axis of the tomograms',
-                      expertLevel=params.LEVEL_ADVANCED,
-                      choices=[X_AXIS_LABEL, Y_AXIS_LABEL, Z_AXIS_LABEL],
-                      default=Y_AXIS,
-                      allowsNull=False,
-                      display=EnumParam.DISPLAY_HLIST,
-                      help='Tomograms are split along this axis to extract train and validation data separately.')
-
-        form.addParam('patch_shape', IntParam,
-                      label='Side length of the training volumes',
-                      default=72,
-                      help='Corresponding sub-volumes pairs of the provided 3D shape '
-                           'are extracted from the even and odd tomograms. The higher it is,'
-                           'the higher net depth is required for training and the longer it '
-                           'takes. Its value also depends on the resolution of the input tomograms, '
-                           'being a higher patch size required for higher resolution.')
-
-        form.addParam('num_slices', IntParam,
-                      label='Number of training pairs to extract per tomogram',
-                      default=1200,
-                      validators=[Positive],
-                      help='Number of sub-volumes to sample from each pair of even and odd tomograms.')
-
-        form.addParam('n_normalization_samples', IntParam,
-                      label='No. of subvolumes used for normalization per tomogram',
-                      default=120,
-                      expertLevel=LEVEL_ADVANCED,
-                      validators=[Positive],
-                      help='Number of training pairs which will be used to compute mean and standard deviation '
-                           'for normalization. By default this is 10% of the number of training pairs.')
-
-        form.addParam('split', FloatParam,
-                      label='Train-Validation Split',
-                      default=0.9,
-                      validators=[GT(0), LT(1)],
-                      expertLevel=LEVEL_ADVANCED,
-                      help='Training and validation data split value.')
-
         form.addSection(label='Training Parameters')
         form.addParam('epochs', IntParam,
                       default=100,
@@ -110,13 +93,24 @@ class ProtCryoCARETraining(ProtCryoCAREBase):
                       validators=[Positive],
                       help='Number of gradient steps performed per epoch.')
         form.addParam('batch_size', IntParam,
-                      default=16,
+                      default=DEFAULT_BATCH_SIZE,
                       label='Batch size',
-                      validators=[Positive],
+                      validators=[GE(0)],
                       help='Size of the training batch. '
                            'An entire big dataset cannot be passed into the neural net at once, '
                            'so it is divided into batches. The batch size is the total number of '
-                           'training examples present in a single batch.')
+                           'training examples present in a single batch. If 0, the largest batch that fits in the '
+                           'GPU memory declared is used (%i if no GPU memory is declared).' % DEFAULT_BATCH_SIZE)
+        form.addParam('gpuMemory', FloatParam,
+                      default=0,
+                      label='GPU memory per device (GB)',
+                      validators=[GE(0)],
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Memory available in each of the GPUs used. If declared, the memory required by the '
+                           'training is estimated from the patch size, batch size and U-Net parameters, and '
+                           'the configurations that do not fit are rejected before launching it. The batch size '
+                           'and U-Net depth left to be chosen automatically (value 0) are then the largest batch and '
+                           'the deepest net that fit.')
         form.addParam('learning_rate', FloatParam,
                       default=0.0004,
                       label='Learning rate',
@@ -128,6 +122,26 @@ class ProtCryoCARETraining(ProtCryoCAREBase):
                            'at each iteration while moving toward a minimum of a loss function. '
                            'Large learning rates result in unstable training and tiny rates '
                            'result in a failure to train.')
+        form.addParam('patience', IntParam,
+                      default=0,
+                      label='Early stopping patience (epochs)',
+                      validators=[GE(0)],
+                      help='If greater than 0, the training is stopped when the validation loss has not improved '
+                           'in this number of epochs. The best weights are kept.')
+        form.addParam('minDelta', FloatParam,
+                      default=0,
+                      label='Early stopping min. improvement',
+                      condition='patience > 0',
+                      validators=[GE(0)],
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Minimum decrease of the validation loss considered an improvement.')
+        form.addParam('maxTrainingTime', FloatParam,
+                      default=0,
+                      label='Max. training time (hours)',
+                      validators=[GE(0)],
+                      expertLevel=LEVEL_ADVANCED,
+                      help='If greater than 0, the training is stopped once it has run for this time. The best '
+                           'weights of the epochs completed are kept.')
         form.addSection(label='U-Net Parameters')
         form.addParam('unet_kern_size', IntParam,
                       default=3,
@@ -141,7 +155,8 @@ class ProtCryoCARETraining(ProtCryoCAREBase):
                       default=0,
                       label='U-Net depth',
                       validators=[GE(0)],
-                      help='Depth of the U-Net.')
+                      help='Depth of the U-Net. If 0, it is chosen according to the patch size, or the deepest net '
+                           'that fits in the GPU memory declared.')
         form.addParam('unet_n_first', IntParam,
                       default=16,
                       label='Number of initial feature channels',
@@ -155,197 +170,410 @@ class ProtCryoCARETraining(ProtCryoCAREBase):
                        help="GPU IDs. The training supports parallelization over multiple GPUs "
                             "since cryoCARE version 0.3.0.")
 
+    def _defineAlternativeInputParams(self, form):
+        form.addParam('useTrainData', params.BooleanParam,
+                      default=False,
+                      label='Use training data already extracted?',
+                      help='If Yes, the training data generated by the training data extraction protocol (or by '
+                           'other trainings) is used, instead of extracting it from the even/odd tomograms. If '
+                           'several are introduced, they are combined: cryoCARE reads the patches from a single file, '
+                           'so they are written together in full when the training starts, and removed once it ends.')
+        form.addParam('inTrainData', params.MultiPointerParam,
+                      pointerClass='CryocareTrainData',
+                      condition='useTrainData',
+                      allowsNull=True,
+                      important=True,
+                      label='Training data')
+
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
         self._initialize()
-        self._insertFunctionStep(self.prepareTrainingDataStep, needsGPU=False)
-        self._insertFunctionStep(self.runDataExtraction, needsGPU=False)
-        self._insertFunctionStep(self.prepareTrainingStep, needsGPU=False)
-        self._insertFunctionStep(self.trainingStep, needsGPU=True)
-        self._insertFunctionStep(self.createOutputStep, needsGPU=False)
+        trainDataId = self._insertTrainDataSteps()
+        prepId = self._insertFunctionStep(self.prepareTrainingStep, prerequisites=trainDataId, needsGPU=False)
+        trainId = self._insertFunctionStep(self.trainingStep, prerequisites=prepId, needsGPU=True)
+        outputId = self._insertFunctionStep(self.createOutputStep, prerequisites=trainId, needsGPU=False)
+        self._insertCleanupStep(outputId)
+
+    def _insertTrainDataSteps(self):
+        """Steps to get the training data: extract it, or combine the ones introduced if there are several.
+        Returns the id of the last one."""
+        if self._needsTomos():
+            prepId = self._insertFunctionStep(self.prepareTrainingDataStep, needsGPU=False)
+            return self._insertFunctionStep(self.runDataExtraction, prerequisites=prepId, needsGPU=False)
+        return self._insertFunctionStep(self.combineTrainDataStep, needsGPU=False)
 
     def _initialize(self):
-        makePath(self._getTrainDataConfDir())
-        self._configFile = join(self._getTrainDataConfDir(), TRAIN_DATA_CONFIG)
+        super()._initialize()
         self._configPath = self._getExtraPath('train_config.json')
 
-    def prepareTrainingDataStep(self):
-        if self.areEvenOddLinked.get():
-            fnOdd, fnEven = self.getOddEvenLists()
-        else:
-            self._getListOfTomoNames(self.evenTomos.get())
-            fnOdd = self._getListOfTomoNames(self.oddTomos.get())
-            fnEven = self._getListOfTomoNames(self.evenTomos.get())
-
-        config = {
-            'even': fnEven,
-            'odd': fnOdd,
-            'patch_shape': 3 * [self.patch_shape.get()],
-            'num_slices': self.num_slices.get(),
-            'split': self.split.get(),
-            'tilt_axis': self._decodeTiltAxisValue(self.tilt_axis.get()),
-            'n_normalization_samples': self.n_normalization_samples.get(),
-            'path': self._getExtraPath('train_data')
-        }
-        with open(self._configFile, 'w+') as f:
-            json.dump(config, f, indent=2)
+    def combineTrainDataStep(self):
+        trainDataDirs = self._getInTrainDataDirs()
+        if self._getTrainDataDir() not in trainDataDirs:
+            manifest = writeManifest(trainDataDirs, self._getTrainDataDir())
+            self.info('%i training datasets combined (%i training pairs).'
+                      % (len(manifest['parts']), sum(part['train'] for part in manifest['parts'])))
+            self._materializeTrainData()
 
     def runDataExtraction(self):
-        Plugin.runCryocare(self, 'cryoCARE_extract_train_data.py', '--conf %s' % self._configFile)
+        super().runDataExtraction()
+        self._materializeTrainData()
+
+    def _materializeTrainData(self):
+        # The combinations and the coordinate-based datasets are virtual, but cryoCARE reads the patches from a
+        # single file (removed once trained)
+        if needsMaterialization(self._getTrainDataDir()):
+            materializeTrainData(self._getTrainDataDir(), self._getTrainDataDir())
 
     def prepareTrainingStep(self):
         # We do this to accept both GPU specified as '0' 1 2 3' or '0,1,2,3':
         gpuId = getattr(self, params.GPU_LIST).getListFromValues()
         gpuId = gpuId[0] if len(gpuId) == 1 else gpuId
-        config = {
+        with open(self._configPath, 'w+') as f:
+            json.dump(self._getTrainingConfig(self._getExtraPath(), gpuId), f, indent=2)
+
+    def _getTrainingConfig(self, path, gpuId):
+        return {
             'train_data': self._getTrainDataDir(),
             'epochs': self.epochs.get(),
             'steps_per_epoch': self.steps_per_epoch.get(),
-            'batch_size': self.batch_size.get(),
+            'batch_size': self._getBatchSize(),
             'unet_kern_size': self.unet_kern_size.get(),
             'unet_n_depth': self._getUNetDepth(),
             'unet_n_first': self.unet_n_first.get(),
             'learning_rate': self.learning_rate.get(),
             'model_name': CRYOCARE_MODEL,
-            'path': self._getExtraPath(),
+            'path': path,
             'gpu_id': gpuId
         }
-        with open(self._configPath, 'w+') as f:
-            json.dump(config, f, indent=2)
 
     def trainingStep(self):
-        Plugin.runCryocare(self, 'cryoCARE_train.py', '--conf {}'.format(self._configPath))
+        stopMsg = self._train(self._configPath, self._getExtraPath(), self._getStatusFile())
+        if stopMsg:
+            self.trainingEnd.set(stopMsg)
+            self._store(self.trainingEnd)
+
+    def _train(self, configPath, modelPath, statusFile, logPrefix=''):
+        """Run a cryoCARE training, which generates the model in modelPath. Its log is followed while it runs to
+        report its progress in the status file and to stop it when the early stopping criteria are met. If it is
+        stopped, a message saying why and when is returned."""
+        earlyStopping = self._getEarlyStopping()
+        monitor = TrainingMonitor()
+        with open(configPath) as f:
+            config = json.load(f)
+        samplesPerEpoch = config['steps_per_epoch'] * config['batch_size']
+        updateStatus = partial(self._writeTrainingStatus, statusFile, monitor, samplesPerEpoch)
+        updateStatus(STATE_RUNNING)
+        # Run by this step (whose GPUs are assigned by the executor) and followed by another thread
+        job = CryocareJob(join(modelPath, TRAIN_LOG_FN))
+        stopReasons = []
+        follower = threading.Thread(target=lambda: stopReasons.append(
+            self._followTraining(job, monitor, earlyStopping, updateStatus, logPrefix)), daemon=True)
+        follower.start()
+        exitCode = Plugin.runCryocareJob(self, job, 'cryoCARE_train.py', '--conf {}'.format(configPath))
+        follower.join()
+        stopReason = stopReasons[0] if stopReasons else None
+
+        if stopReason:
+            self._exportStoppedModel(monitor, modelPath)
+            stopMsg = ('Training stopped after %i of %i epochs (%.1f min) because %s. The weights of epoch %i were '
+                       'kept.' % (monitor.getEpochsDone(), monitor.nEpochs or 0, monitor.getElapsedTime() / 60,
+                                  stopReason, monitor.getBestEpoch() or 0))
+            self.info(logPrefix + stopMsg)
+            updateStatus(STATE_STOPPED, reason=stopReason)
+            return stopMsg
+        elif exitCode != 0:
+            updateStatus(STATE_FAILED)
+            raise Exception('cryoCARE training failed with exit code %i. See the log for details.' % exitCode)
+        updateStatus(STATE_FINISHED)
+        return None
+
+    def _followTraining(self, job, monitor, earlyStopping, updateStatus, logPrefix=''):
+        """Follow the log of the training job, copying it to the protocol log, until it ends or the early stopping
+        criteria are met. In that case the job is stopped and the reason returned."""
+        stopReason, stopEpoch = None, None
+        stopping = False
+        for line in job.readLines(MONITOR_INTERVAL):
+            if line:
+                sys.stdout.write(logPrefix + line)  # Kept in the protocol log
+            epochDone = monitor.parseLine(line)
+            if epochDone:
+                updateStatus(STATE_RUNNING)
+            if earlyStopping is None:
+                continue
+            if stopReason:
+                # The best weights are saved once the epoch is reported, so the stop waits for the next one
+                if monitor.epoch > stopEpoch:
+                    stopping = True
+                    break
+            elif epochDone:
+                stopReason, stopEpoch = earlyStopping.checkLoss(monitor), monitor.epoch
+            timeReason = earlyStopping.checkTime(monitor)
+            if timeReason:
+                # The weights of the epoch in progress are not saved yet, so it is stopped right away
+                stopReason, stopping = timeReason, True
+                break
+        sys.stdout.flush()
+
+        if not stopping:
+            return None  # The training finished
+        if not job.stop():
+            if not job.isDone():
+                self.info(logPrefix + 'The training is not running in this machine (it was submitted to a queue), '
+                                      'so it can not be stopped because %s.' % stopReason)
+            return None
+        return stopReason
 
     def createOutputStep(self):
-        model = CryocareModel(model_file=getModelName(self),
-                              train_data_dir=self._getTrainDataDir())
+        self._registerModel(getModelName(self))
+        self._releaseTrainData()
+
+    def _releaseTrainData(self):
+        """Once trained, the patches written for cryoCARE are removed, and the ones extracted by the protocol are
+        compressed, if requested and kept."""
+        if self._needsTomos() and self._compressesTrainData() and self.retention.get() != KEEP_FINAL:
+            self._compressTrainData()
+        removeMaterializedData(self._getTrainDataDir())
+
+    def _registerModel(self, modelFile):
+        modelInfo = genModelInfo(modelFile, patchSize=self._getPatchSize())
+        modelInfo['binning'] = self._getBinning()
+        writeModelInfo(modelInfo, modelFile)
+        # The model carries its normalization, so its training data is not referenced if it is not to be kept
+        keepTrainData = self.retention.get() == KEEP_ALL or not self._ownsTrainData()
+        model = CryocareModel(model_file=modelFile,
+                              train_data_dir=self._getTrainDataDir() if keepTrainData else None)
+        model.setModelInfo(modelInfo)
         self._defineOutputs(**{Outputobjects.model.name: model})
 
-        if self.areEvenOddLinked.get():
+        if not self._needsTomos():
+            for pointer in self.inTrainData:
+                self._defineSourceRelation(pointer, model)
+        elif self.areEvenOddLinked.get():
             self._defineSourceRelation(self.tomos, model)
         else:
             self._defineSourceRelation(self.oddTomos, model)
             self._defineSourceRelation(self.evenTomos, model)
-
     # --------------------------- INFO functions -----------------------------------
     def _summary(self):
         summary = []
-
-        if self.isFinished():
-            summary.append("Generated training data info:\n"
-                           "train_data_file = *{}*\n"
-                           "validation_data_file = *{}*\n"
-                           "patch_size = *{}*".format(
-                self._getTrainDataFile(),
-                self._getValidationDataFile(),
-                self.patch_shape.get()))
+        if self.trainingEnd.get():
+            summary.append(self.trainingEnd.get())
+        status = readStatus(self._getStatusFile())
+        if status:
+            summary.append(self._getProgressMsg(status))
+
+        if not self._needsTomos():
+            trainDataDirs = self._getInTrainDataDirs()
+            summary.append('Training data: *%s*%s\n'
+                           'patch_size = *%s*\n'
+                           'binning = *%s*' % (self._getTrainDataDir(),
+                                               ' (combination of %i datasets)' % len(trainDataDirs)
+                                               if len(trainDataDirs) > 1 else '',
+                                               self._getPatchSize(), self._getBinning()))
+        elif self.isFinished():
+            summary.append(self._getTrainDataSummary())
+        if not self._needsTomos() or self.isFinished():
+            retentionMsg = self._getRetentionMsg()
+            if retentionMsg:
+                summary.append(retentionMsg)
+        if not self.isFinished():
+            summary.append(self._getDiskCostMsg())
+        summary.append(self._getMemoryEstimateMsg())
         return summary
 
-    def _validate(self):
-        sideLength = self.patch_shape.get()
-        validateMsgs = super()._validate()
-        if self.areEvenOddLinked.get():
-            inputTomo = self.tomos.get()
-            if self.tomos.get():
-                try:
-                    fnOdd, fnEven = self.getOddEvenLists()
-                except Exception as e:
-                    validateMsgs.append('Even/Odd tomograms seem no to be linked to the introduced tomograms '
-                                        'at metadata level.')
-
-                xt, yt, zt = inputTomo.getDimensions()
-                for idim in [xt, yt, zt]:
-                    if idim <= 2 * sideLength:
-                        validateMsgs.append('X, Y and Z dimensions of the tomograms introduced must satisfy the '
-                                            'condition\n\n*dimension > 2 x SideLength*\n\n'
-                                            '(X, Y, Z) = (%i, %i, %i)\n'
-                                            'SideLength = %i\n\n' % (xt, yt, zt, sideLength))
-                        break
-        else:
-            evenTomos = self.evenTomos.get()
-            oddTomos = self.oddTomos.get()
-            xe, ye, ze = evenTomos.getDimensions()
-            xo, yo, zo = oddTomos.getDimensions()
-            for idim in [xe, ye, ze, xo, yo, zo]:
-                if idim <= 2 * sideLength:
-                    validateMsgs.append('X, Y and Z dimensions of the tomograms introduced must satisfy the '
-                                        'condition\n\n*dimension > 2 x SideLength*\n\n'
-                                        '(X, Y, Z) = (%i, %i, %i)\n'
-                                        'SideLength = %i\n\n' % (xe, ye, ze, sideLength))
-                    msg = checkInputTomoSetsSize(evenTomos, oddTomos)
-                    if msg:
-                        validateMsgs.append(msg)
-                    break
+    def _validateParams(self):
+        validateMsgs = super()._validateParams()
+        if not self._needsTomos():
+            trainData = [pointer.get() for pointer in self.inTrainData]
+            if not trainData or None in trainData:
+                return ['The training data to be used must be introduced.']
+            if len({data.getPatchSize() for data in trainData}) > 1:
+                validateMsgs.append('The training data combined must have the same patch size.')
+            if len({data.getBinning() for data in trainData}) > 1:
+                validateMsgs.append('The training data combined must have been extracted with the same binning.')
 
         # Check the patch conditions
-        if sideLength % 2 != 0:
-            validateMsgs.append('Patch shape has to be an even number.')
-
+        sideLength = self._getPatchSize()
+        netDepth = self._getUNetDepth()
+        if sideLength % 2 ** netDepth != 0:
+            validateMsgs.append('Patch shape has to be divisible by 2^depth = %i to train a U-Net of depth %i.'
+                                % (2 ** netDepth, netDepth))
+
+        # Check the GPU memory
+        if self.gpuMemory.get():
+            memory = self._getMemoryEstimate()
+            if self._getBatchSize() == 0 or memory['total'] > self.gpuMemory.get() * GB:
+                validateMsgs.append('The training does not fit in the GPU memory declared (%.1f GB). %s\n'
+                                    'Please, reduce the batch size, patch size or U-Net depth, or use more GPUs.'
+                                    % (self.gpuMemory.get(), self._getMemoryEstimateMsg()))
         return validateMsgs
 
     # --------------------------- UTIL functions -----------------------------------
     @staticmethod
     def _combineTrainDataFiles(pattern, outputFile):
+        import numpy as np
         files = glob.glob(pattern)
-        if len(files) == 1:
+        if len(files) == 1 and not files[0].endswith(SHARDS_EXT):
             moveFile(files[0], outputFile)
         else:
-            # Create a dictionary with the data fields contained in each npz file
+            # Create a dictionary with the data fields contained in each file (npz or shards)
             dataDict = {}
-            with np.load(files[0]) as data:
-                for field in data.files:
-                    dataDict[field] = []
+            for field in loadTrainDataFile(files[0]):
+                dataDict[field] = []
 
             # Read and combine the data from all files
             for i, name in enumerate(files):
-                with np.load(name) as data:
-                    for field in data.files:
-                        dataDict[field].append(data[field])
+                for field, value in loadTrainDataFile(name).items():
+                    dataDict[field].append(value)
 
             # Save the combined data into a npz file
             np.savez(outputFile, **dataDict)
 
-    def _getTrainDataDir(self):
-        return self._getExtraPath(TRAIN_DATA_DIR)
-
-    def _getTrainDataFile(self):
-        return join(self._getTrainDataDir(), TRAIN_DATA_FN)
-
-    def _getValidationDataFile(self):
-        return join(self._getTrainDataDir(), VALIDATION_DATA_FN)
-
-    def _getTrainDataConfDir(self):
-        return self._getExtraPath(TRAIN_DATA_CONFIG)
+    def _getStatusFile(self):
+        return self._getExtraPath(STATUS_FN)
 
     @staticmethod
-    def _decodeTiltAxisValue(value):
-        if value == X_AXIS:
-            return X_AXIS_LABEL
-        elif value == Y_AXIS:
-            return Y_AXIS_LABEL
-        else:
-            return Z_AXIS_LABEL
+    def _writeTrainingStatus(statusFile, monitor, samplesPerEpoch, state, **kwargs):
+        writeStatus(statusFile, dict(monitor.getStatus(samplesPerEpoch), state=state, **kwargs))
 
     @staticmethod
-    def _getListOfTomoNames(tomoSet):
-        return [tomo.getFileName() for tomo in tomoSet]
-
-    def getOddEvenLists(self):
-        oddList = []
-        evenList = []
-        for t in self.tomos.get():
-            odd, even = t.getHalfMaps().split(',')
-            oddList.append(odd)
-            evenList.append(even)
-        return oddList, evenList
+    def _getProgressMsg(status):
+        msg = 'Training %s: epoch %i/%s' % (status['state'], status['epoch'], status.get('epochs') or '?')
+        if 'val_loss' in status:
+            msg += ', loss %.4g, val. loss %.4g (best %.4g)' % (status['loss'], status['val_loss'],
+                                                               status['best_val_loss'])
+        if 'samples_per_second' in status:
+            msg += ', %.1f epochs/min, %.0f samples/s' % (status['epochs_per_minute'], status['samples_per_second'])
+        if status['state'] == STATE_RUNNING and 'eta_seconds' in status:
+            msg += ', ETA %s' % prettyDelta(timedelta(seconds=status['eta_seconds']))
+        return msg + '.'
+
+    def _getEarlyStopping(self):
+        if not self.patience.get() and not self.maxTrainingTime.get():
+            return None
+        return EarlyStopping(patience=self.patience.get(), minDelta=self.minDelta.get(),
+                             maxTime=self.maxTrainingTime.get() * 3600)
+
+    def _exportStoppedModel(self, monitor, modelPath):
+        """Generate the model archive, as cryoCARE does at the end of the training, from the best weights saved
+        by the training stopped."""
+        import pickle
+        import tarfile
+        modelDir = join(modelPath, CRYOCARE_MODEL)
+        if not exists(join(modelDir, MODEL_WEIGHTS_BEST_FN)):
+            raise Exception('The training was stopped before completing any epoch, so there are no weights to keep.')
+        mean, std = getTrainDataNorm(self._getTrainDataDir())
+        norm = {'mean': mean, 'std': std}
+        with open(join(modelDir, MODEL_NORM_FN), 'w') as f:
+            json.dump(norm, f)
+        with open(join(modelDir, 'history.dat'), 'wb') as f:
+            pickle.dump(monitor.history, f)
+        with tarfile.open(join(modelPath, CRYOCARE_MODEL_TGZ), 'w:gz') as tar:
+            tar.add(modelDir, arcname=CRYOCARE_MODEL)
+
+    def _getTrainDataDir(self):
+        trainDataDirs = self._getInTrainDataDirs()
+        # A single training data introduced is used in place, unless its patches are not stored in the files read
+        # by cryoCARE (combinations of several and coordinate-based datasets)
+        if len(trainDataDirs) == 1 and not needsMaterialization(trainDataDirs[0]):
+            return trainDataDirs[0]
+        return self._getExtraPath(TRAIN_DATA_DIR)
+
+    def _ownsTrainData(self):
+        """True if the training data is extracted or combined by the protocol, instead of using the one introduced
+        in place."""
+        return self._getTrainDataDir() == self._getExtraPath(TRAIN_DATA_DIR)
+
+    def _getIntermediatePaths(self):
+        paths = super()._getIntermediatePaths() + [self._configPath, self._getExtraPath(CRYOCARE_MODEL),
+                                                   self._getExtraPath(TRAIN_LOG_FN)]
+        if self._ownsTrainData():
+            paths.append(self._getTrainDataDir())
+        return paths
+
+    def _getInTrainDataDirs(self):
+        """Directories of the training data introduced, if the training data is not extracted."""
+        if self._needsTomos():
+            return []
+        return [pointer.get().getTrainDataDir() for pointer in self.inTrainData]
+
+    def _needsTomos(self):
+        return not self.useTrainData.get()
+
+    def _getPatchSize(self):
+        if self._needsTomos():
+            return self.patch_shape.get()
+        return self.inTrainData[0].get().getPatchSize()
+
+    def _getBinning(self):
+        """Binning of the tomograms the training data was extracted from."""
+        if self._needsTomos():
+            return self.binning.get()
+        return self.inTrainData[0].get().getBinning() or 1
+
+    def _getNumberOfGpus(self):
+        return len(getattr(self, params.GPU_LIST).getListFromValues())
 
     def _getUNetDepth(self):
-        # Estimate the best net depth value according to the patch size if the user left this field empty
+        # Estimate the best net depth value if the user left this field empty
         if self.unet_n_depth.get() == 0:
+            patchSize = self._getPatchSize()
+            if self.gpuMemory.get():
+                # The deepest net that fits in the memory with the batch size requested (or a minimum one)
+                batchSize = self.batch_size.get() or MIN_AUTO_BATCH_SIZE
+                netDepth = getDeepestUNet(patchSize, self.unet_n_first.get(), self.unet_kern_size.get(),
+                                          self._getBatchSizePerGpu(batchSize), self.gpuMemory.get() * GB)
+                if netDepth:
+                    return netDepth
+            # According to the patch size, among the depths valid for it
             refValues = [72, 96, 128]  # Corresponds to a net depth of 2, 3 and 4, respectively
             netDepth = [2, 3, 4]
-            diff = [abs(i - self.patch_shape.get()) for i in refValues]
-            ind, _ = min(enumerate(diff), key=operator.itemgetter(0))
+            diff = [abs(i - patchSize) if patchSize % 2 ** depth == 0 else float('inf')
+                    for i, depth in zip(refValues, netDepth)]
+            ind, _ = min(enumerate(diff), key=operator.itemgetter(1))
             return netDepth[ind]
         else:
             return self.unet_n_depth.get()
+
+    def _getBatchSize(self):
+        """Batch size requested or, if left empty, the largest one that fits in the GPU memory declared. It is
+        the global batch, split among the GPUs used. 0 is returned if not even a sample fits."""
+        if self.batch_size.get():
+            return self.batch_size.get()
+        elif self.gpuMemory.get():
+            batchSizePerGpu = getLargestBatchSize(self._getPatchSize(), self._getUNetDepth(),
+                                                  self.unet_n_first.get(), self.unet_kern_size.get(),
+                                                  self.gpuMemory.get() * GB)
+            return batchSizePerGpu * self._getNumberOfGpus()
+        else:
+            return DEFAULT_BATCH_SIZE
+
+    def _getBatchSizePerGpu(self, batchSize):
+        return -(-batchSize // self._getNumberOfGpus())
+
+    def _getExpectedBytes(self):
+        expectedBytes = MODEL_WEIGHTS_COPIES * FLOAT_BYTES * getUNetParams(self._getUNetDepth(),
+                                                                            self.unet_n_first.get(),
+                                                                            self.unet_kern_size.get())
+        trainDataDirs = self._getInTrainDataDirs()
+        if trainDataDirs and self._getTrainDataDir() not in trainDataDirs:
+            # The combined training data is written for cryoCARE while training
+            nPatches = sum(part['train'] + part['val'] for trainDataDir in trainDataDirs
+                           for part in getTrainDataParts(trainDataDir))
+            expectedBytes += nPatches * self._getPatchSize() ** 3 * 2 * FLOAT_BYTES
+        elif self._needsTomos() and self.storeCoordinates.get():
+            # The patches are written for cryoCARE while training
+            nPairs, _ = self._getInputSize()
+            expectedBytes += nPairs * self.num_slices.get() * self._getPatchSize() ** 3 * 2 * FLOAT_BYTES
+        return super()._getExpectedBytes() + expectedBytes
+
+    def _getMemoryEstimate(self):
+        return estimateTrainingMemory(self._getPatchSize(), self._getUNetDepth(), self.unet_n_first.get(),
+                                      self.unet_kern_size.get(), self._getBatchSizePerGpu(self._getBatchSize()))
+
+    def _getMemoryEstimateMsg(self):
+        memory = self._getMemoryEstimate()
+        return ('Estimated GPU memory per device: *%.2f GB* (parameters and optimizer %.2f GB, activations %.2f GB) '
+                'for a batch size of %i and a U-Net of depth %i.'
+                % (memory['total'] / GB, memory['parameters'] / GB, memory['activations'] / GB,
+                   self._getBatchSize(), self._getUNetDepth()))
@@ -0,0 +1,168 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import glob
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from os.path import abspath, dirname, exists, join
+
+NUMA_NODES_PATTERN = '/sys/devices/system/node/node[0-9]*/cpulist'
+# Thread pools used by the libraries run by cryoCARE: OpenMP, MKL, OpenBLAS and TensorFlow
+THREAD_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS']
+TF_INTEROP_VAR = 'TF_NUM_INTEROP_THREADS'
+MAX_INTEROP_THREADS = 2
+# Write throughput probe
+PROBE_SIZE = 16 * 1024 ** 2
+PROBE_TTL = 600  # Seconds a measure is reused for the same directory
+_throughputCache = {}
+
+
+def parseCpuList(cpuList):
+    """Parse the linux cpulist format, e.g. 0-3,8-11."""
+    cores = []
+    for part in cpuList.strip().split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cores.extend(range(int(first), int(last) + 1))
+        elif part:
+            cores.append(int(part))
+    return cores
+
+
+def getAvailableCores():
+    """Cores the current process is allowed to run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def getNumaNodes():
+    """List of the cores of each NUMA node. An empty list is returned if the topology is not available."""
+    nodes = []
+    for cpuListFile in sorted(glob.glob(NUMA_NODES_PATTERN)):
+        with open(cpuListFile) as f:
+            nodes.append(parseCpuList(f.read()))
+    return [node for node in nodes if node]
+
+
+def partitionCores(cores, nParts, numaNodes=None):
+    """Split the cores into nParts disjoint sets of (almost) the same size. The cores are ordered by NUMA node
+    before splitting, so each set stays within a single node whenever the sizes allow it. If there are less cores
+    than parts, they are shared in a round-robin fashion."""
+    coreSet = set(cores)
+    ordered = [core for node in (numaNodes or []) for core in node if core in coreSet]
+    ordered += sorted(coreSet.difference(ordered))
+    if len(ordered) < nParts:
+        return [[ordered[i % len(ordered)]] for i in range(nParts)]
+    size, extra = divmod(len(ordered), nParts)
+    parts, start = [], 0
+    for i in range(nParts):
+        end = start + size + (1 if i < extra else 0)
+        parts.append(ordered[start:end])
+        start = end
+    return parts
+
+
+def getThreadEnvVars(nThreads):
+    """Environment variables that limit the threads used by a process to the cores it was assigned."""
+    envVars = {var: str(nThreads) for var in THREAD_VARS}
+    envVars[TF_INTEROP_VAR] = str(min(nThreads, MAX_INTEROP_THREADS))
+    return envVars
+
+
+def getAffinityPrefix(cores):
+    """Command prefix that pins a process to the given cores. It is empty if taskset is not available."""
+    if cores and shutil.which('taskset'):
+        return 'taskset -c %s ' % ','.join(str(core) for core in cores)
+    return ''
+
+
+class CoreAllocator:
+    """Give each of the concurrent steps of a protocol a disjoint set of cores, so the processes launched do not
+    oversubscribe the CPU."""
+
+    def __init__(self, nSlots, cores=None):
+        self._free = partitionCores(cores or getAvailableCores(), max(1, nSlots), getNumaNodes())
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            # There should be as many core sets as concurrent steps. If not, the step is not pinned
+            return self._free.pop(0) if self._free else None
+
+    def release(self, cores):
+        if cores is not None:
+            with self._lock:
+                self._free.append(cores)
+
+    @contextmanager
+    def allocate(self):
+        cores = self.acquire()
+        try:
+            yield cores
+        finally:
+            self.release(cores)
+
+
+def getExistingDir(path):
+    """Nearest existing directory containing the path, which may not have been created yet."""
+    path = abspath(path)
+    while not exists(path) and dirname(path) != path:
+        path = dirname(path)
+    return path
+
+
+def getFreeSpace(path):
+    """Free bytes in the file system of the given path."""
+    return shutil.disk_usage(getExistingDir(path)).free
+
+
+def measureWriteThroughput(path, probeSize=PROBE_SIZE):
+    """Write throughput (bytes/s) to the file system of the given path, measured writing and syncing a probe
+    file. The measure is cached for some minutes per directory. None is returned if it cannot be written."""
+    directory = getExistingDir(path)
+    cached = _throughputCache.get(directory)
+    if cached and time.time() - cached[1] < PROBE_TTL:
+        return cached[0]
+    probeFile = join(directory, '.cryocare_probe_%i_%i' % (os.getpid(), threading.get_ident()))
+    block = os.urandom(1024 ** 2)  # Random, so it is not compressed by the file system
+    try:
+        start = time.perf_counter()
+        with open(probeFile, 'wb') as f:
+            for _ in range(max(1, probeSize // len(block))):
+                f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        throughput = max(1, probeSize // len(block)) * len(block) / (time.perf_counter() - start)
+    except OSError:
+        return None
+    finally:
+        if exists(probeFile):
+            os.remove(probeFile)
+    _throughputCache[directory] = (throughput, time.time())
+    return throughput
@@ -0,0 +1,234 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Compressed, reduced-precision storage of the training patches (shards). The patches of each field are split in
+chunks, stored as float32 or float16 and compressed with zlib, zstd or blosc, in a zip archive (not compressed
+itself) with a json header. The chunks are encoded and decoded in parallel, and the round-trip error of the
+patches stored is measured when they are written."""
+import json
+import os
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+SHARDS_VERSION = 1
+SHARDS_EXT = '.shards'
+HEADER_NAME = 'header.json'
+CHUNK_NAME = '%s/%06d'  # Field and chunk index
+# Precisions of the patches stored
+FLOAT32 = 'float32'
+FLOAT16 = 'float16'
+PRECISIONS = (FLOAT32, FLOAT16)
+# Compression of the chunks
+NO_CODEC = 'none'
+ZLIB = 'zlib'
+ZSTD = 'zstd'
+BLOSC = 'blosc'
+CODECS = (NO_CODEC, ZLIB, ZSTD, BLOSC)
+CODEC_MODULES = {ZSTD: 'zstandard', BLOSC: 'blosc'}  # Optional packages required by the codecs
+COMPRESSION_LEVEL = 3
+CHUNK_PATCHES = 64  # Patches per chunk
+CHUNK_BYTES = 256 * 1024 ** 2  # Memory used by each group of chunks read
+CODEC_THREADS = min(8, os.cpu_count() or 1)
+
+
+def isCodecAvailable(codec):
+    """True if the package needed by a codec is installed."""
+    import importlib.util
+    module = CODEC_MODULES.get(codec)
+    return module is None or importlib.util.find_spec(module) is not None
+
+
+def _encode(data, codec):
+    if codec == ZLIB:
+        import zlib
+        return zlib.compress(data.tobytes(), COMPRESSION_LEVEL)
+    if codec == ZSTD:
+        import zstandard
+        return zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compress(data.tobytes())
+    if codec == BLOSC:
+        import blosc
+        return blosc.compress(data.tobytes(), typesize=data.dtype.itemsize, clevel=COMPRESSION_LEVEL)
+    return data.tobytes()
+
+
+def _decode(buffer, codec):
+    if codec == ZLIB:
+        import zlib
+        return zlib.decompress(buffer)
+    if codec == ZSTD:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(buffer)
+    if codec == BLOSC:
+        import blosc
+        return blosc.decompress(buffer)
+    return buffer
+
+
+def writeShards(arrays, fileName, precision=FLOAT32, codec=ZLIB, chunkPatches=CHUNK_PATCHES,
+                nThreads=CODEC_THREADS):
+    """Write the patch arrays (first axis: patches) and scalars (e.g. mean and std) of a dict in a shards file.
+    Returns the round-trip error (max. and root mean square) of the patches of each field."""
+    import numpy as np
+    if precision not in PRECISIONS or codec not in CODECS:
+        raise ValueError('Unknown precision (%s) or codec (%s) for the shards.' % (precision, codec))
+    header = {'version': SHARDS_VERSION, 'precision': precision, 'codec': codec, 'chunk_patches': chunkPatches,
+              'fields': {}, 'scalars': {}, 'errors': {}}
+
+    def encodeChunk(chunk):
+        chunk = np.ascontiguousarray(chunk, dtype=np.float32)
+        stored = chunk.astype(precision)
+        diff = (stored.astype(np.float32) - chunk).astype(np.float64)
+        return _encode(stored, codec), float(np.abs(diff).max(initial=0)), float(np.square(diff).sum())
+
+    tmpFile = '%s.%i.tmp' % (fileName, os.getpid())
+    with zipfile.ZipFile(tmpFile, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf, \
+            ThreadPoolExecutor(max_workers=max(1, nThreads)) as executor:
+        for name, value in arrays.items():
+            if np.ndim(value) == 0:
+                header['scalars'][name] = float(value)
+                continue
+            shape = tuple(int(size) for size in value.shape)
+            patchBytes = max(1, int(np.prod(shape[1:])) * 4)
+            # Groups of chunks encoded in parallel, to bound the memory used
+            groupSize = max(1, min(max(1, nThreads) * 4, CHUNK_BYTES // (patchBytes * chunkPatches)))
+            starts = list(range(0, shape[0], chunkPatches))
+            maxError, sqError = 0., 0.
+            for groupStart in range(0, len(starts), groupSize):
+                groupStarts = starts[groupStart:groupStart + groupSize]
+                chunks = [value[start:start + chunkPatches] for start in groupStarts]
+                for chunkInd, (buffer, chunkMax, chunkSq) in enumerate(executor.map(encodeChunk, chunks),
+                                                                       groupStart):
+                    zf.writestr(CHUNK_NAME % (name, chunkInd), buffer)
+                    maxError, sqError = max(maxError, chunkMax), sqError + chunkSq
+            header['fields'][name] = {'shape': shape, 'chunks': len(starts)}
+            nValues = int(np.prod(shape))
+            header['errors'][name] = {'max': maxError, 'rms': (sqError / nValues) ** 0.5 if nValues else 0.}
+        zf.writestr(HEADER_NAME, json.dumps(header, indent=2))
+    os.replace(tmpFile, fileName)
+    return header['errors']
+
+
+def readShardsHeader(fileName):
+    with zipfile.ZipFile(fileName) as zf:
+        return json.loads(zf.read(HEADER_NAME))
+
+
+class ShardArray:
+    """Read-only float32 array of the patches of a field of a shards file, whose chunks are decoded in parallel
+    when indexed. The last chunk decoded is cached, so the patches can be read one by one."""
+
+    def __init__(self, fileName, field, nThreads=CODEC_THREADS):
+        import numpy as np
+        self._zipFile = zipfile.ZipFile(fileName)  # Its members can be read from several threads
+        header = json.loads(self._zipFile.read(HEADER_NAME))
+        self._field = field
+        self._codec = header['codec']
+        self._storedDtype = np.dtype(header['precision'])
+        self._chunkPatches = header['chunk_patches']
+        self._nThreads = max(1, nThreads)
+        self.shape = tuple(header['fields'][field]['shape'])
+        self.dtype = np.dtype(np.float32)
+        self._lock = threading.Lock()
+        self._cached = (None, None)  # Chunk index and data
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _decodeChunk(self, chunkInd):
+        import numpy as np
+        buffer = _decode(self._zipFile.read(CHUNK_NAME % (self._field, chunkInd)), self._codec)
+        data = np.frombuffer(buffer, dtype=self._storedDtype).reshape((-1,) + self.shape[1:])
+        return data.astype(np.float32)
+
+    def _getChunks(self, chunkInds):
+        """Decoded chunks, in parallel if there are several."""
+        with self._lock:
+            cachedInd, cachedData = self._cached
+        missing = [chunkInd for chunkInd in chunkInds if chunkInd != cachedInd]
+        if len(missing) > 1:
+            with ThreadPoolExecutor(max_workers=min(self._nThreads, len(missing))) as executor:
+                decoded = dict(zip(missing, executor.map(self._decodeChunk, missing)))
+        else:
+            decoded = {chunkInd: self._decodeChunk(chunkInd) for chunkInd in missing}
+        if cachedInd in chunkInds:
+            decoded[cachedInd] = cachedData
+        if chunkInds:
+            lastInd = chunkInds[-1]
+            with self._lock:
+                self._cached = (lastInd, decoded[lastInd])
+        return decoded
+
+    def __getitem__(self, index):
+        import numpy as np
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self[np.arange(start, stop, step)]
+            if stop <= start:
+                return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+            firstChunk, lastChunk = start // self._chunkPatches, (stop - 1) // self._chunkPatches
+            chunks = self._getChunks(list(range(firstChunk, lastChunk + 1)))
+            data = np.concatenate([chunks[chunkInd] for chunkInd in range(firstChunk, lastChunk + 1)])
+            offset = firstChunk * self._chunkPatches
+            return data[start - offset:stop - offset]
+        if np.ndim(index):
+            indices = np.asarray(index, dtype=int)
+            indices = np.where(indices < 0, indices + len(self), indices)
+            if np.any((indices < 0) | (indices >= len(self))):
+                raise IndexError('Index out of range for %i patches.' % len(self))
+            chunkInds = sorted(set(int(i) for i in indices // self._chunkPatches))
+            chunks = self._getChunks(chunkInds)
+            if not len(indices):
+                return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+            return np.stack([chunks[i // self._chunkPatches][i % self._chunkPatches] for i in indices])
+        index = index + len(self) if index < 0 else index
+        if not 0 <= index < len(self):
+            raise IndexError('Index %i out of range for %i patches.' % (index, len(self)))
+        chunkInd = index // self._chunkPatches
+        return self._getChunks([chunkInd])[chunkInd][index % self._chunkPatches]
+
+    def iterChunks(self, chunkBytes=CHUNK_BYTES):
+        import numpy as np
+        patchBytes = max(1, int(np.prod(self.shape[1:])) * self.dtype.itemsize)
+        # Whole stored chunks, so each one is decoded once
+        step = max(1, chunkBytes // (patchBytes * self._chunkPatches)) * self._chunkPatches
+        for start in range(0, len(self), step):
+            yield self[start:start + step]
+
+    def close(self):
+        self._zipFile.close()
+
+
+def loadShards(fileName):
+    """Contents of a shards file as a dict, as np.load returns the ones of a npz file: the patch arrays (decoded,
+    as float32) and the scalars."""
+    header = readShardsHeader(fileName)
+    data = dict(header['scalars'])
+    for field in header['fields']:
+        array = ShardArray(fileName, field)
+        data[field] = array[:]
+        array.close()
+    return data
@@ -0,0 +1,36 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Stand-in cryoCARE backend. It contains scripts named and configured as the cryoCARE programs that produce
+correctly shaped outputs (npz training data, model .tar.gz and denoised MRC files) without GPUs nor TensorFlow.
+It is selected with the plugin variable CRYOCARE_SIMULATE and tuned with the environment variables described in
+simcommon.py. It is used to test the plugin orchestration at scale."""
+from os.path import dirname, join
+
+SIMULATOR_DIR = dirname(__file__)
+
+
+def getSimulatedProgram(program):
+    return join(SIMULATOR_DIR, program)
@@ -0,0 +1,88 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Stand-in for cryoCARE_extract_train_data.py: random pairs of sub-volumes are sampled from the even/odd
+tomograms and saved as train_data.npz and val_data.npz."""
+import os
+from os.path import join
+
+import mrcfile
+import numpy as np
+
+from simcommon import readConfig, simulateLatency, getEnvNumber, SIM_MAX_PATCHES, asList
+
+TILT_AXES = {'Z': 0, 'Y': 1, 'X': 2}  # Axes of the volume data in the MRC files (z, y, x)
+
+
+def samplePatches(evenFn, oddFn, patchSize, nPatches, split, tiltAxis, rng):
+    """Sample pairs of patches from the even/odd tomograms. As in cryoCARE, the tomograms are split along the
+    tilt axis, so the train and validation pairs are taken from different regions."""
+    with mrcfile.mmap(evenFn, mode='r', permissive=True) as mrcEven, \
+            mrcfile.mmap(oddFn, mode='r', permissive=True) as mrcOdd:
+        even, odd = mrcEven.data, mrcOdd.data
+        axis = TILT_AXES[tiltAxis]
+        splitPos = int(even.shape[axis] * split)
+        nTrain = max(1, int(nPatches * split))
+        pairs = {'train': ([], []), 'val': ([], [])}
+        for i in range(nPatches):
+            subset = 'train' if i < nTrain else 'val'
+            lims = [(0, dim - patchSize) for dim in even.shape]
+            if subset == 'train':
+                lims[axis] = (0, max(0, splitPos - patchSize))
+            else:
+                lims[axis] = (min(splitPos, even.shape[axis] - patchSize), even.shape[axis] - patchSize)
+            origin = [rng.integers(low, high + 1) for low, high in lims]
+            sl = tuple(slice(o, o + patchSize) for o in origin)
+            pairs[subset][0].append(np.asarray(even[sl], dtype=np.float32))
+            pairs[subset][1].append(np.asarray(odd[sl], dtype=np.float32))
+    return pairs
+
+
+def main():
+    config = readConfig(__doc__)
+    simulateLatency()
+    rng = np.random.default_rng(0)
+    patchSize = config['patch_shape'][0]
+    nPatches = min(config['num_slices'], getEnvNumber(SIM_MAX_PATCHES, config['num_slices'], int))
+    data = {'train': ([], []), 'val': ([], [])}
+    for evenFn, oddFn in zip(asList(config['even']), asList(config['odd'])):
+        pairs = samplePatches(evenFn, oddFn, patchSize, nPatches, config['split'], config['tilt_axis'], rng)
+        for subset in data:
+            data[subset][0].extend(pairs[subset][0])
+            data[subset][1].extend(pairs[subset][1])
+
+    trainX = np.stack(data['train'][0])
+    nNorm = max(1, min(len(trainX), config['n_normalization_samples']))
+    mean, std = float(trainX[:nNorm].mean()), float(trainX[:nNorm].std())
+    os.makedirs(config['path'], exist_ok=True)
+    for subset, fn in (('train', 'train_data.npz'), ('val', 'val_data.npz')):
+        X = (np.stack(data[subset][0]) - mean) / std if data[subset][0] else np.empty((0,) + 3 * (patchSize,))
+        Y = (np.stack(data[subset][1]) - mean) / std if data[subset][1] else np.empty((0,) + 3 * (patchSize,))
+        np.savez(join(config['path'], fn), X=X[..., np.newaxis], Y=Y[..., np.newaxis], mean=mean, std=std)
+    print('Extracted %i training pairs per tomogram into %s' % (nPatches, config['path']))
+
+
+if __name__ == '__main__':
+    main()
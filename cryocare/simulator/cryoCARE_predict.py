@@ -0,0 +1,72 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Stand-in for cryoCARE_predict.py: the even/odd tomograms are averaged and written, with the same shape and
+header as the input, into the output directory. Tiles larger than CRYOCARE_SIM_MAX_TILE_VOXELS make it fail as
+TensorFlow does when the GPU runs out of memory."""
+import os
+import sys
+from os.path import join, basename
+
+import mrcfile
+import numpy as np
+
+from simcommon import readConfig, simulateLatency, asList, getEnvNumber, SIM_MAX_TILE_VOXELS
+
+
+def predict(evenFn, oddFn, outputDir):
+    outFn = join(outputDir, basename(evenFn))
+    with mrcfile.mmap(evenFn, mode='r', permissive=True) as mrcEven, \
+            mrcfile.mmap(oddFn, mode='r', permissive=True) as mrcOdd:
+        with mrcfile.new_mmap(outFn, shape=mrcEven.data.shape, mrc_mode=2, overwrite=True) as mrcOut:
+            # Slice by slice to keep the memory footprint low
+            for i in range(mrcEven.data.shape[0]):
+                mrcOut.data[i] = (np.asarray(mrcEven.data[i], dtype=np.float32) + mrcOdd.data[i]) / 2
+            mrcOut.voxel_size = mrcEven.voxel_size
+    return outFn
+
+
+def checkTileSize(evenFn, nTiles):
+    maxVoxels = getEnvNumber(SIM_MAX_TILE_VOXELS, 0, int)
+    with mrcfile.mmap(evenFn, mode='r', permissive=True) as mrc:
+        shape = mrc.data.shape
+    tileShape = [int(np.ceil(size / n)) for size, n in zip(shape, nTiles)]
+    if maxVoxels and np.prod(tileShape) > maxVoxels:
+        print('tensorflow.python.framework.errors_impl.ResourceExhaustedError: OOM when allocating tensor with '
+              'shape[1,%i,%i,%i,32] and type float on /job:localhost/replica:0/task:0/device:GPU:0' % tuple(tileShape))
+        sys.exit(1)
+
+
+def main():
+    config = readConfig(__doc__)
+    simulateLatency()
+    os.makedirs(config['output'], exist_ok=True)
+    for evenFn, oddFn in zip(asList(config['even']), asList(config['odd'])):
+        checkTileSize(evenFn, asList(config.get('n_tiles', [1, 1, 1])))
+        print('Denoised tomogram written to %s' % predict(evenFn, oddFn, config['output']))
+
+
+if __name__ == '__main__':
+    main()
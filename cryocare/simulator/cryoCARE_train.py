@@ -0,0 +1,96 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Stand-in for cryoCARE_train.py: a decreasing loss curve is reported (Keras-like log lines) and a model
+.tar.gz with the same contents as the cryoCARE ones is generated."""
+import json
+import math
+import os
+import pickle
+import tarfile
+import time
+from os.path import join
+
+import numpy as np
+
+from simcommon import readConfig, simulateLatency, getEnvNumber, SIM_WEIGHTS_SIZE, SIM_LOSS_CURVE, SIM_EPOCH_TIME
+
+
+# Learning rate with the lowest simulated loss, so the hyperparameter sweeps have a known best configuration
+BEST_LEARNING_RATE = 0.0004
+
+
+def getValLoss(epoch, config):
+    lossCurve = os.environ.get(SIM_LOSS_CURVE)
+    if lossCurve:
+        lossCurve = [float(loss) for loss in lossCurve.split(',')]
+        return lossCurve[min(epoch, len(lossCurve) - 1)]
+    penalty = 1 + abs(math.log10(config['learning_rate'] / BEST_LEARNING_RATE))
+    return 1.05 * penalty / (1 + 0.5 * epoch)
+
+
+def writeWeights(fileName, size):
+    with open(fileName, 'wb') as f:
+        f.write(os.urandom(size))
+
+
+def main():
+    config = readConfig(__doc__)
+    simulateLatency()
+    with np.load(join(config['train_data'], 'train_data.npz')) as data:
+        mean, std = float(data['mean']), float(data['std'])
+
+    modelDir = join(config['path'], config['model_name'])
+    os.makedirs(modelDir, exist_ok=True)
+    # As CSBDeep, the model config is written when the model is created
+    with open(join(modelDir, 'config.json'), 'w') as f:
+        json.dump({key: config[key] for key in ('unet_kern_size', 'unet_n_depth', 'unet_n_first')}, f)
+    epochTime = getEnvNumber(SIM_EPOCH_TIME, 0)
+    weightsSize = getEnvNumber(SIM_WEIGHTS_SIZE, 1024 * 1024, int)
+    epochs, steps = config['epochs'], config['steps_per_epoch']
+    history = {'loss': [], 'val_loss': []}
+    for epoch in range(epochs):
+        valLoss = getValLoss(epoch, config)
+        loss = valLoss / 1.05
+        print('Epoch %i/%i' % (epoch + 1, epochs), flush=True)
+        time.sleep(epochTime)
+        print('%i/%i [==============================] - 0s 1ms/step - loss: %.4f - val_loss: %.4f'
+              % (steps, steps, loss, valLoss), flush=True)
+        if not history['val_loss'] or valLoss < min(history['val_loss']):
+            writeWeights(join(modelDir, 'weights_best.h5'), weightsSize)
+        history['loss'].append(loss)
+        history['val_loss'].append(valLoss)
+    writeWeights(join(modelDir, 'weights_last.h5'), weightsSize)
+
+    with open(join(modelDir, 'history.dat'), 'wb') as f:
+        pickle.dump(history, f)
+    with open(join(modelDir, 'norm.json'), 'w') as f:
+        json.dump({'mean': mean, 'std': std}, f)
+    with tarfile.open(join(config['path'], config['model_name'] + '.tar.gz'), 'w:gz') as tar:
+        tar.add(modelDir, arcname=config['model_name'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Code shared by the stand-in cryoCARE programs. These programs are run as scripts, so they must not import
+the cryocare plugin (and hence Scipion) to keep their start-up cost low."""
+import argparse
+import json
+import os
+import time
+
+# Environment variables used to tune the simulated backend
+SIM_LATENCY = 'CRYOCARE_SIM_LATENCY'  # Seconds added to each program execution
+SIM_MAX_PATCHES = 'CRYOCARE_SIM_MAX_PATCHES'  # Max. number of training pairs extracted per tomogram
+SIM_WEIGHTS_SIZE = 'CRYOCARE_SIM_WEIGHTS_SIZE'  # Size in bytes of the weights files of the model
+SIM_LOSS_CURVE = 'CRYOCARE_SIM_LOSS_CURVE'  # Comma separated validation loss per epoch (the last one is repeated)
+SIM_EPOCH_TIME = 'CRYOCARE_SIM_EPOCH_TIME'  # Seconds taken by each training epoch
+SIM_MAX_TILE_VOXELS = 'CRYOCARE_SIM_MAX_TILE_VOXELS'  # Prediction runs out of memory with larger tiles (0: no limit)
+
+
+def getEnvNumber(varName, default, numType=float):
+    return numType(os.environ.get(varName, default))
+
+
+def readConfig(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--conf', required=True, help='Path to the json config file.')
+    args = parser.parse_args()
+    with open(args.conf) as f:
+        return json.load(f)
+
+
+def simulateLatency():
+    latency = getEnvNumber(SIM_LATENCY, 0)
+    if latency > 0:
+        time.sleep(latency)
+
+
+def asList(value):
+    return value if isinstance(value, list) else [value]
@@ -0,0 +1,173 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Intra-tomogram parallelism: a tomogram is split into overlapping slabs along its longest axis, so they can be
+denoised by concurrent predictions, and the denoised slabs are stitched into the output, blended linearly across
+the overlaps."""
+import os
+import threading
+
+from cryocare.volumes import openVolume
+
+CHUNK_BYTES = 256 * 1024 ** 2  # Memory used to copy and blend each chunk of a slab
+DEFAULT_OVERLAP = 32  # Pixels on each side of the boundaries between slabs
+
+
+class Slab:
+    """Range [start, stop) of a slab along the axis (0, 1, 2 for z, y, x) the tomogram is split along. Its core
+    [coreStart, coreStop) is the part of the tomogram it is responsible for: out of it, it overlaps with its
+    neighbours."""
+    __slots__ = ('axis', 'start', 'stop', 'coreStart', 'coreStop')
+
+    def __init__(self, axis, start, stop, coreStart, coreStop):
+        self.axis = axis
+        self.start = start
+        self.stop = stop
+        self.coreStart = coreStart
+        self.coreStop = coreStop
+
+    def getShape(self, shape):
+        """Shape (z, y, x) of the slab of a volume of the given shape."""
+        slabShape = list(shape)
+        slabShape[self.axis] = self.stop - self.start
+        return tuple(slabShape)
+
+    def getWeights(self):
+        """Blending weights along the axis: they ramp linearly across the overlaps, so the weights of two
+        neighbouring slabs add up to 1."""
+        import numpy as np
+        weights = np.ones(self.stop - self.start, dtype=np.float32)
+        positions = np.arange(self.start, self.stop) + 0.5
+        lowOverlap = self.coreStart - self.start
+        if lowOverlap:
+            lowZone = positions < self.coreStart + lowOverlap
+            weights[lowZone] = (positions[lowZone] - self.start) / (2 * lowOverlap)
+        highOverlap = self.stop - self.coreStop
+        if highOverlap:
+            highZone = positions >= self.coreStop - highOverlap
+            weights[highZone] = (self.stop - positions[highZone]) / (2 * highOverlap)
+        return weights
+
+    def toList(self):
+        return [getattr(self, attr) for attr in self.__slots__]
+
+    def __repr__(self):
+        return 'Slab(%s)' % ', '.join('%s=%r' % (attr, getattr(self, attr)) for attr in self.__slots__)
+
+
+def getSlabs(shape, nSlabs, overlap=DEFAULT_OVERLAP):
+    """Slabs of a volume of the given shape (z, y, x) along its longest axis. There are fewer slabs than requested
+    if their cores would be shorter than twice the overlap, as the blending zones of a slab must not meet."""
+    axis = max(range(len(shape)), key=lambda i: shape[i])
+    size = shape[axis]
+    if overlap:
+        nSlabs = min(nSlabs, size // (2 * overlap))
+    nSlabs = max(1, nSlabs)
+    bounds = [round(i * size / nSlabs) for i in range(nSlabs + 1)]
+    return [Slab(axis, max(0, coreStart - overlap), min(size, coreStop + overlap), coreStart, coreStop)
+            for coreStart, coreStop in zip(bounds[:-1], bounds[1:])]
+
+
+def _axisSlice(axis, start, stop):
+    region = [slice(None)] * 3
+    region[axis] = slice(start, stop)
+    return tuple(region)
+
+
+def _getChunkSize(shape, chunkBytes):
+    return max(1, chunkBytes // (shape[1] * shape[2] * 4))
+
+
+def _newMrc(fileName, shape, voxelSize):
+    """Output MRC, memory-mapped. It is written to a temporary file, to be renamed once complete."""
+    import mrcfile
+    tmpFile = '%s.%i-%i.tmp' % (fileName, os.getpid(), threading.get_ident())
+    mrc = mrcfile.new_mmap(tmpFile, shape=shape, mrc_mode=2, overwrite=True)
+    if voxelSize:
+        mrc.voxel_size = voxelSize
+    return mrc, tmpFile
+
+
+def extractSlab(volFile, outFile, slab, chunkBytes=CHUNK_BYTES):
+    """Write a slab of a volume (any of the formats of cryocare.volumes) to an MRC file. The volume is read by
+    chunks of slices."""
+    import numpy as np
+    with openVolume(volFile) as vol:
+        zStart, zStop = (slab.start, slab.stop) if slab.axis == 0 else (0, vol.shape[0])
+        mrcOut, tmpFile = _newMrc(outFile, slab.getShape(vol.shape), vol.voxelSize)
+        with mrcOut:
+            region = _axisSlice(slab.axis, slab.start, slab.stop) if slab.axis else _axisSlice(0, None, None)
+            chunk = _getChunkSize(vol.shape, chunkBytes)
+            for z0 in range(zStart, zStop, chunk):
+                z1 = min(zStop, z0 + chunk)
+                mrcOut.data[z0 - zStart:z1 - zStart] = np.asarray(vol.data[z0:z1], dtype=np.float32)[region]
+            mrcOut.update_header_stats()
+    os.replace(tmpFile, outFile)
+    return outFile
+
+
+def _blend(out, block, axis, blockStart, offset, nAdded):
+    """Write a weighted block of a slab, which starts at blockStart along the axis, in the output (offset being the
+    start of the slab in it). Its part in the first nAdded positions of the slab is added to the output."""
+    lo, hi = blockStart, blockStart + block.shape[axis]
+    split = min(max(lo, nAdded), hi)
+    if split > lo:
+        out[_axisSlice(axis, offset + lo, offset + split)] += block[_axisSlice(axis, 0, split - lo)]
+    if hi > split:
+        out[_axisSlice(axis, offset + split, offset + hi)] = block[_axisSlice(axis, split - lo, hi - lo)]
+
+
+def stitchSlabs(slabFiles, slabs, shape, outFile, voxelSize=None, chunkBytes=CHUNK_BYTES):
+    """Stitch the (denoised) slabs of a volume of the given shape into the memory-mapped MRC outFile. Each slab is
+    weighted by its blending weights: it is added to the previous one across their overlap and written as it is
+    elsewhere, so the output does not need to be initialized. The voxel size is the one of the first slab if not
+    given."""
+    import mrcfile
+    import numpy as np
+    if voxelSize is None:
+        with mrcfile.mmap(slabFiles[0], mode='r', permissive=True) as mrc:
+            voxelSize = mrc.voxel_size.copy()
+    mrcOut, tmpFile = _newMrc(outFile, tuple(shape), voxelSize)
+    with mrcOut:
+        for i, (slabFile, slab) in enumerate(zip(slabFiles, slabs)):
+            axis = slab.axis
+            weights = slab.getWeights().reshape([-1 if ax == axis else 1 for ax in range(3)])
+            nAdded = 2 * (slab.coreStart - slab.start) if i else 0  # Blending zone with the previous slab
+            with mrcfile.mmap(slabFile, mode='r', permissive=True) as mrc:
+                data = mrc.data
+                if data.shape != slab.getShape(shape):
+                    raise ValueError('The shape of the slab %s is %s instead of %s.'
+                                     % (slabFile, data.shape, slab.getShape(shape)))
+                chunk = _getChunkSize(data.shape, chunkBytes)
+                for z0 in range(0, data.shape[0], chunk):
+                    z1 = min(data.shape[0], z0 + chunk)
+                    block = np.asarray(data[z0:z1], dtype=np.float32)
+                    if axis == 0:
+                        _blend(mrcOut.data, block * weights[z0:z1], axis, z0, slab.start, nAdded)
+                    else:
+                        _blend(mrcOut.data[z0:z1], block * weights, axis, 0, slab.start, nAdded)
+        mrcOut.update_header_stats()
+    os.replace(tmpFile, outFile)
+    return outFile
@@ -0,0 +1,146 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, basename, getsize, exists, dirname
+
+logger = logging.getLogger(__name__)
+
+
+class _StagedEntry:
+    def __init__(self, paths, size):
+        self.paths = paths
+        self.size = size
+        self.future = None
+        self.evictable = False  # Only once used and released. Prefetched entries are about to be used
+
+
+class ScratchStager:
+    """Copy the input files of the items to be processed (e.g. the even/odd halves of a tomogram) to a local
+    scratch directory in background threads, so the next items are staged while the current one is being
+    processed. The staged files already used are evicted in LRU order to keep the scratch usage under a size cap
+    (they are kept meanwhile, e.g. in case the item has to be processed again). The outputs
+    written to the scratch can be moved back to their final location asynchronously."""
+
+    def __init__(self, scratchDir, maxSize, nWorkers=1):
+        self._dir = scratchDir
+        self._maxSize = maxSize
+        self._entries = OrderedDict()  # From least to most recently used
+        self._lock = threading.Lock()
+        self._copier = ThreadPoolExecutor(max_workers=nWorkers, thread_name_prefix='stage-in')
+        self._mover = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stage-out')
+        os.makedirs(scratchDir, exist_ok=True)
+
+    def getOutputDir(self, key):
+        return join(self._dir, 'out', key)
+
+    def prefetch(self, key, files):
+        """Start copying the files in background, if they fit in the scratch."""
+        with self._lock:
+            if key in self._entries:
+                return
+            size = sum(getsize(fn) for fn in files)
+            if not self._makeRoom(size):
+                logger.info('No room in the scratch for %s: it will be read from its original location.' % key)
+                return
+            # Each file is staged in its own directory to keep its base name, used by the programs to name outputs
+            paths = [join(self._dir, 'in', key, str(i), basename(fn)) for i, fn in enumerate(files)]
+            entry = _StagedEntry(paths, size)
+            entry.future = self._copier.submit(self._copy, files, paths)
+            self._entries[key] = entry
+
+    def get(self, key, files):
+        """Return the staged copies of the files, waiting for them if they are still being copied. The original
+        files are returned if they could not be staged."""
+        self.prefetch(key, files)
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                return files
+            entry.evictable = False  # Not while being used
+            self._entries.move_to_end(key)
+        try:
+            entry.future.result()
+        except Exception as e:
+            logger.warning('Staging of %s failed (%s): it will be read from its original location.' % (key, e))
+            with self._lock:
+                self._evict(key)
+            return files
+        return entry.paths
+
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry:
+                entry.evictable = True
+
+    def moveAsync(self, src, dst, onDone=None):
+        """Move a file from the scratch to its final location in background. A future is returned."""
+        def _move():
+            os.makedirs(dirname(dst), exist_ok=True)
+            shutil.move(src, dst)
+            if onDone:
+                onDone()
+        return self._mover.submit(_move)
+
+    def close(self):
+        self._copier.shutdown(wait=True)
+        self._mover.shutdown(wait=True)
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    def getUsedSize(self):
+        with self._lock:
+            return sum(entry.size for entry in self._entries.values())
+
+    @staticmethod
+    def _copy(files, paths):
+        for fn, path in zip(files, paths):
+            os.makedirs(dirname(path), exist_ok=True)
+            tmpPath = path + '.tmp'
+            shutil.copyfile(fn, tmpPath)
+            os.replace(tmpPath, path)
+
+    def _makeRoom(self, size):
+        usedSize = sum(entry.size for entry in self._entries.values())
+        for key in list(self._entries):
+            if usedSize + size <= self._maxSize:
+                break
+            entry = self._entries[key]
+            if not entry.evictable or not entry.future.done():
+                continue
+            self._evict(key)
+            usedSize -= entry.size
+        return usedSize + size <= self._maxSize
+
+    def _evict(self, key):
+        entry = self._entries.pop(key)
+        for path in entry.paths:
+            if exists(path):
+                os.remove(path)
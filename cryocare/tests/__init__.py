@@ -24,13 +24,27 @@
 # *
 # **************************************************************************
 
+import io
+import json
+import tarfile
 from enum import Enum
+from os.path import join
 
-from cryocare.constants import CRYOCARE_MODEL_TGZ
+import mrcfile
+import numpy as np
+
+from cryocare.constants import CRYOCARE_MODEL, CRYOCARE_MODEL_TGZ
+from cryocare.protocols.protocol_load_model import ProtCryoCARELoadModel
 from pyworkflow.tests import DataSet
+from tomo.protocols import ProtImportTomograms
 
 CRYOCARE = 'cryocare'
 
+# Synthetic data of the tests run with the simulated cryoCARE backend
+TOMO_SHAPE = (24, 32, 32)  # (z, y, x)
+S_RATE = 10
+PATCH_SIZE = 8
+
 
 class DataSetCryoCARE(Enum):
     rec_even_odd_tomos_dir = 'Tomos_EvenOdd_Reconstructed'
@@ -49,3 +63,53 @@ class DataSetCryoCARE(Enum):
 
 
 DataSet(name=CRYOCARE, folder=CRYOCARE, files={el.name: el.value for el in DataSetCryoCARE})
+
+
+def genSyntheticTomos(outDir, nTomos, shape=TOMO_SHAPE, pattern='TS_%05d_%s.mrc'):
+    rng = np.random.default_rng(0)
+    for i in range(nTomos):
+        signal = rng.random(shape, dtype=np.float32)
+        for half in ('even', 'odd'):
+            with mrcfile.new(join(outDir, pattern % (i, half)), overwrite=True) as mrc:
+                mrc.set_data(signal + rng.normal(scale=0.1, size=shape).astype(np.float32))
+                mrc.voxel_size = S_RATE
+
+
+def _addTarMember(tar, name, content):
+    info = tarfile.TarInfo(join(CRYOCARE_MODEL, name))
+    info.size = len(content)
+    tar.addfile(info, io.BytesIO(content))
+
+
+def genFakeModel(modelFile, weights=b'\x00' * 4096, withNorm=True):
+    with tarfile.open(modelFile, 'w:gz') as tar:
+        _addTarMember(tar, 'config.json', json.dumps({'unet_n_depth': 3, 'unet_n_first': 16}).encode())
+        if withNorm:
+            _addTarMember(tar, 'norm.json', json.dumps({'mean': 0.5, 'std': 2.0}).encode())
+        _addTarMember(tar, 'weights_best.h5', weights)
+        _addTarMember(tar, 'history.dat', b'{}')
+
+
+def _importHalves(test, tomoDir, pattern='*_%s.mrc'):
+    """Import the even/odd synthetic tomograms of a directory in the project of a BaseTest (class or instance)."""
+    halves = {}
+    for half in ('even', 'odd'):
+        protImport = test.newProtocol(ProtImportTomograms, filesPath=tomoDir, filesPattern=pattern % half,
+                                      samplingRate=S_RATE)
+        test.launchProtocol(protImport)
+        halves[half] = protImport.Tomograms
+    return halves
+
+
+def _loadFakeModel(test):
+    """Load a fake model, enough for the simulated prediction, which does not read it."""
+    modelFile = test.getOutputPath('fake_model.tar.gz')
+    genFakeModel(modelFile)
+    protModel = test.newProtocol(ProtCryoCARELoadModel, trainDataModel=modelFile)
+    test.launchProtocol(protModel)
+    return protModel.model
+
+
+def _importHalvesAndModel(test, tomoDir):
+    """Even/odd tomograms and model to run a simulated prediction."""
+    return _importHalves(test, tomoDir), _loadFakeModel(test)
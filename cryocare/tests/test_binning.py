@@ -0,0 +1,78 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join, getmtime
+
+import mrcfile
+import numpy as np
+
+from cryocare.binning import fourierBin, getBinnedFile
+
+SHAPE = (20, 24, 32)
+VOXEL_SIZE = 2.5
+
+
+class TestFourierBinning(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpDir)
+        # Low frequency signal, fully preserved by the crop
+        z, y, x = np.meshgrid(*[np.arange(n) for n in SHAPE], indexing='ij')
+        self.volume = (3 + np.cos(2 * np.pi * x / SHAPE[2]) * np.sin(2 * np.pi * 2 * z / SHAPE[0])
+                       + np.cos(2 * np.pi * 3 * y / SHAPE[1])).astype(np.float32)
+        self.inFile = join(self.tmpDir, 'TS_01_even.mrc')
+        with mrcfile.new(self.inFile) as mrc:
+            mrc.set_data(self.volume)
+            mrc.voxel_size = VOXEL_SIZE
+
+    def testFourierBin(self):
+        outFile = fourierBin(self.inFile, join(self.tmpDir, 'binned.mrc'), 2)
+        with mrcfile.open(outFile) as mrc:
+            binned = mrc.data
+            self.assertEqual(binned.shape, tuple(n // 2 for n in SHAPE))
+            self.assertAlmostEqual(float(mrc.voxel_size.x), 2 * VOXEL_SIZE, places=4)
+            # The binned volume is the input one sampled every 2 voxels
+            np.testing.assert_allclose(binned, self.volume[::2, ::2, ::2], atol=1e-4)
+
+    def testChunked(self):
+        wholeFile = fourierBin(self.inFile, join(self.tmpDir, 'whole.mrc'), 2)
+        chunkedFile = fourierBin(self.inFile, join(self.tmpDir, 'chunked.mrc'), 2, chunkBytes=1)
+        with mrcfile.open(wholeFile) as whole, mrcfile.open(chunkedFile) as chunked:
+            np.testing.assert_allclose(whole.data, chunked.data, atol=1e-5)
+
+    def testCache(self):
+        cacheDir = join(self.tmpDir, 'cache')
+        self.assertEqual(getBinnedFile(self.inFile, 1, cacheDir), self.inFile)
+        binnedFile = getBinnedFile(self.inFile, 2, cacheDir)
+        mtime = getmtime(binnedFile)
+        self.assertEqual(getBinnedFile(self.inFile, 2, cacheDir), binnedFile)
+        self.assertEqual(getmtime(binnedFile), mtime)
+        self.assertEqual(os.listdir(cacheDir), [os.path.basename(binnedFile)])
+        self.assertNotEqual(getBinnedFile(self.inFile, 4, cacheDir), binnedFile)
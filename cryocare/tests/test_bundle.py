@@ -0,0 +1,130 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from os.path import join, exists
+from unittest import mock
+
+from cryocare import Plugin
+from cryocare.bundle import writeBundle, readTasks, getPendingTasks, LAUNCHER_FN
+from cryocare.constants import CRYOCARE_SIMULATE, TRAIN_DATA_MANIFEST_FN
+from cryocare.protocols import ProtCryoCAREExtractTrainData, ProtCryoCAREPrediction
+from cryocare.protocols.protocol_extract_train_data import Outputobjects as extractOutputs
+from cryocare.protocols.protocol_predict import Outputobjects as predictOutputs
+from cryocare.tests import genSyntheticTomos, PATCH_SIZE, _importHalves, _loadFakeModel
+from cryocare.traindata import getTrainDataParts
+from pyworkflow.tests import BaseTest, setupTestProject
+from pyworkflow.utils import makePath
+
+N_TOMOS = 3
+
+
+def runLauncher(bundleDir, index=None, **environ):
+    """Run a task of the bundle as the scheduler would. Returns the exit code."""
+    args = [join(bundleDir, LAUNCHER_FN)] + ([str(index)] if index is not None else [])
+    return subprocess.run(args, env=dict(os.environ, **environ), stdout=subprocess.DEVNULL).returncode
+
+
+class TestBundle(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpDir)
+
+    @mock.patch.dict(os.environ, {CRYOCARE_SIMULATE: 'True'})
+    def testLauncher(self):
+        genSyntheticTomos(self.tmpDir, 2)
+        tasks = [('TS_%i' % i, {'even': join(self.tmpDir, 'TS_%05d_even.mrc' % i),
+                                'odd': join(self.tmpDir, 'TS_%05d_odd.mrc' % i),
+                                'output': join(self.tmpDir, 'out_%i' % i)})
+                 for i in range(2)]
+        bundleDir = join(self.tmpDir, 'bundle')
+        writeBundle(bundleDir, 'cryoCARE_predict.py', tasks)
+        self.assertEqual([(index, tsId) for index, tsId, _ in readTasks(bundleDir)], [(1, 'TS_0'), (2, 'TS_1')])
+        self.assertEqual(len(getPendingTasks(bundleDir)), 2)
+        # The task index is taken from the argument or from the variables of the schedulers
+        self.assertEqual(runLauncher(bundleDir, 1), 0)
+        self.assertEqual(runLauncher(bundleDir, SLURM_ARRAY_TASK_ID='2'), 0)
+        self.assertEqual(getPendingTasks(bundleDir), [])
+        self.assertTrue(exists(join(self.tmpDir, 'out_1', 'TS_00001_even.mrc')))
+        self.assertEqual(runLauncher(bundleDir, 1), 0)  # Already done
+        self.assertEqual(runLauncher(bundleDir, 3), 2)
+        self.assertEqual(runLauncher(bundleDir), 2)
+
+
+@unittest.skipUnless(Plugin.isSimulated(), 'Set %s=True to run it with the simulated backend.' % CRYOCARE_SIMULATE)
+class TestBundleProtocols(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        tomoDir = cls.getOutputPath('synthetic_tomos')
+        makePath(tomoDir)
+        genSyntheticTomos(tomoDir, N_TOMOS)
+        cls.tomos = _importHalves(cls, tomoDir)
+
+    def _runArrayJob(self, prot):
+        """Launch the protocol, which fails as the array job has not run, run its tasks and continue it."""
+        with self.assertRaises(Exception):
+            self.launchProtocol(prot)
+        bundleDir = prot._getBundleDir()
+        self.assertEqual(len(getPendingTasks(bundleDir)), N_TOMOS)
+        for index in range(1, N_TOMOS + 1):
+            self.assertEqual(runLauncher(bundleDir, index), 0)
+        prot = self.proj.getProtocol(prot.getObjId())
+        self.launchProtocol(prot)
+        return prot
+
+    def testPrediction(self):
+        model = _loadFakeModel(self)
+        protPredict = self.newProtocol(ProtCryoCAREPrediction,
+                                       evenTomos=self.tomos['even'],
+                                       oddTomos=self.tomos['odd'],
+                                       model=model,
+                                       exportBundle=True)
+        protPredict = self._runArrayJob(protPredict)
+        outTomos = getattr(protPredict, predictOutputs.tomograms.name)
+        self.assertEqual(outTomos.getSize(), N_TOMOS)
+        for tomo in outTomos:
+            self.assertTrue(exists(tomo.getFileName()))
+            self.assertNotIn('even', tomo.getFileName())
+        self.assertIn('%i/%i tomograms denoised' % (N_TOMOS, N_TOMOS), protPredict.summary()[0])
+
+    def testExtraction(self):
+        protExtract = self.newProtocol(ProtCryoCAREExtractTrainData,
+                                       evenTomos=self.tomos['even'],
+                                       oddTomos=self.tomos['odd'],
+                                       patch_shape=PATCH_SIZE,
+                                       num_slices=10,
+                                       n_normalization_samples=5,
+                                       exportBundle=True)
+        protExtract = self._runArrayJob(protExtract)
+        trainData = getattr(protExtract, extractOutputs.train_data.name)
+        self.assertTrue(exists(join(trainData.getTrainDataDir(), TRAIN_DATA_MANIFEST_FN)))
+        self.assertEqual(len(getTrainDataParts(trainData.getTrainDataDir())), N_TOMOS)
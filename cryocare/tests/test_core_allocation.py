@@ -0,0 +1,121 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from os.path import join
+
+from pyworkflow.utils import envVarOn
+from cryocare.resources import partitionCores, CoreAllocator, getAvailableCores, getThreadEnvVars, \
+    getAffinityPrefix, getExistingDir, getFreeSpace, measureWriteThroughput
+
+# CPU bound job representative of the cryoCARE processes: multithreaded (BLAS) matrix products
+BENCHMARK_JOB = 'import numpy as np; a = np.random.rand(1024, 1024); [a @ a for _ in range(20)]'
+BENCHMARK_VAR = 'CRYOCARE_BENCHMARK'
+
+
+class TestCoreAllocation(unittest.TestCase):
+
+    def testPartitionNuma(self):
+        numaNodes = [[0, 2, 4, 6], [1, 3, 5, 7]]
+        parts = partitionCores(list(range(8)), 2, numaNodes)
+        self.assertEqual(parts, numaNodes)  # One set per NUMA node
+        parts = partitionCores(list(range(8)), 4, numaNodes)
+        self.assertEqual(parts, [[0, 2], [4, 6], [1, 3], [5, 7]])
+
+    def testPartitionDisjoint(self):
+        parts = partitionCores(list(range(10)), 3)
+        self.assertEqual(sorted(core for part in parts for core in part), list(range(10)))
+        self.assertEqual([len(part) for part in parts], [4, 3, 3])
+
+    def testMoreSlotsThanCores(self):
+        self.assertEqual(partitionCores([0, 1], 3), [[0], [1], [0]])
+
+    def testAllocator(self):
+        allocator = CoreAllocator(2, cores=[0, 1, 2, 3])
+        with allocator.allocate() as cores1, allocator.allocate() as cores2:
+            self.assertFalse(set(cores1).intersection(cores2))
+            self.assertIsNone(allocator.acquire())  # Exhausted
+        self.assertIsNotNone(allocator.acquire())
+
+    def testThreadEnvVars(self):
+        envVars = getThreadEnvVars(8)
+        self.assertEqual(envVars['OMP_NUM_THREADS'], '8')
+        self.assertEqual(envVars['TF_NUM_INTEROP_THREADS'], '2')
+
+
+class TestDiskResources(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpDir)
+
+    def testFreeSpace(self):
+        # The working directories do not exist yet when the protocols are validated
+        runDir = join(self.tmpDir, 'Runs', '000002_ProtCryoCARETraining')
+        self.assertEqual(getExistingDir(runDir), self.tmpDir)
+        self.assertEqual(getFreeSpace(runDir), shutil.disk_usage(self.tmpDir).free)
+
+    def testWriteThroughput(self):
+        throughput = measureWriteThroughput(self.tmpDir, probeSize=1024 ** 2)
+        self.assertGreater(throughput, 0)
+        self.assertEqual(os.listdir(self.tmpDir), [])  # The probe is removed
+        self.assertEqual(measureWriteThroughput(self.tmpDir), throughput)  # Cached
+
+
+def runWorkers(nWorkers, pin):
+    """Run nWorkers benchmark jobs concurrently, pinned to disjoint core sets or not. The throughput (jobs per
+    minute) is returned."""
+    allocator = CoreAllocator(nWorkers)
+    procs = []
+    t0 = time.time()
+    for _ in range(nWorkers):
+        env = dict(os.environ)
+        cmd = '%s -c "%s"' % (sys.executable, BENCHMARK_JOB)
+        if pin:
+            cores = allocator.acquire()
+            env.update(getThreadEnvVars(len(cores)))
+            cmd = getAffinityPrefix(cores) + cmd
+        procs.append(subprocess.Popen(cmd, shell=True, env=env))
+    for proc in procs:
+        proc.wait()
+    return 60 * nWorkers / (time.time() - t0)
+
+
+@unittest.skipUnless(envVarOn(BENCHMARK_VAR), 'Set %s=True to run the core pinning benchmark.' % BENCHMARK_VAR)
+class BenchmarkCorePinning(unittest.TestCase):
+
+    def testThroughputVsWorkers(self):
+        nCores = len(getAvailableCores())
+        nWorkers = 1
+        print('\n%8s %20s %20s' % ('Workers', 'Not pinned (job/min)', 'Pinned (job/min)'))
+        while nWorkers <= nCores:
+            print('%8i %20.2f %20.2f' % (nWorkers, runWorkers(nWorkers, False), runWorkers(nWorkers, True)))
+            nWorkers *= 2
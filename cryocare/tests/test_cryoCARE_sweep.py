@@ -0,0 +1,127 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import csv
+import tarfile
+import unittest
+from os.path import exists, join
+
+from cryocare import Plugin
+from cryocare.constants import CRYOCARE_SIMULATE, CRYOCARE_MODEL, STATUS_FN
+from cryocare.lifecycle import KEEP_FINAL, readRecord
+from cryocare.monitor import readStatus
+from cryocare.protocols.protocol_sweep import ProtCryoCARESweep, RANDOM, SWEEP_DIR
+from cryocare.protocols.protocol_training import Outputobjects as trainOutputs
+from cryocare.tests import genSyntheticTomos, PATCH_SIZE, _importHalves
+from cryocare.utils import getModelName
+from pyworkflow.tests import BaseTest, setupTestProject
+from pyworkflow.utils import makePath
+
+# The simulated training reaches its lowest loss with the first one
+LEARNING_RATES = '0.0004 0.004 0.00001'
+
+
+class TestSweepConfigs(unittest.TestCase):
+
+    def testConfigs(self):
+        prot = ProtCryoCARESweep()
+        prot.sweepDepths.set('2 3')
+        prot.sweepLearningRates.set(LEARNING_RATES)
+        prot.sweepBatchSizes.set('')
+        configs = prot._getSweepConfigs()
+        self.assertEqual(len(configs), 6)
+        self.assertEqual({config['batch_size'] for config in configs}, {prot._getBatchSize()})
+        prot.sweepMode.set(RANDOM)
+        prot.nConfigs.set(4)
+        self.assertEqual(len(prot._getSweepConfigs()), 4)
+        # The same configurations are drawn every time, and not more than there are
+        self.assertEqual(prot._getSweepConfigs(), prot._getSweepConfigs())
+        prot.nConfigs.set(10)
+        self.assertEqual(len(prot._getSweepConfigs()), 6)
+
+
+@unittest.skipUnless(Plugin.isSimulated(), 'Set %s=True to run it with the simulated backend.' % CRYOCARE_SIMULATE)
+class TestSweepProtocol(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        tomoDir = cls.getOutputPath('synthetic_tomos')
+        makePath(tomoDir)
+        genSyntheticTomos(tomoDir, 2)
+        cls.tomos = _importHalves(cls, tomoDir)
+
+    def testSweep(self):
+        protSweep = self.newProtocol(ProtCryoCARESweep,
+                                     evenTomos=self.tomos['even'],
+                                     oddTomos=self.tomos['odd'],
+                                     patch_shape=PATCH_SIZE,
+                                     num_slices=10,
+                                     n_normalization_samples=5,
+                                     epochs=3,
+                                     steps_per_epoch=2,
+                                     sweepDepths='2',
+                                     sweepLearningRates=LEARNING_RATES,
+                                     gpuList='0 1',
+                                     numberOfThreads=3)
+        self.launchProtocol(protSweep)
+        with open(protSweep._getResultsFile(), newline='') as f:
+            results = list(csv.DictReader(f))
+        self.assertEqual(len(results), 3)
+        self.assertEqual(float(results[0]['learning_rate']), 0.0004)
+        self.assertEqual([int(result['epochs']) for result in results], [3, 3, 3])
+        # Every configuration was trained to the end, not stopped
+        for configInd in range(3):
+            status = readStatus(join(protSweep._getConfigDir(configInd), STATUS_FN))
+            self.assertEqual((status['state'], status['epoch']), ('finished', 3))
+        model = getattr(protSweep, trainOutputs.model.name)
+        self.assertIn(results[0]['config'], model.getPath())
+        with tarfile.open(model.getPath()) as tar:
+            self.assertIn('%s/history.dat' % CRYOCARE_MODEL, tar.getnames())
+        self.assertIn('*%.4g*' % float(results[0]['best_val_loss']), '\n'.join(protSweep.summary()))
+
+    def testSweepFinalOnly(self):
+        protSweep = self.newProtocol(ProtCryoCARESweep,
+                                     evenTomos=self.tomos['even'],
+                                     oddTomos=self.tomos['odd'],
+                                     patch_shape=PATCH_SIZE,
+                                     num_slices=10,
+                                     n_normalization_samples=5,
+                                     epochs=2,
+                                     steps_per_epoch=2,
+                                     sweepDepths='2',
+                                     sweepLearningRates='0.0004 0.004',
+                                     retention=KEEP_FINAL)
+        self.launchProtocol(protSweep)
+        # The best model is kept out of the sweep directory, and the intermediate data is removed
+        model = getattr(protSweep, trainOutputs.model.name)
+        self.assertEqual(model.getPath(), getModelName(protSweep))
+        self.assertIsNone(model.getTrainDataDir())
+        self.assertFalse(exists(protSweep._getExtraPath(SWEEP_DIR)))
+        self.assertFalse(exists(protSweep._getTrainDataDir()))
+        with tarfile.open(model.getPath()) as tar:
+            self.assertIn('%s/history.dat' % CRYOCARE_MODEL, tar.getnames())
+        self.assertGreater(readRecord(protSweep.getWorkingDir())['reclaimed'], 0)
+        self.assertIn('reclaimed', '\n'.join(protSweep.summary()))
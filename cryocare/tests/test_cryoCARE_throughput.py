@@ -0,0 +1,154 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import unittest
+
+from cryocare import Plugin
+from cryocare.constants import CRYOCARE_SIMULATE
+from cryocare.protocols.protocol_training import Outputobjects as trainOutputs, ProtCryoCARETraining
+from cryocare.protocols.protocol_predict import Outputobjects as predictOutputs, ProtCryoCAREPrediction
+from cryocare.protocols.protocol_predict_subtomos import Outputobjects as subtomoOutputs, \
+    ProtCryoCAREPredictSubtomos
+from cryocare.preview import getPreviewAttributes
+from cryocare.tests import genSyntheticTomos, _loadFakeModel, S_RATE, PATCH_SIZE
+from pyworkflow.tests import BaseTest, setupTestProject
+from pyworkflow.utils import magentaStr, makePath
+from tomo.protocols import ProtImportTomograms, ProtImportSubTomograms
+
+# Throughput harness settings, which can be tuned with environment variables
+N_TOMOS = int(os.environ.get('CRYOCARE_THROUGHPUT_N_TOMOS', 1000))
+N_THREADS = int(os.environ.get('CRYOCARE_THROUGHPUT_THREADS', 4))
+N_SUBTOMOS = int(os.environ.get('CRYOCARE_THROUGHPUT_N_SUBTOMOS', 2000))
+SUBTOMOS_PER_BATCH = 500
+SUBTOMO_SHAPE = (16, 16, 16)
+
+
+def reportThroughput(prot, nThreads):
+    """Report the steps per second of a protocol and the scheduler overhead, measured as the wall time not
+    explained by the steps running with the given parallelism."""
+    steps = prot.loadSteps()
+    wallTime = prot.getElapsedTime().total_seconds()
+    busyTime = sum(step.getElapsedTime().total_seconds() for step in steps)
+    overhead = max(0., wallTime - busyTime / nThreads)
+    print(magentaStr('%s: %i steps in %.1f s --> %.2f steps/s, %.2f s busy, scheduler overhead %.1f s '
+                     '(%.1f ms per step)' % (prot.getObjLabel(), len(steps), wallTime, len(steps) / wallTime,
+                                             busyTime, overhead, 1000 * overhead / len(steps))))
+
+
+@unittest.skipUnless(Plugin.isSimulated(), 'The throughput harness runs with the simulated cryoCARE backend. '
+                                           'Set %s=True to run it.' % CRYOCARE_SIMULATE)
+class TestCryoCAREThroughput(BaseTest):
+    """Drive the training and prediction protocols over many synthetic tomograms with the simulated backend to
+    find the scaling limits of the plugin orchestration (step insertion, config generation, output registration
+    and parallel scheduling)."""
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.tomoDir = cls.getOutputPath('synthetic_tomos')
+        makePath(cls.tomoDir)
+        genSyntheticTomos(cls.tomoDir, N_TOMOS)
+
+    def _runImportTomograms(self, half):
+        protImport = self.newProtocol(ProtImportTomograms,
+                                      filesPath=self.tomoDir,
+                                      filesPattern='*_%s.mrc' % half,
+                                      samplingRate=S_RATE)
+        protImport.setObjLabel('Import %i %s tomograms' % (N_TOMOS, half))
+        self.launchProtocol(protImport)
+        return getattr(protImport, 'Tomograms', None)
+
+    def testThroughput(self):
+        evenTomos = self._runImportTomograms('even')
+        oddTomos = self._runImportTomograms('odd')
+
+        print(magentaStr("\n==> Training with the simulated backend:"))
+        protTraining = self.newProtocol(ProtCryoCARETraining,
+                                        evenTomos=evenTomos,
+                                        oddTomos=oddTomos,
+                                        patch_shape=PATCH_SIZE,
+                                        num_slices=10,
+                                        n_normalization_samples=5,
+                                        epochs=2,
+                                        steps_per_epoch=2)
+        self.assertEqual(protTraining.validate(), [])
+        self.launchProtocol(protTraining)
+        model = getattr(protTraining, trainOutputs.model.name, None)
+        self.assertIsNotNone(model)
+        reportThroughput(protTraining, 1)
+
+        print(magentaStr("\n==> Predicting %i tomograms with the simulated backend:" % N_TOMOS))
+        protPredict = self.newProtocol(ProtCryoCAREPrediction,
+                                       evenTomos=evenTomos,
+                                       oddTomos=oddTomos,
+                                       model=model,
+                                       numberOfThreads=N_THREADS,
+                                       gpuList=' '.join(N_THREADS * ['0']))  # One GPU slot per thread
+        self.assertEqual(protPredict.validate(), [])
+        self.launchProtocol(protPredict)
+        outTomos = getattr(protPredict, predictOutputs.tomograms.name, None)
+        self.assertEqual(outTomos.getSize(), N_TOMOS)
+        self.assertIn('%i/%i tomograms denoised' % (N_TOMOS, N_TOMOS), protPredict.summary()[0])
+        for outTomo in outTomos.iterItems():
+            previewFiles = getPreviewAttributes(outTomo)
+            self.assertTrue(all(os.path.exists(fn) for fn in previewFiles.values()))
+        # The output set is closed without waiting for the previews
+        stepNames = [step.funcName.get() for step in protPredict.loadSteps()]
+        self.assertLess(stepNames.index('_closeOutputSet'), stepNames.index('previewsStep'))
+        reportThroughput(protPredict, max(1, N_THREADS - 1))  # Concurrent steps
+
+    def testSubtomogramThroughput(self):
+        subtomoDir = self.getOutputPath('synthetic_subtomos')
+        makePath(subtomoDir)
+        genSyntheticTomos(subtomoDir, N_SUBTOMOS, shape=SUBTOMO_SHAPE, pattern='particle_%06d_%s.mrc')
+        halves = {}
+        for half in ('even', 'odd'):
+            protImport = self.newProtocol(ProtImportSubTomograms,
+                                          filesPath=subtomoDir,
+                                          filesPattern='*_%s.mrc' % half,
+                                          samplingRate=S_RATE)
+            protImport.setObjLabel('Import %i %s subtomograms' % (N_SUBTOMOS, half))
+            self.launchProtocol(protImport)
+            halves[half] = protImport.outputSubTomograms
+
+        model = _loadFakeModel(self)
+
+        print(magentaStr("\n==> Predicting %i subtomograms with the simulated backend:" % N_SUBTOMOS))
+        protPredict = self.newProtocol(ProtCryoCAREPredictSubtomos,
+                                       evenTomos=halves['even'],
+                                       oddTomos=halves['odd'],
+                                       model=model,
+                                       batchSize=SUBTOMOS_PER_BATCH,
+                                       numberOfThreads=N_THREADS,
+                                       gpuList=' '.join(N_THREADS * ['0']))
+        self.launchProtocol(protPredict)
+        outSubtomos = getattr(protPredict, subtomoOutputs.subtomograms.name, None)
+        self.assertEqual(outSubtomos.getSize(), N_SUBTOMOS)
+        for inSubtomo, outSubtomo in zip(halves['even'], outSubtomos):
+            self.assertEqual(inSubtomo.getObjId(), outSubtomo.getObjId())
+            self.assertEqual(outSubtomo.getDimensions(), SUBTOMO_SHAPE)
+        self.assertIn('%i/%i subtomograms denoised' % (N_SUBTOMOS, N_SUBTOMOS), protPredict.summary()[0])
+        reportThroughput(protPredict, max(1, N_THREADS - 1))
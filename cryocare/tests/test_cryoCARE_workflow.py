@@ -34,6 +34,7 @@ from cryocare.protocols.protocol_training import Outputobjects as trainOutputs,
 from cryocare.protocols.protocol_predict import Outputobjects as predictOutputs, ProtCryoCAREPrediction
 from cryocare.constants import TRAIN_DATA_FN, VALIDATION_DATA_FN, CRYOCARE_MODEL_TGZ
 from cryocare.objects import CryocareModel
+from cryocare.utils import getModelInfoFile
 from tomo.tests.test_base_centralized_layer import TestBaseCentralizedLayer
 
 
@@ -75,6 +76,8 @@ class TestCryoCARE(TestBaseCentralizedLayer):
         # Check generated model
         self.assertEqual(type(cryoCareModel), CryocareModel)
         self.assertEqual(cryoCareModel.getPath(), protTraining._getExtraPath(CRYOCARE_MODEL_TGZ))
+        self.assertEqual(cryoCareModel.getPatchSize(), patchSize)
+        self.assertTrue(exists(getModelInfoFile(cryoCareModel.getPath())))
         # Check files and links generated
         self.assertTrue(exists(protTraining._getExtraPath('train_config.json')))
         self.assertTrue(exists(join(protTraining._getTrainDataDir(), TRAIN_DATA_FN)))
@@ -85,13 +88,16 @@ class TestCryoCARE(TestBaseCentralizedLayer):
         print(magentaStr("\n==> Loading a pre-trained model:"))
         protImportTM = self.newProtocol(
             ProtCryoCARELoadModel,
-            trainDataModel=self.dataset.getFile(DataSetCryoCARE.training_data_model.name),
-            trainDataDir=self.dataset.getFile(DataSetCryoCARE.training_data_dir.name))
+            trainDataModel=self.dataset.getFile(DataSetCryoCARE.training_data_model.name))
         protImportTM = self.launchProtocol(protImportTM)
         cryoCareModel = getattr(protImportTM, loadTrainingModelOutputs.model.name, None)
         self.assertEqual(type(cryoCareModel), CryocareModel)
         self.assertEqual(cryoCareModel.getPath(), protImportTM._getExtraPath(CRYOCARE_MODEL_TGZ))
-        self.assertEqual(cryoCareModel.getTrainDataDir(), protImportTM._getExtraPath())
+        self.assertIsNone(cryoCareModel.getTrainDataDir())
+        # The normalization is read from the model itself, so no training data is required to predict
+        self.assertIsNotNone(cryoCareModel.getMean())
+        self.assertIsNotNone(cryoCareModel.getStd())
+        self.assertTrue(exists(getModelInfoFile(cryoCareModel.getPath())))
         return protImportTM
 
     def _runPredict(self, evenTomos, oddTomos, model, displayText=None):
@@ -0,0 +1,74 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import subprocess
+import sys
+import unittest
+
+# Scipion imports all the installed plugins when the GUI or a project is opened, so the import of the protocols
+# has to stay cheap. The dependencies that Scipion loads anyway (pwem and tomo) are imported first, so only the
+# cost added by this plugin is measured
+PRELOADED_MODULES = 'pwem.protocols, tomo.objects'
+PLUGIN_MODULES = 'cryocare.protocols'
+IMPORT_BUDGET_US = int(os.environ.get('CRYOCARE_IMPORT_BUDGET_US', 50000))
+N_RUNS = 3
+# Modules that must only be imported when the steps are executed
+DEFERRED_MODULES = ['tarfile', 'tensorflow', 'csbdeep']
+
+
+def getPluginImportTimes():
+    """Run the plugin import in a new interpreter with -X importtime. A dictionary {module: self time (us)} of the
+    modules imported by the plugin, excluding the preloaded ones, is returned."""
+    cmd = [sys.executable, '-X', 'importtime', '-c', 'import %s; import %s' % (PRELOADED_MODULES, PLUGIN_MODULES)]
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    proc = subprocess.run(cmd, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, env=env, check=True,
+                          universal_newlines=True)
+    lines = [line for line in proc.stderr.splitlines() if line.startswith('import time:')]
+    lastPreloaded = PRELOADED_MODULES.split(', ')[-1]
+    pluginLines = []
+    for i, line in enumerate(lines):
+        if line.split('|')[-1].strip() == lastPreloaded:
+            pluginLines = lines[i + 1:]
+    importTimes = {}
+    for line in pluginLines:
+        selfTime, _, module = line[len('import time:'):].split('|')
+        importTimes[module.strip()] = int(selfTime)
+    return importTimes
+
+
+class TestImportTime(unittest.TestCase):
+
+    def testImportBudget(self):
+        # The minimum of several runs is used to filter out the noise
+        totalTimes = [sum(getPluginImportTimes().values()) for _ in range(N_RUNS)]
+        self.assertLess(min(totalTimes), IMPORT_BUDGET_US,
+                        'Importing the cryoCARE plugin takes %i us (budget is %i us)'
+                        % (min(totalTimes), IMPORT_BUDGET_US))
+
+    def testDeferredImports(self):
+        importedModules = getPluginImportTimes().keys()
+        for module in DEFERRED_MODULES:
+            self.assertNotIn(module, importedModules, '%s must not be imported when loading the plugin' % module)
@@ -0,0 +1,115 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+from os.path import join, exists
+
+from cryocare.lifecycle import (KEEP_DAYS, KEEP_FINAL, DAY_SECONDS, removeIntermediates, getReclaimableSize,
+                                linkFinal, getReferencedPaths, writeRecord, readRecord, sweepExpired)
+
+SIZE = 1000
+
+
+def genFile(fileName, size=SIZE):
+    os.makedirs(os.path.dirname(fileName), exist_ok=True)
+    with open(fileName, 'wb') as f:
+        f.write(b'\x00' * size)
+    return fileName
+
+
+class TestLifecycle(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpDir)
+        # Working directory of a run: intermediate data and a final product inside an intermediate directory
+        self.workingDir = join(self.tmpDir, 'Runs', '000002_ProtCryoCAREPrediction')
+        self.extra = join(self.workingDir, 'extra')
+        self.configDir = join(self.extra, 'predict_config')
+        self.denoisedDir = join(self.extra, 'TS_01_denoised')
+        genFile(join(self.configDir, 'TS_01.json'))
+        genFile(join(self.configDir, 'TS_02.json'))
+        self.final = genFile(join(self.denoisedDir, 'TS_01.mrc'))
+        self.partial = genFile(join(self.denoisedDir, 'partial', 'TS_01.mrc'))
+        self.intermediates = [self.configDir, self.denoisedDir, join(self.extra, 'missing')]
+
+    def testRemove(self):
+        reclaimed = removeIntermediates(self.intermediates, [self.final])
+        self.assertEqual(reclaimed, 3 * SIZE)
+        self.assertFalse(exists(self.configDir))
+        self.assertFalse(exists(self.partial))
+        self.assertTrue(exists(self.final))
+
+    def testProtectedDir(self):
+        # Nothing inside a protected directory is removed
+        self.assertEqual(removeIntermediates([self.final, self.partial], [self.denoisedDir]), 0)
+        self.assertTrue(exists(self.partial))
+
+    def testHardLinks(self):
+        linked = join(self.tmpDir, 'linked.mrc')
+        self.assertEqual(linkFinal(self.final, linked), 'hard link')
+        self.assertTrue(exists(self.final))
+        # The data of the files with other links is not freed
+        self.assertEqual(getReclaimableSize(self.denoisedDir), SIZE)
+        self.assertEqual(removeIntermediates([self.denoisedDir], []), SIZE)
+        with open(linked, 'rb') as f:
+            self.assertEqual(len(f.read()), SIZE)
+
+    def testExpiration(self):
+        runsDir = join(self.tmpDir, 'Runs')
+        writeRecord(self.workingDir, KEEP_DAYS, paths=self.intermediates, finalPaths=[self.final], days=2)
+        self.assertEqual(sweepExpired(runsDir), [])
+        self.assertEqual(sweepExpired(runsDir, now=time.time() + 3 * DAY_SECONDS, exclude=self.workingDir), [])
+        swept = sweepExpired(runsDir, now=time.time() + 3 * DAY_SECONDS)
+        self.assertEqual(swept, [(self.workingDir, 3 * SIZE)])
+        self.assertTrue(exists(self.final))
+        record = readRecord(self.workingDir)
+        self.assertEqual((record['paths'], record['reclaimed']), ([], 3 * SIZE))
+        # Already swept
+        self.assertEqual(sweepExpired(runsDir, now=time.time() + 3 * DAY_SECONDS), [])
+
+    def testReferencedPaths(self):
+        projectDb = join(self.tmpDir, 'project.sqlite')
+        with sqlite3.connect(projectDb) as conn:
+            conn.execute('CREATE TABLE Objects (id INTEGER PRIMARY KEY, parent_id INTEGER, name TEXT, '
+                         'classname TEXT, value TEXT)')
+            conn.executemany('INSERT INTO Objects VALUES (?, ?, ?, ?, ?)',
+                             [(1, None, '5.outputModel', 'CryocareModel', None),
+                              (2, 1, '5.1._model_file', 'String', self.final),
+                              (3, 1, '5.1._train_data_dir', 'String', None),
+                              (4, None, '6.Tomograms', 'SetOfTomograms', None),
+                              (5, 4, '6.4._model_file', 'String', 'other')])
+        self.assertEqual(getReferencedPaths(projectDb), [self.final])
+        self.assertEqual(getReferencedPaths(join(self.tmpDir, 'missing.sqlite')), [])
+        # The files referenced are protected, as the final ones
+        writeRecord(self.workingDir, KEEP_FINAL, paths=[self.denoisedDir], days=0)
+        sweepExpired(join(self.tmpDir, 'Runs'), getReferencedPaths(projectDb))
+        self.assertTrue(exists(self.final))
+        self.assertFalse(exists(self.partial))
@@ -0,0 +1,68 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+from cryocare.manifest import CompletionManifest, getConfigHash
+
+
+class TestCompletionManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpDir)
+        self.manifestFile = join(self.tmpDir, 'manifest.jsonl')
+        self.outFile = join(self.tmpDir, 'TS_01.mrc')
+        with open(self.outFile, 'wb') as f:
+            f.write(b'\x00' * 1024)
+        self.configHash = getConfigHash({'even': 'TS_01_even.mrc', 'gpu_id': 0}, ignoredKeys=['gpu_id'])
+
+    def testResume(self):
+        CompletionManifest(self.manifestFile).add('TS_01', self.configHash, self.outFile)
+        # A new instance, as when the protocol is continued, reads the completed items from disk
+        manifest = CompletionManifest(self.manifestFile)
+        self.assertTrue(manifest.isDone('TS_01', self.configHash))
+        self.assertFalse(manifest.isDone('TS_02', self.configHash))
+        self.assertFalse(manifest.isDone('TS_01', getConfigHash({'even': 'other.mrc'})))
+        # Changed outputs are not considered complete
+        with open(self.outFile, 'ab') as f:
+            f.write(b'\x00')
+        self.assertFalse(manifest.isDone('TS_01', self.configHash))
+
+    def testGpuIgnoredInHash(self):
+        self.assertEqual(self.configHash,
+                         getConfigHash({'even': 'TS_01_even.mrc', 'gpu_id': 3}, ignoredKeys=['gpu_id']))
+
+    def testPartialLine(self):
+        # Simulate a crash while a record was being written
+        with open(self.manifestFile, 'w') as f:
+            f.write('{"id": "TS_00", "config_')
+        CompletionManifest(self.manifestFile).add('TS_01', self.configHash, self.outFile)
+        manifest = CompletionManifest(self.manifestFile)
+        self.assertIsNone(manifest.get('TS_00'))
+        self.assertTrue(manifest.isDone('TS_01', self.configHash))
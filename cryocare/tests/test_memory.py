@@ -0,0 +1,77 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import unittest
+
+from cryocare.memory import getUNetParams, estimateTrainingMemory, getLargestBatchSize, getDeepestUNet, GB
+from cryocare.protocols import ProtCryoCARETraining
+
+
+class TestTrainingMemory(unittest.TestCase):
+
+    def testUNetParams(self):
+        # Depth 1 and 2 initial filters: convolutions 1->2, 2->2, 2->4, 4->2, (2+2)->2, 2->2 and 1x1x1 2->1
+        self.assertEqual(getUNetParams(1, 2, 3), 56 + 110 + 220 + 218 + 218 + 110 + 3)
+        self.assertGreater(getUNetParams(3, 16, 3), getUNetParams(2, 16, 3))
+
+    def testEstimate(self):
+        memory = estimateTrainingMemory(72, 2, 16, 3, 16)
+        self.assertEqual(memory['activations'], 2 * estimateTrainingMemory(72, 2, 16, 3, 8)['activations'])
+        self.assertEqual(memory['parameters'], estimateTrainingMemory(72, 2, 16, 3, 8)['parameters'])
+        self.assertGreater(memory['total'], memory['activations'] + memory['parameters'])
+
+    def testLargestBatchSize(self):
+        budget = 8 * GB
+        batchSize = getLargestBatchSize(72, 2, 16, 3, budget)
+        self.assertLessEqual(estimateTrainingMemory(72, 2, 16, 3, batchSize)['total'], budget)
+        self.assertGreater(estimateTrainingMemory(72, 2, 16, 3, batchSize + 1)['total'], budget)
+        self.assertEqual(getLargestBatchSize(72, 2, 16, 3, 0.1 * GB), 0)
+
+    def testDeepestUNet(self):
+        # 72 is not divisible by 2^4
+        self.assertEqual(getDeepestUNet(72, 16, 3, 1, 100 * GB), 3)
+        self.assertEqual(getDeepestUNet(128, 16, 3, 1, 100 * GB), 4)
+        self.assertIsNone(getDeepestUNet(128, 16, 3, 64, 1 * GB))
+
+
+class TestTrainingProtocolMemory(unittest.TestCase):
+
+    def setUp(self):
+        self.prot = ProtCryoCARETraining()
+
+    def testUNetDepthFromPatchSize(self):
+        for patchSize, netDepth in [(72, 2), (96, 3), (128, 4), (136, 3)]:
+            self.prot.patch_shape.set(patchSize)
+            self.assertEqual(self.prot._getUNetDepth(), netDepth)
+
+    def testAutomaticBatchSize(self):
+        self.prot.batch_size.set(0)
+        self.assertEqual(self.prot._getBatchSize(), 16)
+        self.prot.gpuMemory.set(11)
+        batchSize = self.prot._getBatchSize()
+        self.assertLessEqual(self.prot._getMemoryEstimate()['total'], 11 * GB)
+        # The global batch is split among the GPUs
+        self.prot.gpuList.set('0 1')
+        self.assertEqual(self.prot._getBatchSize(), 2 * batchSize)
@@ -0,0 +1,76 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+from cryocare.constants import CRYOCARE_MODEL_TGZ
+from cryocare.tests import genFakeModel
+from cryocare.utils import readModelInfo, checkModelInfo, checkModelArchive, storeModel, getFileHash
+
+
+class TestModelIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpDir)
+        self.modelFile = join(self.tmpDir, CRYOCARE_MODEL_TGZ)
+
+    def testIndex(self):
+        genFakeModel(self.modelFile)
+        modelInfo = readModelInfo(self.modelFile, patchSize=72)
+        self.assertEqual(modelInfo['hash'], getFileHash(self.modelFile))
+        self.assertEqual((modelInfo['mean'], modelInfo['std'], modelInfo['patch_size']), (0.5, 2.0, 72))
+        self.assertEqual(modelInfo['config']['unet_n_depth'], 3)
+        self.assertEqual(len(modelInfo['members']), 4)
+        self.assertEqual(len(modelInfo['member_hashes']), 3)  # config, norm and weights
+        self.assertEqual(checkModelInfo(modelInfo), [])
+
+    def testMissingNorm(self):
+        genFakeModel(self.modelFile, withNorm=False)
+        self.assertEqual(len(checkModelInfo(readModelInfo(self.modelFile))), 1)
+
+    def testCheckArchive(self):
+        genFakeModel(self.modelFile)
+        self.assertEqual(checkModelArchive(self.modelFile), [])
+        genFakeModel(self.modelFile, withNorm=False)
+        self.assertEqual(len(checkModelArchive(self.modelFile)), 1)
+        with open(self.modelFile, 'wb') as f:
+            f.write(b'not a model')
+        self.assertEqual(len(checkModelArchive(self.modelFile)), 1)
+
+    def testStoreDeduplication(self):
+        storeDir = join(self.tmpDir, 'store')
+        genFakeModel(self.modelFile)
+        otherModelFile = join(self.tmpDir, 'copy.tar.gz')
+        with open(self.modelFile, 'rb') as fIn, open(otherModelFile, 'wb') as fOut:
+            fOut.write(fIn.read())
+        stored1 = storeModel(self.modelFile, readModelInfo(self.modelFile), storeDir)
+        stored2 = storeModel(otherModelFile, readModelInfo(otherModelFile), storeDir)
+        self.assertEqual(stored1, stored2)
+        self.assertEqual(len([fn for fn in os.listdir(os.path.dirname(stored1)) if fn.endswith('.tar.gz')]), 1)
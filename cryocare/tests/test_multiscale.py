@@ -0,0 +1,121 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join, exists
+
+import mrcfile
+import numpy as np
+
+from cryocare import Plugin
+from cryocare.constants import CRYOCARE_SIMULATE
+from cryocare.multiscale import (getLevelShapes, getMultiscaleAttribute, getMultiscaleFile, isMultiscaleDone,
+                                 readMultiscaleLevel, writeMultiscale)
+from cryocare.protocols.protocol_predict import Outputobjects as predictOutputs, ProtCryoCAREPrediction
+from cryocare.tests import genSyntheticTomos, _importHalvesAndModel
+from pyworkflow.tests import BaseTest, setupTestProject
+from pyworkflow.utils import makePath
+
+VOL_SHAPE = (40, 70, 50)  # (z, y, x), not multiple of the chunk size
+CHUNK_SIZE = 16
+
+
+class TestMultiscale(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpDir)
+        self.data = np.random.default_rng(0).normal(size=VOL_SHAPE).astype(np.float32)
+        self.volFile = join(self.tmpDir, 'TS_01.mrc')
+        with mrcfile.new(self.volFile) as mrc:
+            mrc.set_data(self.data)
+            mrc.voxel_size = 2.5
+
+    def testLevelShapes(self):
+        self.assertEqual(getLevelShapes(VOL_SHAPE), [(40, 70, 50), (20, 35, 25), (10, 18, 13), (5, 9, 7)])
+
+    def testWrite(self):
+        path = getMultiscaleFile(self.volFile)
+        self.assertEqual(path, join(self.tmpDir, 'TS_01.ome.zarr'))
+        writeMultiscale(self.volFile, path, chunkSize=CHUNK_SIZE, nThreads=2)
+        self.assertTrue(isMultiscaleDone(path))
+        self.assertFalse([fn for fn in os.listdir(self.tmpDir) if fn.endswith('.tmp')])
+
+        with open(join(path, '.zattrs')) as f:
+            multiscales = json.load(f)['multiscales'][0]
+        self.assertEqual([ax['name'] for ax in multiscales['axes']], ['z', 'y', 'x'])
+        self.assertEqual([ds['coordinateTransformations'][0]['scale'][0] for ds in multiscales['datasets']],
+                         [2.5, 5., 10., 20.])
+        for level, shape in enumerate(getLevelShapes(VOL_SHAPE)):
+            with open(join(path, str(level), '.zarray')) as f:
+                self.assertEqual(json.load(f)['shape'], list(shape))
+
+        np.testing.assert_array_equal(readMultiscaleLevel(path), self.data)
+        # Bin 2 is the average of each 2x2x2 voxels
+        binned = self.data.reshape(20, 2, 35, 2, 25, 2).mean(axis=(1, 3, 5))
+        np.testing.assert_allclose(readMultiscaleLevel(path, 1), binned, rtol=1e-5, atol=1e-6)
+        self.assertEqual(readMultiscaleLevel(path, 3).shape, (5, 9, 7))
+        # Regions are read from the chunks they overlap
+        region = (slice(10, 30), slice(15, 60), slice(40, None))
+        np.testing.assert_array_equal(readMultiscaleLevel(path, region=region), self.data[region])
+
+    def testChunkSize(self):
+        with self.assertRaises(ValueError):
+            writeMultiscale(self.volFile, getMultiscaleFile(self.volFile), chunkSize=20)
+
+
+@unittest.skipUnless(Plugin.isSimulated(), 'Set %s=True to run the prediction with the simulated cryoCARE backend.'
+                     % CRYOCARE_SIMULATE)
+class TestMultiscalePrediction(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.tomoDir = cls.getOutputPath('synthetic_tomos')
+        makePath(cls.tomoDir)
+        genSyntheticTomos(cls.tomoDir, 2)
+
+    def testMultiscaleOutput(self):
+        halves, model = _importHalvesAndModel(self, self.tomoDir)
+
+        protPredict = self.newProtocol(ProtCryoCAREPrediction,
+                                       evenTomos=halves['even'],
+                                       oddTomos=halves['odd'],
+                                       model=model,
+                                       multiscale=True)
+        self.launchProtocol(protPredict)
+        outTomos = getattr(protPredict, predictOutputs.tomograms.name, None)
+        self.assertEqual(outTomos.getSize(), 2)
+        for tomo in outTomos:
+            # The output is still the MRC file, with the path of its multiscale copy
+            self.assertTrue(tomo.getFileName().endswith('.mrc'))
+            path = getMultiscaleAttribute(tomo)
+            self.assertTrue(exists(path) and isMultiscaleDone(path))
+            with mrcfile.open(tomo.getFileName(), permissive=True) as mrc:
+                np.testing.assert_array_equal(readMultiscaleLevel(path), mrc.data)
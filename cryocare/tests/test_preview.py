@@ -0,0 +1,81 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+import mrcfile
+import numpy as np
+from PIL import Image
+
+from cryocare.preview import (PreviewGenerator, XY, XZ, THUMBNAIL, JPEG, getPreviewFiles, genPreviews,
+                              arePreviewsDone, getThumbnailFactor)
+
+SHAPE = (40, 60, 80)  # (z, y, x)
+
+
+class TestPreview(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpDir)
+        self.volFile = join(self.tmpDir, 'TS_01_denoised.mrc')
+        data = np.random.default_rng(0).random(SHAPE, dtype=np.float32)
+        with mrcfile.new(self.volFile) as mrc:
+            mrc.set_data(data)
+            mrc.voxel_size = 10
+
+    def testPreviews(self):
+        previewFiles = getPreviewFiles(self.volFile)
+        self.assertEqual(previewFiles[XY], join(self.tmpDir, 'TS_01_denoised_xy.png'))
+        self.assertFalse(arePreviewsDone(previewFiles))
+        genPreviews(self.volFile, previewFiles, maxSize=32)
+        self.assertTrue(arePreviewsDone(previewFiles))
+        with Image.open(previewFiles[XY]) as xy, Image.open(previewFiles[XZ]) as xz:
+            self.assertEqual(xy.size, (SHAPE[2], SHAPE[1]))  # (width, height)
+            self.assertEqual(xz.size, (SHAPE[2], SHAPE[0]))
+        with mrcfile.open(previewFiles[THUMBNAIL]) as mrc:
+            self.assertEqual(mrc.data.shape, (13, 20, 26))  # Binned by 3
+            self.assertAlmostEqual(float(mrc.voxel_size.x), 30)
+
+    def testThumbnailFactor(self):
+        self.assertEqual(getThumbnailFactor((100, 100, 50)), 1)
+        self.assertEqual(getThumbnailFactor((4096, 4096, 1000)), 16)
+        self.assertEqual(getThumbnailFactor((1000, 900, 300)), 4)
+
+    def testGenerator(self):
+        generator = PreviewGenerator(nWorkers=2, maxSize=32)
+        self.addCleanup(generator.close)
+        previewFiles = getPreviewFiles(self.volFile, JPEG)
+        generator.submit('TS_01', self.volFile, previewFiles)
+        generator.submit('missing', join(self.tmpDir, 'missing.mrc'),
+                         getPreviewFiles(join(self.tmpDir, 'missing.mrc')))
+        failed = generator.wait()
+        self.assertEqual(list(failed), ['missing'])
+        self.assertTrue(arePreviewsDone(previewFiles))
+        with Image.open(previewFiles[XY]) as xy:
+            self.assertEqual(xy.format, 'JPEG')
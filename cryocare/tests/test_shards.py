@@ -0,0 +1,126 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join, exists, getsize
+
+import numpy as np
+
+from cryocare.constants import TRAIN_DATA_FN, VALIDATION_DATA_FN, TRAIN_DATA_SHARDS_FN
+from cryocare.protocols.protocol_training import ProtCryoCARETraining
+from cryocare.shards import (writeShards, readShardsHeader, ShardArray, loadShards, isCodecAvailable, FLOAT16,
+                             FLOAT32, ZLIB, ZSTD, BLOSC, NO_CODEC)
+from cryocare.tests.test_traindata import genTrainData
+from cryocare.traindata import compressTrainData, openTrainData, getTrainDataParts, getTrainDataNorm, \
+    materializeTrainData, removeMaterializedData, needsMaterialization
+
+SHAPE = (50, 6, 6, 6, 1)
+
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpDir)
+        self.data = np.random.default_rng(0).normal(size=SHAPE).astype(np.float32)
+
+    def _write(self, precision, codec, name='data.shards'):
+        fileName = join(self.tmpDir, name)
+        errors = writeShards({'X': self.data, 'mean': 1.5}, fileName, precision, codec, chunkPatches=8, nThreads=3)
+        return fileName, errors
+
+    def testLossless(self):
+        for codec in (NO_CODEC, ZLIB):
+            fileName, errors = self._write(FLOAT32, codec)
+            self.assertEqual(errors['X']['max'], 0)
+            array = ShardArray(fileName, 'X')
+            self.assertEqual(array.shape, SHAPE)
+            np.testing.assert_array_equal(array[:], self.data)
+            np.testing.assert_array_equal(array[5:21], self.data[5:21])  # Across chunks
+            np.testing.assert_array_equal(array[-1], self.data[-1])
+            np.testing.assert_array_equal(array[[40, 3, 41]], self.data[[40, 3, 41]])
+            np.testing.assert_array_equal(array[::7], self.data[::7])
+            np.testing.assert_array_equal(np.concatenate(list(array.iterChunks(chunkBytes=1))), self.data)
+            with self.assertRaises(IndexError):
+                array[50]
+            array.close()
+        self.assertEqual(loadShards(fileName)['mean'], 1.5)
+
+    def testHalfPrecision(self):
+        fileName, errors = self._write(FLOAT16, NO_CODEC)
+        plainFile, _ = self._write(FLOAT32, NO_CODEC, 'plain.shards')
+        self.assertLess(getsize(fileName), 0.6 * getsize(plainFile))
+        # The round-trip error measured is the actual one
+        decoded = loadShards(fileName)['X']
+        self.assertAlmostEqual(errors['X']['max'], float(np.abs(decoded - self.data).max()), places=6)
+        self.assertLess(errors['X']['max'], 5e-3)
+        self.assertEqual(readShardsHeader(fileName)['errors'], errors)
+
+    @unittest.skipUnless(isCodecAvailable(ZSTD) and isCodecAvailable(BLOSC), 'zstandard and blosc are needed.')
+    def testOptionalCodecs(self):
+        for codec in (ZSTD, BLOSC):
+            fileName, _ = self._write(FLOAT16, codec)
+            np.testing.assert_allclose(loadShards(fileName)['X'], self.data, atol=5e-3)
+
+    def testUnknownCodec(self):
+        with self.assertRaises(ValueError):
+            writeShards({'X': self.data}, join(self.tmpDir, 'data.shards'), FLOAT32, 'lz4')
+
+    def testCompressTrainData(self):
+        trainDataDir = join(self.tmpDir, 'train_data')
+        genTrainData(trainDataDir, 30, 5, 2.0, 3.0, 0)
+        expected = openTrainData(trainDataDir)['Y'][:]
+        errors = compressTrainData(trainDataDir, FLOAT16, ZLIB, nThreads=2)
+        self.assertLess(errors['val']['X']['max'], 5e-3)
+        self.assertFalse(exists(join(trainDataDir, TRAIN_DATA_FN)))
+        self.assertTrue(exists(join(trainDataDir, TRAIN_DATA_SHARDS_FN)))
+        self.assertTrue(needsMaterialization(trainDataDir))
+        self.assertEqual([(part['train'], part['val'], part['patch_size']) for part in getTrainDataParts(trainDataDir)],
+                         [(30, 5, 4)])
+        self.assertAlmostEqual(getTrainDataNorm(trainDataDir)[0], 2.0)
+        np.testing.assert_allclose(openTrainData(trainDataDir)['Y'][:], expected, atol=5e-3)
+
+        # Written for cryoCARE while training, the shards are kept
+        materializeTrainData(trainDataDir, trainDataDir)
+        with np.load(join(trainDataDir, VALIDATION_DATA_FN)) as data:
+            self.assertEqual(data['X'].shape, (5, 4, 4, 4, 1))
+        removeMaterializedData(trainDataDir)
+        self.assertEqual(sorted(os.listdir(trainDataDir)), ['train_data.shards', 'val_data.shards'])
+
+    def testCombineTrainDataFiles(self):
+        np.savez(join(self.tmpDir, 'a_part.npz'), X=self.data[:25], mean=1.5)
+        writeShards({'X': self.data[25:], 'mean': 1.5}, join(self.tmpDir, 'b_part.shards'), FLOAT32, ZLIB)
+        outFile = join(self.tmpDir, 'combined.npz')
+        ProtCryoCARETraining._combineTrainDataFiles(join(self.tmpDir, '*_part.*'), outFile)
+        with np.load(outFile) as combined:
+            self.assertEqual(sorted(combined.files), ['X', 'mean'])
+            np.testing.assert_array_equal(np.sort(combined['X'], axis=None), np.sort(self.data, axis=None))
+        # A single shards file is decoded too
+        ProtCryoCARETraining._combineTrainDataFiles(join(self.tmpDir, 'b_part.shards'), outFile)
+        with np.load(outFile) as combined:
+            np.testing.assert_array_equal(combined['X'][0], self.data[25:])
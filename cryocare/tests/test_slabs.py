@@ -0,0 +1,140 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join, exists
+
+import mrcfile
+import numpy as np
+
+from cryocare import Plugin
+from cryocare.constants import CRYOCARE_SIMULATE
+from cryocare.protocols.protocol_predict import Outputobjects as predictOutputs, ProtCryoCAREPrediction
+from cryocare.slabs import getSlabs, extractSlab, stitchSlabs
+from cryocare.tests import genSyntheticTomos, _importHalvesAndModel
+from pyworkflow.tests import BaseTest, setupTestProject
+from pyworkflow.utils import makePath
+
+TOMO_SHAPE = (24, 40, 150)  # (z, y, x). Split along x
+CHUNK_BYTES = 4 * 40 * 150 * 5  # 5 slices, to stitch by chunks
+
+
+class TestSlabs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpDir)
+
+    def _splitAndStitch(self, data, slabs, predict):
+        volFile = join(self.tmpDir, 'vol.mrc')
+        with mrcfile.new(volFile, overwrite=True) as mrc:
+            mrc.set_data(data)
+            mrc.voxel_size = 4.5
+        slabFiles = []
+        for i, slab in enumerate(slabs):
+            slabFile = extractSlab(volFile, join(self.tmpDir, 'slab%i.mrc' % i), slab, chunkBytes=CHUNK_BYTES)
+            with mrcfile.mmap(slabFile, mode='r+') as mrc:
+                mrc.data[:] = predict(i, mrc.data)
+            slabFiles.append(slabFile)
+        outFile = stitchSlabs(slabFiles, slabs, data.shape, join(self.tmpDir, 'out.mrc'), chunkBytes=CHUNK_BYTES)
+        self.assertFalse([fn for fn in os.listdir(self.tmpDir) if fn.endswith('.tmp')])
+        with mrcfile.open(outFile) as mrc:
+            self.assertEqual(float(mrc.voxel_size.x), 4.5)
+            return mrc.data.copy()
+
+    def testGetSlabs(self):
+        slabs = getSlabs(TOMO_SHAPE, 3, overlap=8)
+        self.assertEqual([slab.toList() for slab in slabs],
+                         [[2, 0, 58, 0, 50], [2, 42, 108, 50, 100], [2, 92, 150, 100, 150]])
+        self.assertEqual(slabs[1].getShape(TOMO_SHAPE), (24, 40, 66))
+        # The cores are never shorter than twice the overlap
+        self.assertEqual(len(getSlabs(TOMO_SHAPE, 20, overlap=8)), 9)
+        self.assertEqual(len(getSlabs((8, 8, 8), 4, overlap=8)), 1)
+        # Along the longest axis
+        self.assertEqual(getSlabs((100, 40, 60), 2)[0].axis, 0)
+        # The blending weights add up to 1
+        weights = np.zeros(TOMO_SHAPE[2])
+        for slab in slabs:
+            weights[slab.start:slab.stop] += slab.getWeights()
+        np.testing.assert_allclose(weights, 1)
+
+    def testStitch(self):
+        # A voxel-wise predictor (as the stand-in one) gives the same output as predicting the whole volume
+        rng = np.random.default_rng(0)
+        for shape, nSlabs in ((TOMO_SHAPE, 3), ((60, 20, 30), 4)):  # Along x and along z
+            volume = rng.normal(size=shape).astype(np.float32)
+            stitched = self._splitAndStitch(volume, getSlabs(shape, nSlabs, overlap=4), lambda i, slab: 2 * slab)
+            np.testing.assert_allclose(stitched, 2 * volume, rtol=1e-6, atol=1e-6)
+
+    def testBlending(self):
+        # Slabs predicted as constants: the output ramps linearly from one to the next across the overlaps
+        slabs = getSlabs(TOMO_SHAPE, 3, overlap=8)
+        stitched = self._splitAndStitch(np.zeros(TOMO_SHAPE, dtype=np.float32), slabs,
+                                        lambda i, slab: np.full(slab.shape, i))
+        profile = stitched[0, 0]
+        np.testing.assert_array_equal(profile[:42], 0)
+        np.testing.assert_array_equal(profile[58:92], 1)
+        np.testing.assert_array_equal(profile[108:], 2)
+        np.testing.assert_allclose(profile[42:58], (np.arange(16) + 0.5) / 16)
+        self.assertTrue(np.all(np.diff(profile[92:108]) > 0))
+
+
+@unittest.skipUnless(Plugin.isSimulated(), 'Set %s=True to run the prediction with the simulated cryoCARE backend.'
+                     % CRYOCARE_SIMULATE)
+class TestSlabPrediction(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.tomoDir = cls.getOutputPath('synthetic_tomos')
+        makePath(cls.tomoDir)
+        genSyntheticTomos(cls.tomoDir, 1, shape=TOMO_SHAPE)
+
+    def testSlabPrediction(self):
+        halves, model = _importHalvesAndModel(self, self.tomoDir)
+
+        protPredict = self.newProtocol(ProtCryoCAREPrediction,
+                                       evenTomos=halves['even'],
+                                       oddTomos=halves['odd'],
+                                       model=model,
+                                       nSlabs=3,
+                                       slabOverlap=8,
+                                       numberOfThreads=4)
+        self.launchProtocol(protPredict)
+        outTomos = getattr(protPredict, predictOutputs.tomograms.name, None)
+        self.assertEqual(outTomos.getSize(), 1)
+        self.assertEqual(len([step for step in protPredict.loadSteps() if step.funcName == 'predictSlabStep']), 3)
+
+        # The stand-in predictor averages the even/odd tomograms voxel-wise, so the stitched slabs are the same
+        tomo = outTomos.getFirstItem()
+        with mrcfile.open(tomo.getFileName(), permissive=True) as mrcOut, \
+                mrcfile.open(join(self.tomoDir, 'TS_00000_even.mrc'), permissive=True) as mrcEven, \
+                mrcfile.open(join(self.tomoDir, 'TS_00000_odd.mrc'), permissive=True) as mrcOdd:
+            np.testing.assert_allclose(mrcOut.data, (mrcEven.data + mrcOdd.data) / 2, rtol=1e-6, atol=1e-6)
+        self.assertFalse(exists(protPredict._getSlabsDir(tomo.getTsId())))
+        self.assertTrue(any('slabs' in line for line in protPredict.summary()))
@@ -0,0 +1,78 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join, exists
+
+from cryocare.staging import ScratchStager
+
+FILE_SIZE = 1000
+
+
+class TestScratchStager(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpDir)
+        self.files = {}
+        for key in ('TS_01', 'TS_02', 'TS_03'):
+            self.files[key] = []
+            for half in ('even', 'odd'):
+                fn = join(self.tmpDir, '%s_%s.mrc' % (key, half))
+                with open(fn, 'wb') as f:
+                    f.write(os.urandom(FILE_SIZE))
+                self.files[key].append(fn)
+        # Room for the halves of two tomograms
+        self.stager = ScratchStager(join(self.tmpDir, 'scratch'), 4 * FILE_SIZE)
+
+    def testStageAndEvict(self):
+        staged1 = self.stager.get('TS_01', self.files['TS_01'])
+        self.assertNotEqual(staged1, self.files['TS_01'])
+        self.assertTrue(all(exists(fn) for fn in staged1))
+        self.stager.prefetch('TS_02', self.files['TS_02'])
+        # TS_01 is in use and TS_02 about to be used, so TS_03 does not fit and is read from its original location
+        self.assertEqual(self.stager.get('TS_03', self.files['TS_03']), self.files['TS_03'])
+        # Once released, TS_01 is the least recently used one and is evicted
+        self.stager.release('TS_01')
+        self.stager.release('TS_03')
+        staged3 = self.stager.get('TS_03', self.files['TS_03'])
+        self.assertNotEqual(staged3, self.files['TS_03'])
+        self.assertFalse(any(exists(fn) for fn in staged1))
+        self.assertLessEqual(self.stager.getUsedSize(), 4 * FILE_SIZE)
+
+    def testMoveBack(self):
+        outDir = self.stager.getOutputDir('TS_01')
+        os.makedirs(outDir)
+        src, dst = join(outDir, 'out.mrc'), join(self.tmpDir, 'final', 'out.mrc')
+        shutil.copyfile(self.files['TS_01'][0], src)
+        done = []
+        self.stager.moveAsync(src, dst, onDone=lambda: done.append(dst)).result()
+        self.assertTrue(exists(dst))
+        self.assertEqual(done, [dst])
+        self.stager.close()
+        self.assertFalse(exists(outDir))
@@ -0,0 +1,116 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join
+from unittest.mock import patch
+
+from cryocare import Plugin
+from cryocare.constants import CRYOCARE_SIMULATE, TILING_FN
+from cryocare.protocols.protocol_predict import Outputobjects as predictOutputs, ProtCryoCAREPrediction
+from cryocare.simulator.simcommon import SIM_MAX_TILE_VOXELS
+from cryocare.tests import genSyntheticTomos, _importHalvesAndModel
+from cryocare.tiling import TilingMemory, escalateTiling, getTilingLadder, isOutOfMemory
+from pyworkflow.tests import BaseTest, setupTestProject
+from pyworkflow.utils import makePath
+
+TOMO_SHAPE = (32, 128, 128)  # (z, y, x)
+MAX_TILE_VOXELS = 32 * 64 * 64  # The simulated prediction needs n_tiles 1 2 2
+
+
+class TestTiling(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpDir)
+
+    def testEscalation(self):
+        # The axis with the largest tiles is split first, down to the min. tile size
+        self.assertEqual(escalateTiling([1, 1, 1], shape=(32, 128, 256)), [1, 1, 2])
+        self.assertEqual(escalateTiling([1, 1, 2], shape=(32, 128, 256)), [1, 2, 2])
+        self.assertIsNone(escalateTiling([1, 4, 4], shape=(32, 128, 128), minTileSize=32))
+        # Without shape, x and y go first
+        self.assertEqual(escalateTiling([1, 1, 1]), [1, 1, 2])
+        self.assertEqual(escalateTiling([1, 1, 2]), [1, 2, 2])
+
+    def testLadder(self):
+        self.assertEqual(getTilingLadder([1, 1, 1], shape=TOMO_SHAPE),
+                         [[1, 1, 1], [1, 2, 1], [1, 2, 2], [1, 4, 2], [1, 4, 4]])
+        self.assertEqual(len(getTilingLadder([1, 1, 1], maxEscalations=3)), 4)
+
+    def testOutOfMemory(self):
+        self.assertTrue(isOutOfMemory('tensorflow...ResourceExhaustedError: OOM when allocating tensor', 1))
+        self.assertTrue(isOutOfMemory('', 137))
+        self.assertFalse(isOutOfMemory('FileNotFoundError: TS_01_even.mrc', 1))
+
+    def testMemory(self):
+        fileName = join(self.tmpDir, TILING_FN)
+        memory = TilingMemory(fileName)
+        self.assertEqual(memory.getStart(TOMO_SHAPE, [1, 1, 1]), [1, 1, 1])
+        memory.remember(TOMO_SHAPE, [1, 2, 2])
+        memory.remember(None, [4, 4, 4])  # Unknown shapes are not remembered
+
+        # Persisted for the continued executions
+        memory = TilingMemory(fileName)
+        self.assertEqual(memory.getAll(), {'32x128x128': [1, 2, 2]})
+        # Never fewer tiles than the configured ones
+        self.assertEqual(memory.getStart(TOMO_SHAPE, [2, 1, 1]), [2, 2, 2])
+        self.assertEqual(memory.getStart((64, 64, 64), [1, 1, 1]), [1, 1, 1])
+
+
+@unittest.skipUnless(Plugin.isSimulated(), 'Set %s=True to run the prediction with the simulated cryoCARE backend '
+                                           'running out of memory.' % CRYOCARE_SIMULATE)
+class TestAdaptiveTiling(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.tomoDir = cls.getOutputPath('synthetic_tomos')
+        makePath(cls.tomoDir)
+        genSyntheticTomos(cls.tomoDir, 2, shape=TOMO_SHAPE)
+
+    def testAdaptiveTiling(self):
+        halves, model = _importHalvesAndModel(self, self.tomoDir)
+
+        protPredict = self.newProtocol(ProtCryoCAREPrediction,
+                                       evenTomos=halves['even'],
+                                       oddTomos=halves['odd'],
+                                       model=model,
+                                       n_tiles='1 1 1')
+        with patch.dict(os.environ, {SIM_MAX_TILE_VOXELS: str(MAX_TILE_VOXELS)}):
+            self.launchProtocol(protPredict)
+        outTomos = getattr(protPredict, predictOutputs.tomograms.name, None)
+        self.assertEqual(outTomos.getSize(), 2)
+
+        # Only the first tomogram ran out of memory, the second one started with the tiling that worked
+        with open(protPredict._getExtraPath(TILING_FN)) as f:
+            self.assertEqual(json.load(f), {'32x128x128': [1, 2, 2]})
+        with open(protPredict.getLogPaths()[0]) as f:
+            self.assertEqual(f.read().count('ran out of memory'), 2)
+        self.assertTrue(any('n_tiles 1 2 2' in line for line in protPredict.summary()))
@@ -0,0 +1,136 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import unittest
+from os.path import join
+
+from cryocare.tomoindex import TomoDescriptor, buildTomoIndex, getTomoIndex
+from cryocare.volumes import readVolumeDims
+
+S_RATE = 4.0
+DIMS = (64, 48, 32)
+
+
+class FakeSet:
+    """Set of tomograms stored as the SQLite files of Scipion, with the attributes read by the index."""
+
+    def __init__(self, dbFile, columns, rows, dims=DIMS):
+        self._dbFile = dbFile
+        self._dims = dims
+        with sqlite3.connect(dbFile) as conn:
+            conn.execute('CREATE TABLE Classes (id INTEGER PRIMARY KEY, label_property TEXT, column_name TEXT)')
+            conn.executemany('INSERT INTO Classes (label_property, column_name) VALUES (?, ?)',
+                             [(attr, 'c%02d' % (i + 1)) for i, attr in enumerate(columns)])
+            conn.execute('CREATE TABLE Objects (id INTEGER PRIMARY KEY, %s)' %
+                         ', '.join('c%02d' % (i + 1) for i in range(len(columns))))
+            conn.executemany('INSERT INTO Objects VALUES (%s)' % ', '.join('?' * (len(columns) + 1)), rows)
+
+    def getFileName(self):
+        return self._dbFile
+
+    def getSamplingRate(self):
+        return S_RATE
+
+    def getDim(self):
+        return self._dims
+
+
+def genFakeMrc(fileName, dims=DIMS):
+    with open(fileName, 'wb') as f:
+        f.write(struct.pack('<3i', *dims) + b'\x00' * 1012)
+
+
+class TestTomoIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpDir)
+        self.indexFile = join(self.tmpDir, 'tomo_index.json')
+
+    def _genFiles(self, prefix, n=3):
+        fileNames = []
+        for i in range(n):
+            fileName = join(self.tmpDir, '%s_%i.mrc' % (prefix, i))
+            genFakeMrc(fileName)
+            fileNames.append(fileName)
+        return fileNames
+
+    def _genEvenOddSets(self):
+        evenFiles, oddFiles = self._genFiles('even'), self._genFiles('odd')
+        evenSet = FakeSet(join(self.tmpDir, 'even.sqlite'), ['_filename', '_samplingRate', '_tsId'],
+                          [(i + 1, fn, S_RATE, 'TS_%02d' % i) for i, fn in enumerate(evenFiles)])
+        # The tsIds of the odd set are ignored
+        oddSet = FakeSet(join(self.tmpDir, 'odd.sqlite'), ['_filename', '_samplingRate', '_tsId'],
+                         [(i + 1, fn, S_RATE, 'other_%02d' % i) for i, fn in enumerate(oddFiles)])
+        return evenSet, oddSet, evenFiles, oddFiles
+
+    def testEvenOddSets(self):
+        evenSet, oddSet, evenFiles, oddFiles = self._genEvenOddSets()
+        index = buildTomoIndex(evenSet, oddSet)
+        self.assertEqual(list(index.keys()), ['TS_00', 'TS_01', 'TS_02'])
+        desc = index['TS_01']
+        self.assertEqual((desc.objId, desc.even, desc.odd, desc.dims, desc.sRate),
+                         (2, evenFiles[1], oddFiles[1], DIMS, S_RATE))
+        self.assertFalse(hasattr(desc, '__dict__'))
+
+    def testHalfMapsSet(self):
+        evenFiles, oddFiles = self._genFiles('even'), self._genFiles('odd')
+        tomoSet = FakeSet(join(self.tmpDir, 'tomos.sqlite'), ['_filename', '_samplingRate', '_tsId', '_halfMapFilenames'],
+                          [(i + 1, 'full_%i.mrc' % i, None, 'TS_%02d' % i, '%s,%s' % (odd, even))
+                           for i, (even, odd) in enumerate(zip(evenFiles, oddFiles))])
+        index = buildTomoIndex(tomoSet)
+        self.assertEqual((index['TS_02'].even, index['TS_02'].odd), (evenFiles[2], oddFiles[2]))
+        self.assertEqual(index['TS_02'].sRate, S_RATE)  # Not stored in the items: the one of the set
+
+    def testSetDims(self):
+        # The dimensions are the ones of the set, without reading the headers of the tomograms
+        evenSet = FakeSet(join(self.tmpDir, 'even.sqlite'), ['_filename', '_samplingRate', '_tsId'],
+                          [(1, join(self.tmpDir, 'missing.mrc'), S_RATE, 'TS_00')], dims=(10, 20, 30))
+        self.assertEqual(buildTomoIndex(evenSet, evenSet)['TS_00'].dims, (10, 20, 30))
+
+    def testPersistence(self):
+        evenSet, oddSet, _, _ = self._genEvenOddSets()
+        index = getTomoIndex(self.indexFile, evenSet, oddSet)
+        self.assertTrue(os.path.exists(self.indexFile))
+        loaded = getTomoIndex(self.indexFile, evenSet, oddSet)
+        self.assertEqual([desc.toList() for desc in loaded.values()], [desc.toList() for desc in index.values()])
+        # Rebuilt if the input sets change
+        with sqlite3.connect(evenSet.getFileName()) as conn:
+            conn.execute("UPDATE Objects SET c03 = 'renamed' WHERE id = 1")
+        stat = os.stat(evenSet.getFileName())
+        os.utime(evenSet.getFileName(), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertIn('renamed', getTomoIndex(self.indexFile, evenSet, oddSet))
+
+    def testMrcDims(self):
+        fileName = join(self.tmpDir, 'tomo.mrc')
+        genFakeMrc(fileName, dims=(10, 20, 30))
+        self.assertEqual(readVolumeDims(fileName + ':mrc'), (10, 20, 30))
+        self.assertIsNone(readVolumeDims(join(self.tmpDir, 'missing.mrc')))
+        self.assertIsNone(TomoDescriptor('TS', 1, 'e', 'o', None, S_RATE).dims)
@@ -0,0 +1,243 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join, exists
+
+import mrcfile
+import numpy as np
+
+from cryocare import Plugin
+from cryocare.constants import CRYOCARE_SIMULATE, TRAIN_DATA_FN, VALIDATION_DATA_FN, TRAIN_DATA_MANIFEST_FN, \
+    TRAIN_COORDS_FN, TRAIN_DATA_SHARDS_FN, VALIDATION_DATA_SHARDS_FN
+from cryocare.lifecycle import expandProtected
+from cryocare.protocols import ProtCryoCAREExtractTrainData
+from cryocare.protocols.protocol_extract_train_data import Outputobjects as extractOutputs
+from cryocare.protocols.protocol_training import Outputobjects as trainOutputs, ProtCryoCARETraining
+from cryocare.shards import PRECISIONS, CODECS, FLOAT16, ZLIB
+from cryocare.tests import genSyntheticTomos, PATCH_SIZE, _importHalves
+from cryocare.traindata import mapNpzArray, openTrainData, writeManifest, materializeTrainData, getTrainDataNorm, \
+    ConcatenatedArray, extractCoordinates, readCoordinates, prefetch
+from pyworkflow.tests import BaseTest, setupTestProject
+from pyworkflow.utils import makePath
+
+PATCH = 4
+
+
+def genTrainData(outDir, nTrain, nVal, mean, std, seed):
+    """Training dataset with the layout of the cryoCARE one: normalized patches and their normalization."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(outDir)
+    raw = {}
+    for fileName, n in ((TRAIN_DATA_FN, nTrain), (VALIDATION_DATA_FN, nVal)):
+        raw[fileName] = {field: rng.normal(mean, std, (n, PATCH, PATCH, PATCH, 1)).astype(np.float32)
+                         for field in ('X', 'Y')}
+        np.savez(join(outDir, fileName), mean=mean, std=std,
+                 **{field: (data - mean) / std for field, data in raw[fileName].items()})
+    return raw
+
+
+class TestTrainData(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpDir)
+
+    def testMapNpzArray(self):
+        data = np.arange(120, dtype=np.float32).reshape(5, 4, 6)
+        np.savez(join(self.tmpDir, 'a.npz'), X=data, mean=3.0)
+        np.savez_compressed(join(self.tmpDir, 'b.npz'), X=data)
+        mapped = mapNpzArray(join(self.tmpDir, 'a.npz'), 'X')
+        self.assertIsInstance(mapped, np.memmap)
+        np.testing.assert_array_equal(mapped, data)
+        self.assertEqual(float(mapNpzArray(join(self.tmpDir, 'a.npz'), 'mean')), 3.0)
+        np.testing.assert_array_equal(mapNpzArray(join(self.tmpDir, 'b.npz'), 'X'), data)
+
+    def testConcatenatedArray(self):
+        a, b = np.arange(6).reshape(3, 2), np.arange(6, 10).reshape(2, 2)
+        concat = ConcatenatedArray([(a, 1, 0), (np.empty((0, 2)), 1, 0), (b, 1, 0)])
+        expected = np.concatenate([a, b])
+        self.assertEqual(concat.shape, (5, 2))
+        np.testing.assert_array_equal(concat[1:4], expected[1:4])
+        np.testing.assert_array_equal(concat[::2], expected[::2])
+        np.testing.assert_array_equal(concat[-1], expected[-1])
+        np.testing.assert_array_equal(concat[[4, 0]], expected[[4, 0]])
+        np.testing.assert_array_equal(np.concatenate(list(concat.iterChunks(chunkBytes=1))), expected)
+        with self.assertRaises(IndexError):
+            concat[5]
+
+    def testCombine(self):
+        rawA = genTrainData(join(self.tmpDir, 'a'), 30, 3, 1.0, 2.0, 0)
+        rawB = genTrainData(join(self.tmpDir, 'b'), 10, 2, 5.0, 0.5, 1)
+        combinedDir = join(self.tmpDir, 'combined')
+        manifest = writeManifest([join(self.tmpDir, 'a'), join(self.tmpDir, 'b')], combinedDir)
+        self.assertEqual(os.listdir(combinedDir), [TRAIN_DATA_MANIFEST_FN])  # Nothing copied
+        self.assertEqual([part['train'] for part in manifest['parts']], [30, 10])
+        allRaw = np.concatenate([rawA[TRAIN_DATA_FN]['X'], rawB[TRAIN_DATA_FN]['X']])
+        # Pooled normalization of the parameters of each one
+        self.assertAlmostEqual(manifest['mean'], (30 * 1.0 + 10 * 5.0) / 40)
+        data = openTrainData(combinedDir)
+        mean, std = getTrainDataNorm(combinedDir)
+        np.testing.assert_allclose(data['X'][:] * std + mean, allRaw, rtol=1e-4, atol=1e-4)
+        self.assertEqual(len(openTrainData(combinedDir, 'val')['Y']), 5)
+        # Combinations can be combined again
+        genTrainData(join(self.tmpDir, 'c'), 5, 1, 0.0, 1.0, 2)
+        manifest = writeManifest([combinedDir, join(self.tmpDir, 'c')], join(self.tmpDir, 'nested'))
+        self.assertEqual(len(manifest['parts']), 3)
+
+        materializeTrainData(combinedDir, combinedDir, chunkBytes=1000)
+        with np.load(join(combinedDir, TRAIN_DATA_FN)) as materialized:
+            np.testing.assert_allclose(materialized['X'], data['X'][:])
+            self.assertAlmostEqual(float(materialized['mean']), mean)
+
+    def testCoordinates(self):
+        rng = np.random.default_rng(0)
+        volumes = {}
+        for i in range(2):
+            for half in ('even', 'odd'):
+                volumes[i, half] = join(self.tmpDir, 'TS_%i_%s.mrc' % (i, half))
+                with mrcfile.new(volumes[i, half]) as mrc:
+                    mrc.set_data(rng.normal(i, 1 + i, (16, 24, 20)).astype(np.float32))
+        coordsDir = join(self.tmpDir, 'coords')
+        info = extractCoordinates([volumes[i, 'even'] for i in range(2)], [volumes[i, 'odd'] for i in range(2)],
+                                  coordsDir, patchSize=PATCH, nPatches=10, split=0.8, tiltAxis='Y', nNormSamples=5,
+                                  nThreads=2)
+        self.assertEqual(os.listdir(coordsDir), [TRAIN_COORDS_FN])  # No patches written
+        self.assertEqual((info['train'], info['val']), (16, 4))
+        coords = readCoordinates(coordsDir)
+        # Train and validation patches from different regions along the tilt axis (y)
+        self.assertTrue(np.all(coords['train'][:, 2] <= int(24 * 0.8) - PATCH))
+        self.assertTrue(np.all(coords['val'][:, 2] >= int(24 * 0.8)))
+
+        # The patches are read from the tomograms and normalized with the pooled normalization
+        data = openTrainData(coordsDir)
+        tomoInd, z, y, x = coords['train'][-1]
+        with mrcfile.open(volumes[tomoInd, 'odd']) as mrc:
+            expected = mrc.data[z:z + PATCH, y:y + PATCH, x:x + PATCH]
+        np.testing.assert_allclose(data['Y'][-1][..., 0] * data['std'] + data['mean'], expected, rtol=1e-5, atol=1e-5)
+        self.assertEqual(data['X'][3:9].shape, (6, PATCH, PATCH, PATCH, 1))
+
+        # They can be combined with the extracted ones and written for cryoCARE
+        genTrainData(join(self.tmpDir, 'a'), 6, 2, 1.0, 2.0, 0)
+        combinedDir = join(self.tmpDir, 'combined')
+        manifest = writeManifest([coordsDir, join(self.tmpDir, 'a')], combinedDir)
+        self.assertEqual([part['train'] for part in manifest['parts']], [16, 6])
+        materializeTrainData(combinedDir, combinedDir, chunkBytes=1000)
+        with np.load(join(combinedDir, VALIDATION_DATA_FN)) as materialized:
+            np.testing.assert_allclose(materialized['X'], openTrainData(combinedDir, 'val')['X'][:])
+        # The tomograms are kept as long as the training data
+        self.assertIn(os.path.realpath(volumes[1, 'odd']), expandProtected([combinedDir]))
+
+    def testPrefetchError(self):
+        def produce():
+            yield 1
+            raise ValueError('Corrupted patch')
+        items = prefetch(produce())
+        self.assertEqual(next(items), 1)
+        with self.assertRaises(ValueError):
+            next(items)
+
+    def testPatchSizeMismatch(self):
+        genTrainData(join(self.tmpDir, 'a'), 3, 1, 0.0, 1.0, 0)
+        os.makedirs(join(self.tmpDir, 'b'))
+        for fileName in (TRAIN_DATA_FN, VALIDATION_DATA_FN):
+            np.savez(join(self.tmpDir, 'b', fileName), X=np.zeros((2, 8, 8, 8, 1)), Y=np.zeros((2, 8, 8, 8, 1)),
+                     mean=0.0, std=1.0)
+        with self.assertRaises(ValueError):
+            writeManifest([join(self.tmpDir, 'a'), join(self.tmpDir, 'b')], join(self.tmpDir, 'combined'))
+
+
+@unittest.skipUnless(Plugin.isSimulated(), 'Set %s=True to run it with the simulated backend.' % CRYOCARE_SIMULATE)
+class TestTrainDataProtocols(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        tomoDir = cls.getOutputPath('synthetic_tomos')
+        makePath(tomoDir)
+        genSyntheticTomos(tomoDir, 2)
+        cls.tomos = _importHalves(cls, tomoDir)
+
+    def _extract(self, nSlices, **kwargs):
+        protExtract = self.newProtocol(ProtCryoCAREExtractTrainData,
+                                       evenTomos=self.tomos['even'],
+                                       oddTomos=self.tomos['odd'],
+                                       patch_shape=PATCH_SIZE,
+                                       num_slices=nSlices,
+                                       n_normalization_samples=5,
+                                       **kwargs)
+        self.launchProtocol(protExtract)
+        return getattr(protExtract, extractOutputs.train_data.name)
+
+    def testCompressedTraining(self):
+        trainData = self._extract(10, patchPrecision=PRECISIONS.index(FLOAT16), patchCompression=CODECS.index(ZLIB))
+        self.assertEqual(sorted(os.listdir(trainData.getTrainDataDir())),
+                         [TRAIN_DATA_SHARDS_FN, VALIDATION_DATA_SHARDS_FN])
+        protTraining = self.newProtocol(ProtCryoCARETraining,
+                                        useTrainData=True,
+                                        epochs=2,
+                                        steps_per_epoch=2)
+        protTraining.inTrainData.append(trainData)
+        self.launchProtocol(protTraining)
+        self.assertEqual(os.listdir(protTraining._getExtraPath('train_data')), [TRAIN_DATA_MANIFEST_FN])
+        self.assertEqual(len(openTrainData(protTraining._getExtraPath('train_data'))['X']), 2 * 9)
+
+    def testCoordinateTraining(self):
+        trainData = self._extract(10, storeCoordinates=True)
+        self.assertEqual(os.listdir(trainData.getTrainDataDir()), [TRAIN_COORDS_FN])
+        protTraining = self.newProtocol(ProtCryoCARETraining,
+                                        useTrainData=True,
+                                        epochs=2,
+                                        steps_per_epoch=2)
+        protTraining.inTrainData.append(trainData)
+        self.launchProtocol(protTraining)
+        model = getattr(protTraining, trainOutputs.model.name)
+        # The patches were written for cryoCARE in the training directory, and removed once trained
+        trainDataDir = protTraining._getExtraPath('train_data')
+        self.assertEqual(os.listdir(trainDataDir), [TRAIN_DATA_MANIFEST_FN])
+        self.assertAlmostEqual(model.getMean(), getTrainDataNorm(trainData.getTrainDataDir())[0], places=5)
+        self.assertEqual(len(openTrainData(trainDataDir)['X']), 2 * 9)
+
+    def testCombinedTraining(self):
+        trainData = [self._extract(10), self._extract(20)]
+        self.assertEqual(trainData[0].getPatchSize(), PATCH_SIZE)
+        protTraining = self.newProtocol(ProtCryoCARETraining,
+                                        useTrainData=True,
+                                        epochs=2,
+                                        steps_per_epoch=2)
+        for data in trainData:
+            protTraining.inTrainData.append(data)
+        self.launchProtocol(protTraining)
+        model = getattr(protTraining, trainOutputs.model.name)
+        trainDataDir = protTraining._getExtraPath('train_data')
+        self.assertEqual(model.getTrainDataDir(), trainDataDir)
+        self.assertTrue(exists(join(trainDataDir, TRAIN_DATA_MANIFEST_FN)))
+        # The files written for cryoCARE are removed once trained
+        self.assertFalse(exists(join(trainDataDir, TRAIN_DATA_FN)))
+        self.assertAlmostEqual(model.getMean(), getTrainDataNorm(trainDataDir)[0], places=5)
+        self.assertEqual(len(openTrainData(trainDataDir)['X']), 2 * (9 + 18))
@@ -0,0 +1,236 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import pickle
+import shutil
+import tarfile
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from os.path import join
+
+from cryocare import Plugin
+from cryocare.constants import CRYOCARE_SIMULATE, CRYOCARE_MODEL, STATUS_FN
+from cryocare.jobs import CryocareJob
+from cryocare.monitor import TrainingMonitor, EarlyStopping, ItemProgress, writeStatus, readStatus
+from cryocare.protocols.protocol_training import Outputobjects as trainOutputs, ProtCryoCARETraining
+from cryocare.simulator.simcommon import SIM_LOSS_CURVE, SIM_EPOCH_TIME
+from cryocare.tests import genSyntheticTomos, PATCH_SIZE, _importHalves
+from pyworkflow.tests import BaseTest, setupTestProject
+from pyworkflow.utils import makePath, runJob
+
+# Scripted validation loss: it improves during 4 epochs and then flattens
+LOSS_CURVE = [1.0, 0.6, 0.4, 0.3, 0.31, 0.3, 0.305, 0.302, 0.301]
+STOP_EPOCH = 7  # 3 epochs without improvement after the best one (4)
+
+
+def genLogLines(valLosses, nEpochs):
+    for epoch, valLoss in enumerate(valLosses):
+        yield 'Epoch %i/%i\n' % (epoch + 1, nEpochs)
+        # Progress bar rewritten in place, only the last update reports the validation loss
+        yield ('\r 1/10 [==>...........] - ETA: 1s - loss: 0.9000\b\b\b\r10/10 [==============] - 2s 200ms/step '
+               '- loss: %.4f - val_loss: %.4f\n' % (valLoss / 1.05, valLoss))
+
+
+class TestTrainingMonitor(unittest.TestCase):
+
+    def testParse(self):
+        monitor = TrainingMonitor()
+        epochsDone = [monitor.parseLine(line) for line in genLogLines(LOSS_CURVE[:3], 100)]
+        self.assertEqual(epochsDone, [False, True] * 3)
+        self.assertEqual((monitor.epoch, monitor.nEpochs), (3, 100))
+        self.assertEqual(monitor.history['val_loss'], LOSS_CURVE[:3])
+        self.assertEqual(monitor.getBestEpoch(), 3)
+
+    def testPatience(self):
+        earlyStopping = EarlyStopping(patience=3, minDelta=0.01)
+        monitor = TrainingMonitor()
+        for line in genLogLines(LOSS_CURVE, 100):
+            if monitor.parseLine(line) and earlyStopping.checkLoss(monitor):
+                break
+        self.assertEqual(monitor.epoch, STOP_EPOCH)
+        self.assertEqual(monitor.getBestEpoch(), 4)
+        self.assertIsNone(EarlyStopping(patience=4, minDelta=0.01).checkLoss(monitor))
+
+    def testStatus(self):
+        monitor = TrainingMonitor()
+        lines = list(genLogLines(LOSS_CURVE[:2], 10))
+        monitor.parseLine(lines[0])
+        self.assertEqual(monitor.getStatus(100), {'epoch': 0, 'epochs': 10, 'elapsed_seconds': 0})
+        for line in lines[1:]:
+            monitor.parseLine(line)
+        monitor._epochTimes = [2., 2.]  # Deterministic epoch times
+        status = monitor.getStatus(100)
+        self.assertEqual((status['epoch'], status['val_loss'], status['best_epoch']), (2, LOSS_CURVE[1], 2))
+        self.assertEqual((status['samples_per_second'], status['epochs_per_minute']), (50, 30))
+        self.assertEqual(status['eta_seconds'], 16)
+
+    def testItemProgress(self):
+        progress = ItemProgress(10, done=4)  # 4 done by a previous execution
+        self.assertNotIn('eta_seconds', progress.getStatus())
+        progress.startTime -= 60
+        progress.addDone(2)
+        status = progress.getStatus()
+        self.assertEqual((status['done'], status['total']), (6, 10))
+        self.assertAlmostEqual(status['items_per_hour'], 120, places=0)
+        self.assertAlmostEqual(status['eta_seconds'], 120, delta=1)
+
+    def testStatusFile(self):
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        statusFile = join(tmpDir, STATUS_FN)
+        self.assertIsNone(readStatus(statusFile))
+        writeStatus(statusFile, {'done': 1})
+        self.assertEqual(readStatus(statusFile)['done'], 1)
+        self.assertIn('updated', readStatus(statusFile))
+        self.assertEqual(os.listdir(tmpDir), [STATUS_FN])
+
+    def testTimeBudget(self):
+        monitor = TrainingMonitor()
+        self.assertIsNone(EarlyStopping(maxTime=60).checkTime(monitor))
+        monitor.startTime -= 61
+        self.assertIsNotNone(EarlyStopping(maxTime=60).checkTime(monitor))
+
+
+class LocalProtocol:
+    """Runs the jobs as the local executor of a protocol does."""
+
+    @staticmethod
+    def runJob(program, arguments, **kwargs):
+        runJob(None, program, arguments)
+
+
+class TestCryocareJob(unittest.TestCase):
+
+    def setUp(self):
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        self.job = CryocareJob(join(tmpDir, 'job.log'))
+
+    def _start(self, code):
+        """Run the python code given as a job in a thread. Returns the thread and the list its exit code is
+        appended to."""
+        exitCodes = []
+        thread = threading.Thread(target=lambda: exitCodes.append(
+            self.job.run(LocalProtocol, sys.executable, '-u -c "%s"' % code)), daemon=True)
+        thread.start()
+        return thread, exitCodes
+
+    def testReadLines(self):
+        thread, exitCodes = self._start("print('Epoch 1/2'); print('Epoch 2/2')")
+        lines = [line for line in self.job.readLines(interval=0.05) if line]
+        self.assertEqual(lines, ['Epoch 1/2\n', 'Epoch 2/2\n'])
+        self.assertTrue(self.job.isDone())
+        thread.join()
+        self.assertEqual(exitCodes, [0])
+        self.assertFalse(self.job.stop())  # Not running anymore
+
+    def testStop(self):
+        thread, exitCodes = self._start("import time; print('Epoch 1/2'); time.sleep(60)")
+        for line in self.job.readLines(interval=0.05):
+            if line:
+                break
+        start = time.time()
+        self.assertTrue(self.job.stop(timeout=5))
+        thread.join(timeout=10)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(len(exitCodes), 1)
+        self.assertNotEqual(exitCodes[0], 0)
+
+
+@unittest.skipUnless(Plugin.isSimulated(), 'Set %s=True to run it with the simulated backend.' % CRYOCARE_SIMULATE)
+class TestEarlyStoppingProtocol(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        tomoDir = cls.getOutputPath('synthetic_tomos')
+        makePath(tomoDir)
+        genSyntheticTomos(tomoDir, 2)
+        cls.tomos = _importHalves(cls, tomoDir)
+
+    def testEarlyStopping(self):
+        os.environ[SIM_LOSS_CURVE] = ','.join(str(loss) for loss in LOSS_CURVE)
+        self.addCleanup(os.environ.pop, SIM_LOSS_CURVE)
+        # The training is followed through its log, so it must still be running when stopped
+        os.environ[SIM_EPOCH_TIME] = '0.1'
+        self.addCleanup(os.environ.pop, SIM_EPOCH_TIME)
+        protTraining = self.newProtocol(ProtCryoCARETraining,
+                                        evenTomos=self.tomos['even'],
+                                        oddTomos=self.tomos['odd'],
+                                        patch_shape=PATCH_SIZE,
+                                        num_slices=10,
+                                        n_normalization_samples=5,
+                                        epochs=100,
+                                        steps_per_epoch=2,
+                                        patience=3,
+                                        minDelta=0.01)
+        self.launchProtocol(protTraining)
+        model = getattr(protTraining, trainOutputs.model.name)
+        self.assertIn('after %i of 100 epochs' % STOP_EPOCH, protTraining.trainingEnd.get())
+        self.assertIn('weights of epoch 4', protTraining.trainingEnd.get())
+        with tarfile.open(model.getPath()) as tar:
+            history = pickle.load(tar.extractfile('%s/history.dat' % CRYOCARE_MODEL))
+        self.assertEqual(history['val_loss'], LOSS_CURVE[:STOP_EPOCH])
+        self.assertIsNotNone(model.getMean())
+        status = readStatus(protTraining._getExtraPath(STATUS_FN))
+        self.assertEqual((status['state'], status['epoch'], status['best_epoch']), ('stopped', STOP_EPOCH, 4))
+
+    def testFullTraining(self):
+        # The early stopping criteria are not met: cryoCARE finishes the training and its model is kept as it is
+        protTraining = self.newProtocol(ProtCryoCARETraining,
+                                        evenTomos=self.tomos['even'],
+                                        oddTomos=self.tomos['odd'],
+                                        patch_shape=PATCH_SIZE,
+                                        num_slices=10,
+                                        n_normalization_samples=5,
+                                        epochs=3,
+                                        steps_per_epoch=2,
+                                        patience=3,
+                                        minDelta=0.01)
+        self.launchProtocol(protTraining)
+        self.assertIsNone(protTraining.trainingEnd.get())
+        self.assertFalse(any('stopped' in line for line in protTraining.summary()))
+        status = readStatus(protTraining._getExtraPath(STATUS_FN))
+        self.assertEqual((status['state'], status['epoch']), ('finished', 3))
+
+    def testTrainingStatus(self):
+        # Without early stopping, the status file follows the training until it finishes
+        protTraining = self.newProtocol(ProtCryoCARETraining,
+                                        evenTomos=self.tomos['even'],
+                                        oddTomos=self.tomos['odd'],
+                                        patch_shape=PATCH_SIZE,
+                                        num_slices=10,
+                                        n_normalization_samples=5,
+                                        epochs=2,
+                                        steps_per_epoch=2)
+        self.launchProtocol(protTraining)
+        status = readStatus(protTraining._getExtraPath(STATUS_FN))
+        self.assertEqual((status['state'], status['epoch'], status['epochs']), ('finished', 2, 2))
+        self.assertNotIn('reason', status)
+        self.assertIsNone(protTraining.trainingEnd.get())
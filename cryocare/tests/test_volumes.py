@@ -0,0 +1,164 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import glob
+import shutil
+import struct
+import tempfile
+import unittest
+from os.path import join, splitext
+
+import mrcfile
+import numpy as np
+import tifffile
+
+from cryocare import Plugin
+from cryocare.binning import getBinnedFile
+from cryocare.constants import CRYOCARE_SIMULATE
+from cryocare.protocols.protocol_training import Outputobjects as trainOutputs, ProtCryoCARETraining
+from cryocare.tests import genSyntheticTomos, PATCH_SIZE, _importHalves
+from cryocare.volumes import (MRC, SPIDER, TIFF, Volume, openVolume, readVolumeDims, convertToMrc, getVolumeFormat,
+                              getVolumePath, isCryocareReadable, SPI_LABBYT, SPI_NSAM, SPI_NROW, SPI_NSLICE,
+                              SPI_IFORM, SPI_PIXSIZ)
+from pyworkflow.tests import BaseTest, setupTestProject
+from pyworkflow.utils import makePath
+
+SHAPE = (6, 10, 12)  # (z, y, x)
+VOXEL_SIZE = 2.5
+
+
+def writeSpider(fileName, data, voxelSize=VOXEL_SIZE, byteOrder='<'):
+    nz, ny, nx = data.shape
+    # The header takes a whole number of records (rows) of at least 256 bytes
+    labrec = -(-1024 // (nx * 4))
+    header = np.zeros(labrec * nx, dtype=np.float32)
+    for word, value in ((SPI_NSLICE, nz), (SPI_NROW, ny), (SPI_IFORM, 3), (SPI_NSAM, nx),
+                        (SPI_LABBYT, labrec * nx * 4), (SPI_PIXSIZ, voxelSize)):
+        header[word - 1] = value
+    with open(fileName, 'wb') as f:
+        f.write(header.astype(byteOrder + 'f4').tobytes())
+        f.write(data.astype(byteOrder + 'f4').tobytes())
+
+
+class TestVolumes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpDir)
+        self.data = np.random.default_rng(0).random(SHAPE, dtype=np.float32)
+
+    def _checkVolume(self, location, fmt, memmap=True, voxelSize=VOXEL_SIZE):
+        self.assertEqual(getVolumeFormat(location), fmt)
+        self.assertEqual(readVolumeDims(location), tuple(reversed(SHAPE)))
+        with openVolume(location) as vol:
+            self.assertEqual(vol.shape, SHAPE)
+            self.assertEqual(isinstance(vol.data, np.memmap), memmap)
+            np.testing.assert_array_equal(vol.data[2], self.data[2])
+            np.testing.assert_array_equal(vol.data[1:4, 3, 2:5], self.data[1:4, 3, 2:5])
+            np.testing.assert_array_equal(np.asarray(vol.data), self.data)
+            self.assertEqual(vol.voxelSize, (voxelSize, ) * 3 if voxelSize else None)
+
+    def testMrc(self):
+        fileName = join(self.tmpDir, 'TS_01.rec')
+        with mrcfile.new(fileName) as mrc:
+            mrc.set_data(self.data)
+            mrc.voxel_size = VOXEL_SIZE
+        self._checkVolume(fileName, MRC)
+        self._checkVolume(fileName + ':mrc', MRC)
+        self.assertEqual(getVolumePath(fileName + ':mrc'), fileName)
+        self.assertTrue(isCryocareReadable(fileName + ':mrc'))
+
+    def testSpider(self):
+        for byteOrder in ('<', '>'):
+            fileName = join(self.tmpDir, 'TS_01_%s.vol' % ('le' if byteOrder == '<' else 'be'))
+            writeSpider(fileName, self.data, byteOrder=byteOrder)
+            self._checkVolume(fileName, SPIDER)
+            self._checkVolume(fileName + ':spi', SPIDER)
+            self.assertFalse(isCryocareReadable(fileName))
+
+    def testTiff(self):
+        contiguous = join(self.tmpDir, 'contiguous.tif')
+        tifffile.imwrite(contiguous, self.data)
+        self._checkVolume(contiguous, TIFF, voxelSize=None)
+        # Compressed pages can not be memory-mapped: they are read on demand
+        compressed = join(self.tmpDir, 'compressed.tiff')
+        tifffile.imwrite(compressed, self.data, compression='zlib')
+        self._checkVolume(compressed, TIFF, memmap=False, voxelSize=None)
+
+    def testConversion(self):
+        fileName = join(self.tmpDir, 'TS_01.spi')
+        writeSpider(fileName, self.data)
+        outFile = convertToMrc(fileName + ':spi', join(self.tmpDir, 'converted.mrc'), chunkBytes=1)
+        with mrcfile.open(outFile) as mrc:
+            np.testing.assert_array_equal(mrc.data, self.data)
+            self.assertAlmostEqual(float(mrc.voxel_size.x), VOXEL_SIZE)
+
+    def testInputFiles(self):
+        """The files cryoCARE can read are passed as they are, and the others are converted or binned to MRC."""
+        cacheDir = join(self.tmpDir, 'cache')
+        recFile = join(self.tmpDir, 'TS_01.rec')
+        with mrcfile.new(recFile) as mrc:
+            mrc.set_data(self.data)
+        self.assertEqual(getBinnedFile(recFile + ':mrc', 1, cacheDir), recFile)
+        tifFile = join(self.tmpDir, 'TS_02.tif')
+        tifffile.imwrite(tifFile, self.data, compression='zlib')
+        converted = getBinnedFile(tifFile, 1, cacheDir)
+        self.assertTrue(converted.endswith('.mrc'))
+        with Volume(converted) as vol:
+            np.testing.assert_array_equal(vol.data, self.data)
+        binned = getBinnedFile(tifFile, 2, cacheDir)
+        self.assertEqual(readVolumeDims(binned), tuple(n // 2 for n in reversed(SHAPE)))
+        self.assertIsNone(readVolumeDims(join(self.tmpDir, 'missing.tif')))
+        with open(join(self.tmpDir, 'bad.spi'), 'wb') as f:
+            f.write(struct.pack('<64f', *range(64)))
+        self.assertIsNone(readVolumeDims(join(self.tmpDir, 'bad.spi')))
+
+
+@unittest.skipUnless(Plugin.isSimulated(), 'Set %s=True to run it with the simulated backend.' % CRYOCARE_SIMULATE)
+class TestTiffTraining(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.tomoDir = cls.getOutputPath('synthetic_tomos')
+        makePath(cls.tomoDir)
+        genSyntheticTomos(cls.tomoDir, 2)
+        for fileName in glob.glob(join(cls.tomoDir, '*.mrc')):
+            with mrcfile.open(fileName) as mrc:
+                tifffile.imwrite(splitext(fileName)[0] + '.tif', mrc.data)
+
+    def testTiffTraining(self):
+        # Not binned, the TIFF tomograms are converted to MRC for cryoCARE
+        tomos = _importHalves(self, self.tomoDir, pattern='*_%s.tif')
+        protTraining = self.newProtocol(ProtCryoCARETraining,
+                                        evenTomos=tomos['even'],
+                                        oddTomos=tomos['odd'],
+                                        patch_shape=PATCH_SIZE,
+                                        num_slices=10,
+                                        n_normalization_samples=5,
+                                        epochs=2,
+                                        steps_per_epoch=2)
+        self.launchProtocol(protTraining)
+        self.assertIsNotNone(getattr(protTraining, trainOutputs.model.name, None))
@@ -0,0 +1,123 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Adaptive tiling of the predictions: when cryoCARE runs out of memory with a tiling, the tomogram is predicted
+again with more tiles, following a bounded escalation ladder, and the tiling that worked is remembered for the
+next tomograms of the same shape."""
+import json
+import os
+import re
+import threading
+from os.path import exists
+
+# Messages of TensorFlow, CUDA and the system when running out of GPU or host memory
+OOM_PATTERN = re.compile(r'ResourceExhaustedError|OOM when allocating|out of memory|CUDA_ERROR_OUT_OF_MEMORY|'
+                         r'MemoryError|Cannot allocate memory|std::bad_alloc', re.IGNORECASE)
+OOM_EXIT_CODES = (137, -9)  # Killed (SIGKILL), e.g. by the kernel OOM killer
+MAX_ESCALATIONS = 6  # Each one doubles the number of tiles along an axis
+MIN_TILE_SIZE = 32  # Pixels. The tiles are not split below it
+
+
+def isOutOfMemory(output, exitCode):
+    """True if a failed cryoCARE execution ran out of memory, judging by its output or exit code."""
+    return exitCode in OOM_EXIT_CODES or bool(OOM_PATTERN.search(output or ''))
+
+
+def escalateTiling(nTiles, shape=None, minTileSize=MIN_TILE_SIZE):
+    """Next tiling of the ladder: the number of tiles is doubled along the axis with the largest tiles (z, y, x
+    order, as n_tiles), or the one with fewest tiles if the shape is unknown. None if the tiles can not be split
+    further."""
+    nTiles = list(nTiles)
+    if shape:
+        tileSizes = [size / n for size, n in zip(shape, nTiles)]
+        axis = max(range(len(nTiles)), key=lambda i: tileSizes[i])
+        if tileSizes[axis] / 2 < minTileSize:
+            return None
+    else:
+        axis = min(reversed(range(len(nTiles))), key=lambda i: nTiles[i])  # x and y first
+    nTiles[axis] *= 2
+    return nTiles
+
+
+def getTilingLadder(nTiles, shape=None, maxEscalations=MAX_ESCALATIONS):
+    """Tilings to try, from the one given to the most conservative one."""
+    ladder = [list(nTiles)]
+    for _ in range(maxEscalations):
+        nextTiles = escalateTiling(ladder[-1], shape)
+        if nextTiles is None:
+            break
+        ladder.append(nextTiles)
+    return ladder
+
+
+def getShapeKey(shape):
+    return 'x'.join(str(size) for size in shape)
+
+
+class TilingMemory:
+    """Tilings that worked for each tomogram shape, persisted in a json file so the tomograms of the same shape
+    (in this or in a continued execution) start with them instead of running out of memory again."""
+
+    def __init__(self, fileName):
+        self._fileName = fileName
+        self._tilings = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._tilings is None:
+            self._tilings = {}
+            if exists(self._fileName):
+                with open(self._fileName) as f:
+                    self._tilings = json.load(f)
+        return self._tilings
+
+    def get(self, shape):
+        with self._lock:
+            return self._load().get(getShapeKey(shape), None)
+
+    def getStart(self, shape, nTiles):
+        """Tiling to start with: the one that worked for the shape, if it has at least the tiles given."""
+        remembered = self.get(shape) if shape else None
+        if remembered is None:
+            return list(nTiles)
+        return [max(n, m) for n, m in zip(nTiles, remembered)]
+
+    def remember(self, shape, nTiles):
+        if not shape:
+            return
+        with self._lock:
+            tilings = self._load()
+            key = getShapeKey(shape)
+            if tilings.get(key) == list(nTiles):
+                return
+            tilings[key] = list(nTiles)
+            tmpFile = '%s.%i.tmp' % (self._fileName, os.getpid())
+            with open(tmpFile, 'w') as f:
+                json.dump(tilings, f, indent=2)
+            os.replace(tmpFile, self._fileName)
+
+    def getAll(self):
+        with self._lock:
+            return dict(self._load())
@@ -0,0 +1,148 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Compact index of the even/odd tomograms to process, built with a single query to the SQLite files of the input
+sets (instead of instantiating a Tomogram per entry) and persisted to be reused when the protocol is continued."""
+import json
+import os
+from os.path import exists, realpath
+
+INDEX_VERSION = 1
+# Columns of the set SQLite files read, by attribute name
+TS_ID = '_tsId'
+FILENAME = '_filename'
+S_RATE = '_samplingRate'
+HALF_MAPS = '_halfMapFilenames'
+
+
+class TomoDescriptor:
+    """What the protocols need of each tomogram: its tsId and objId (to resolve the Tomogram when registering the
+    outputs), even/odd files, dimensions (x, y, z) and sampling rate. The dimensions are the ones of the set (of its
+    first tomogram), so the ones that need them exactly read the header of the tomogram."""
+    __slots__ = ('tsId', 'objId', 'even', 'odd', 'dims', 'sRate')
+
+    def __init__(self, tsId, objId, even, odd, dims, sRate):
+        self.tsId = tsId
+        self.objId = objId
+        self.even = even
+        self.odd = odd
+        self.dims = tuple(dims) if dims else None
+        self.sRate = sRate
+
+    def toList(self):
+        return [getattr(self, attr) for attr in self.__slots__]
+
+    def __repr__(self):
+        return 'TomoDescriptor(%s)' % ', '.join('%s=%r' % (attr, getattr(self, attr)) for attr in self.__slots__)
+
+
+def _selectColumns(dbFile, attributes):
+    """Rows (objId + the attributes requested) of the items of a set, sorted by objId. The column of each
+    attribute is looked up in the Classes table of the set."""
+    import sqlite3
+    with sqlite3.connect('file:%s?mode=ro' % dbFile, uri=True) as conn:
+        columns = dict(conn.execute('SELECT label_property, column_name FROM Classes'))
+        missing = [attr for attr in attributes if attr not in columns]
+        if missing:
+            raise KeyError('Attributes %s not found in %s.' % (', '.join(missing), dbFile))
+        query = 'SELECT id, %s FROM Objects ORDER BY id' % ', '.join(columns[attr] for attr in attributes)
+        return conn.execute(query).fetchall()
+
+
+def _getPairs(evenSet, oddSet):
+    """(objId, tsId, sampling rate, even file, odd file) of each tomogram, read directly from the SQLite files."""
+    if oddSet is None:
+        rows = _selectColumns(evenSet.getFileName(), [TS_ID, S_RATE, HALF_MAPS])
+        return [(objId, tsId, sRate) + tuple(reversed(halfMaps.split(','))) for objId, tsId, sRate, halfMaps in rows]
+    evenRows = _selectColumns(evenSet.getFileName(), [TS_ID, S_RATE, FILENAME])
+    oddRows = _selectColumns(oddSet.getFileName(), [FILENAME])
+    return [(objId, tsId, sRate, even, odd) for (objId, tsId, sRate, even), (_, odd) in zip(evenRows, oddRows)]
+
+
+def _getPairsFromItems(evenSet, oddSet):
+    """Same as _getPairs, iterating over the items of the sets."""
+    if oddSet is None:
+        return [(tomo.getObjId(), tomo.getTsId(), tomo.getSamplingRate()) +
+                tuple(reversed(tomo.getHalfMaps().split(','))) for tomo in evenSet]
+    return [(even.getObjId(), even.getTsId(), even.getSamplingRate(), even.getFileName(), odd.getFileName())
+            for even, odd in zip(evenSet, oddSet)]
+
+
+def buildTomoIndex(evenSet, oddSet=None):
+    """Index of the tomograms of a set with the even/odd half maps associated (oddSet None) or of a pair of even and
+    odd sets, paired in order. The tsIds are the ones of the even set. No tomogram is opened: the dimensions and
+    the default sampling rate are the ones of the set."""
+    import sqlite3
+    try:
+        pairs = _getPairs(evenSet, oddSet)
+    except (KeyError, sqlite3.Error):
+        pairs = _getPairsFromItems(evenSet, oddSet)  # Not stored as expected
+    setSRate, setDims = evenSet.getSamplingRate(), evenSet.getDim()
+    return {tsId: TomoDescriptor(tsId, objId, even, odd, setDims, sRate or setSRate)
+            for objId, tsId, sRate, even, odd in pairs}
+
+
+def getSetsSignature(*sets):
+    """Identifies the state of the SQLite files of the input sets, to know if a persisted index is up to date."""
+    signature = []
+    for inSet in sets:
+        dbFile = realpath(inSet.getFileName())
+        stat = os.stat(dbFile)
+        signature.append([dbFile, stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def saveTomoIndex(fileName, index, signature):
+    tmpFile = '%s.%i.tmp' % (fileName, os.getpid())
+    with open(tmpFile, 'w') as f:
+        json.dump({'version': INDEX_VERSION,
+                   'signature': signature,
+                   'tomos': [descriptor.toList() for descriptor in index.values()]}, f)
+    os.replace(tmpFile, fileName)
+
+
+def loadTomoIndex(fileName, signature):
+    """Persisted index, or None if there is not one or it was built from other input sets."""
+    if not exists(fileName):
+        return None
+    try:
+        with open(fileName) as f:
+            data = json.load(f)
+    except ValueError:
+        return None
+    if data.get('version') != INDEX_VERSION or data.get('signature') != signature:
+        return None
+    return {values[0]: TomoDescriptor(*values) for values in data['tomos']}
+
+
+def getTomoIndex(fileName, evenSet, oddSet=None):
+    """Persisted index of the input sets, built if it does not exist or they have changed."""
+    sets = [evenSet] if oddSet is None else [evenSet, oddSet]
+    signature = getSetsSignature(*sets)
+    index = loadTomoIndex(fileName, signature)
+    if index is None:
+        index = buildTomoIndex(evenSet, oddSet)
+        saveTomoIndex(fileName, index, signature)
+    return index
@@ -0,0 +1,507 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Access to the cryoCARE training datasets (train_data.npz and val_data.npz) without loading them in memory.
+
+Several datasets can be combined with a manifest that lists them (virtual concatenation): nothing is copied, and
+the patches of each one are re-normalized with the pooled mean and standard deviation when they are read.
+cryoCARE only reads the npz files, so the virtual datasets are written in full to train (materializeTrainData).
+
+A dataset can also store only the origins of its patches (train_coords.npz), with the even/odd tomograms they
+are sampled from and their normalization. Its patches are read from the memory-mapped tomograms when indexed.
+Or store its patches compressed and/or as float16 (train_data.shards and val_data.shards, see cryocare.shards)."""
+import bisect
+import json
+import math
+import os
+import queue
+import struct
+import threading
+import zipfile
+from collections import OrderedDict
+from os.path import join, exists, abspath
+
+from cryocare.constants import TRAIN_DATA_FN, VALIDATION_DATA_FN, TRAIN_DATA_MANIFEST_FN, TRAIN_COORDS_FN, \
+    TRAIN_DATA_SHARDS_FN, VALIDATION_DATA_SHARDS_FN
+from cryocare.volumes import openVolume, getVolumePath
+
+SUBSETS = {'train': TRAIN_DATA_FN, 'val': VALIDATION_DATA_FN}
+SHARD_SUBSETS = {'train': TRAIN_DATA_SHARDS_FN, 'val': VALIDATION_DATA_SHARDS_FN}
+PATCH_FIELDS = ('X', 'Y')  # Normalized noisy patches pairs
+PATCH_HALVES = {'X': 'even', 'Y': 'odd'}  # Tomograms the patches of each field are read from
+TILT_AXES = {'Z': 0, 'Y': 1, 'X': 2}  # Axes of the volume data (z, y, x)
+MAX_OPEN_VOLUMES = 16  # Tomograms kept open by each coordinate-based array
+PREFETCH_BATCHES = 4  # Chunks of patches read in advance while writing them
+MANIFEST_VERSION = 1
+# Memory used by each chunk of patches read or written
+CHUNK_BYTES = 256 * 1024 ** 2
+# Size of the fixed part of a zip local file header, followed by the file name and the extra field
+ZIP_LOCAL_HEADER_SIZE = 30
+
+
+def mapNpzArray(npzFile, field):
+    """Memory map an array stored in a npz file. np.savez stores them uncompressed, so they can be read in place.
+    The compressed ones (np.savez_compressed) and the scalars are loaded."""
+    import numpy as np
+    with zipfile.ZipFile(npzFile) as zf:
+        info = zf.getinfo(field + '.npy')
+    if info.compress_type == zipfile.ZIP_STORED:
+        with open(npzFile, 'rb') as f:
+            # The extra field of the local header may differ from the central directory one (zip64)
+            f.seek(info.header_offset + ZIP_LOCAL_HEADER_SIZE - 4)
+            nameLen, extraLen = struct.unpack('<HH', f.read(4))
+            f.seek(nameLen + extraLen, os.SEEK_CUR)
+            version = np.lib.format.read_magic(f)
+            readHeader = np.lib.format.read_array_header_1_0 if version == (1, 0) else \
+                np.lib.format.read_array_header_2_0
+            shape, fortranOrder, dtype = readHeader(f)
+            offset = f.tell()
+        if shape and not dtype.hasobject:
+            return np.memmap(npzFile, dtype=dtype, mode='r', offset=offset, shape=shape,
+                             order='F' if fortranOrder else 'C')
+    with np.load(npzFile) as data:
+        return data[field]
+
+
+class ConcatenatedArray:
+    """Read-only concatenation, along the first axis, of arrays that are only read when indexed. The data of each
+    part is transformed (scale * data + offset) when read."""
+
+    def __init__(self, parts):
+        """parts: list of (array, scale, offset)."""
+        import numpy as np
+        self._parts = [part for part in parts if len(part[0])] or parts[:1]
+        self._starts = [0]
+        for array, _, _ in self._parts:
+            self._starts.append(self._starts[-1] + len(array))
+        first = self._parts[0][0]
+        self.shape = (self._starts[-1],) + tuple(first.shape[1:])
+        scaled = any((scale, offset) != (1, 0) for _, scale, offset in self._parts)
+        self.dtype = np.dtype(np.float32) if scaled else first.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        import numpy as np
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self[np.arange(start, stop, step)]
+            chunks = [self._read(partInd, slice(max(start, partStart) - partStart, min(stop, partEnd) - partStart))
+                      for partInd, (partStart, partEnd) in enumerate(zip(self._starts, self._starts[1:]))
+                      if start < partEnd and stop > partStart]
+            return np.concatenate(chunks) if chunks else np.empty((0,) + self.shape[1:], dtype=self.dtype)
+        if np.ndim(index):
+            return np.stack([self[int(i)] for i in index]) if len(index) else \
+                np.empty((0,) + self.shape[1:], dtype=self.dtype)
+        index = index + len(self) if index < 0 else index
+        if not 0 <= index < len(self):
+            raise IndexError('Index %i out of range for %i patches.' % (index, len(self)))
+        partInd = bisect.bisect_right(self._starts, index) - 1
+        return self._read(partInd, index - self._starts[partInd])
+
+    def _read(self, partInd, index):
+        import numpy as np
+        array, scale, offset = self._parts[partInd]
+        data = np.asarray(array[index])
+        if (scale, offset) == (1, 0):
+            return data.astype(self.dtype, copy=False)
+        return (data * scale + offset).astype(self.dtype, copy=False)
+
+    def iterChunks(self, chunkBytes=CHUNK_BYTES):
+        """Iterate over the data in chunks of patches of about chunkBytes."""
+        import numpy as np
+        patchBytes = max(1, int(np.prod(self.shape[1:])) * self.dtype.itemsize)
+        step = max(1, chunkBytes // patchBytes)
+        for start in range(0, len(self), step):
+            yield self[start:start + step]
+
+
+class PatchArray:
+    """Read-only array of the patches (n, z, y, x, 1) of a coordinate-based training dataset, read from the
+    memory-mapped tomograms when indexed and normalized with the dataset mean and standard deviation."""
+
+    def __init__(self, locations, origins, patchSize, mean, std):
+        """origins: (n, 4) array of tomogram index (in locations) and z, y, x origin of each patch."""
+        import numpy as np
+        self._locations = list(locations)
+        self._origins = origins
+        self._patchSize = patchSize
+        self._mean, self._std = mean, std
+        self._volumes = OrderedDict()  # Most recently used last
+        self._lock = threading.Lock()
+        self.shape = (len(origins),) + 3 * (patchSize,) + (1,)
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        import numpy as np
+        if isinstance(index, slice):
+            return self._read(range(*index.indices(len(self))))
+        if np.ndim(index):
+            return self._read(index)
+        index = index + len(self) if index < 0 else index
+        if not 0 <= index < len(self):
+            raise IndexError('Index %i out of range for %i patches.' % (index, len(self)))
+        return self._read([index])[0]
+
+    def _getData(self, tomoInd):
+        with self._lock:
+            if tomoInd in self._volumes:
+                self._volumes.move_to_end(tomoInd)
+            else:
+                self._volumes[tomoInd] = openVolume(self._locations[tomoInd])
+                if len(self._volumes) > MAX_OPEN_VOLUMES:
+                    # Not closed, as it may be being read: it is released with its last reference
+                    self._volumes.popitem(last=False)
+            return self._volumes[tomoInd].data
+
+    def _read(self, indices):
+        import numpy as np
+        size = self._patchSize
+        patches = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        for i, index in enumerate(indices):
+            tomoInd, z, y, x = (int(value) for value in self._origins[index])
+            patch = self._getData(tomoInd)[z:z + size, y:y + size, x:x + size]
+            patches[i, ..., 0] = (np.asarray(patch, dtype=np.float32) - self._mean) / self._std
+        return patches
+
+    def iterChunks(self, chunkBytes=CHUNK_BYTES):
+        step = max(1, chunkBytes // (self._patchSize ** 3 * self.dtype.itemsize))
+        for start in range(0, len(self), step):
+            yield self[start:start + step]
+
+
+def _put(items, item, stop):
+    """Put an item in a bounded queue, unless the consumer stops."""
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def prefetch(iterable, size=PREFETCH_BATCHES):
+    """Iterate over an iterable whose next items (up to size) are produced by a thread in background. The
+    exceptions raised producing them are raised when they are reached."""
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    end = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                if not _put(items, (item, None), stop):
+                    return
+        except Exception as e:
+            _put(items, (None, e), stop)
+        _put(items, (end, None), stop)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is end:
+                break
+            yield item
+    finally:
+        stop.set()
+
+
+def isVirtual(trainDataDir):
+    """True if the training data directory holds a manifest that combines other ones."""
+    return exists(join(trainDataDir, TRAIN_DATA_MANIFEST_FN))
+
+
+def isCoordinateBased(trainDataDir):
+    """True if the training data directory holds the coordinates of the patches instead of the patches."""
+    return exists(join(trainDataDir, TRAIN_COORDS_FN))
+
+
+def isCompressed(trainDataDir):
+    """True if the training data directory holds the patches as shards (compressed and/or float16)."""
+    return exists(join(trainDataDir, TRAIN_DATA_SHARDS_FN))
+
+
+def needsMaterialization(trainDataDir):
+    """True if the patches of a training dataset have to be written for the programs that can only read the
+    train and validation files."""
+    return isVirtual(trainDataDir) or isCoordinateBased(trainDataDir) or isCompressed(trainDataDir)
+
+
+def readCoordinates(trainDataDir):
+    import numpy as np
+    with np.load(join(trainDataDir, TRAIN_COORDS_FN)) as data:
+        return {field: data[field] for field in data.files}
+
+
+def getCoordinateVolumes(trainDataDir):
+    """Files of the even/odd tomograms a coordinate-based training dataset reads its patches from."""
+    coords = readCoordinates(trainDataDir)
+    return [getVolumePath(str(location)) for half in PATCH_HALVES.values() for location in coords[half]]
+
+
+def sampleOrigins(shape, patchSize, nPatches, split, tiltAxis, rng):
+    """Origins (z, y, x) of the train and validation patches of a tomogram. As in cryoCARE, the tomogram is
+    split along the tilt axis, so they are taken from different regions."""
+    import numpy as np
+    axis = TILT_AXES[tiltAxis]
+    splitPos = int(shape[axis] * split)
+    nTrain = max(1, int(nPatches * split))
+    origins = {}
+    for subset, n in (('train', nTrain), ('val', nPatches - nTrain)):
+        lims = [(0, dim - patchSize) for dim in shape]
+        if subset == 'train':
+            lims[axis] = (0, max(0, splitPos - patchSize))
+        else:
+            lims[axis] = (min(splitPos, shape[axis] - patchSize), shape[axis] - patchSize)
+        origins[subset] = np.stack([rng.integers(low, high + 1, size=n) for low, high in lims], axis=1)
+    return origins
+
+
+def _samplePatches(evenFn, patchSize, nPatches, split, tiltAxis, nNormSamples, seed):
+    """Origins of the patches of a tomogram, and mean and standard deviation of its first train patches."""
+    import numpy as np
+    with openVolume(evenFn) as volume:
+        origins = sampleOrigins(volume.shape, patchSize, nPatches, split, tiltAxis, np.random.default_rng(seed))
+        total, totalSq, count = 0., 0., 0
+        for z, y, x in origins['train'][:max(1, nNormSamples)]:
+            patch = np.asarray(volume.data[z:z + patchSize, y:y + patchSize, x:x + patchSize], dtype=np.float64)
+            total, totalSq, count = total + patch.sum(), totalSq + (patch ** 2).sum(), count + patch.size
+    mean = total / count
+    return origins, mean, math.sqrt(max(totalSq / count - mean ** 2, 0))
+
+
+def extractCoordinates(evenFns, oddFns, outDir, patchSize, nPatches, split, tiltAxis, nNormSamples, seed=0,
+                       nThreads=1):
+    """Sample the patches of a training dataset as cryoCARE does, but store only their origins, the tomograms
+    and the normalization of each one (pooled into the dataset one), instead of the patches. Returns the number of
+    train and validation patches and the dataset normalization."""
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max(1, nThreads)) as executor:
+        results = list(executor.map(lambda args: _samplePatches(args[1], patchSize, nPatches, split, tiltAxis,
+                                                                 nNormSamples, [seed, args[0]]),
+                                    enumerate(evenFns)))
+    tomoNorms = [{'train': len(origins['train']), 'mean': mean, 'std': std} for origins, mean, std in results]
+    mean, std = poolNormalization(tomoNorms)
+    coords = {'even': np.array([abspath(fn) for fn in evenFns]),
+              'odd': np.array([abspath(fn) for fn in oddFns]),
+              'tomo_mean': np.array([norm['mean'] for norm in tomoNorms]),
+              'tomo_std': np.array([norm['std'] for norm in tomoNorms]),
+              'mean': mean,
+              'std': std,
+              'patch_size': patchSize}
+    for subset in SUBSETS:
+        coords[subset] = np.concatenate([
+            np.column_stack([np.full(len(origins[subset]), tomoInd), origins[subset]]).reshape(-1, 4)
+            for tomoInd, (origins, _, _) in enumerate(results)]).astype(np.int32)
+    os.makedirs(outDir, exist_ok=True)
+    fileName = join(outDir, TRAIN_COORDS_FN)
+    tmpFile = '%s.%i.tmp' % (fileName, os.getpid())
+    with open(tmpFile, 'wb') as f:
+        np.savez(f, **coords)
+    os.replace(tmpFile, fileName)
+    return {'train': len(coords['train']), 'val': len(coords['val']), 'mean': mean, 'std': std}
+
+
+def readManifest(trainDataDir):
+    with open(join(trainDataDir, TRAIN_DATA_MANIFEST_FN)) as f:
+        return json.load(f)
+
+
+def getTrainDataParts(trainDataDir):
+    """Physical training datasets of a training data directory, with their size and normalization."""
+    if isVirtual(trainDataDir):
+        return readManifest(trainDataDir)['parts']
+    if isCoordinateBased(trainDataDir):
+        coords = readCoordinates(trainDataDir)
+        return [{'path': abspath(trainDataDir),
+                 'mean': float(coords['mean']),
+                 'std': float(coords['std']),
+                 'train': len(coords['train']),
+                 'val': len(coords['val']),
+                 'patch_size': int(coords['patch_size'])}]
+    mean, std = getTrainDataNorm(trainDataDir)
+    if isCompressed(trainDataDir):
+        from cryocare.shards import readShardsHeader
+        shapes = {subset: readShardsHeader(join(trainDataDir, fileName))['fields']['X']['shape']
+                  for subset, fileName in SHARD_SUBSETS.items()}
+    else:
+        shapes = {subset: mapNpzArray(join(trainDataDir, fileName), 'X').shape
+                  for subset, fileName in SUBSETS.items()}
+    return [{'path': abspath(trainDataDir),
+             'mean': mean,
+             'std': std,
+             'train': int(shapes['train'][0]),
+             'val': int(shapes['val'][0]),
+             'patch_size': int(shapes['train'][1])}]
+
+
+def getTrainDataNorm(trainDataDir):
+    """Mean and standard deviation used to normalize the patches of a training dataset."""
+    import numpy as np
+    if isVirtual(trainDataDir):
+        manifest = readManifest(trainDataDir)
+        return manifest['mean'], manifest['std']
+    if isCoordinateBased(trainDataDir):
+        coords = readCoordinates(trainDataDir)
+        return float(coords['mean']), float(coords['std'])
+    if isCompressed(trainDataDir):
+        from cryocare.shards import readShardsHeader
+        scalars = readShardsHeader(join(trainDataDir, TRAIN_DATA_SHARDS_FN))['scalars']
+        return scalars['mean'], scalars['std']
+    with np.load(join(trainDataDir, TRAIN_DATA_FN)) as data:
+        return float(data['mean']), float(data['std'])
+
+
+def loadTrainDataFile(fileName):
+    """Contents of a train or validation file, as a npz file (np.savez) or as a shards file."""
+    import numpy as np
+    from cryocare.shards import HEADER_NAME, loadShards
+    with zipfile.ZipFile(fileName) as zf:
+        isShards = HEADER_NAME in zf.namelist()
+    if isShards:
+        return loadShards(fileName)
+    with np.load(fileName) as data:
+        return {field: data[field] for field in data.files}
+
+
+def compressTrainData(trainDataDir, precision, codec, nThreads=1):
+    """Replace the train and validation files of an extracted training dataset with shards. Returns the
+    round-trip error of the patches of each subset and field."""
+    from cryocare.shards import writeShards
+    mean, std = getTrainDataNorm(trainDataDir)
+    errors = {}
+    for subset, fileName in SUBSETS.items():
+        npzFile = join(trainDataDir, fileName)
+        if not exists(npzFile):
+            continue  # Compressed by a previous execution
+        arrays = {field: mapNpzArray(npzFile, field) for field in PATCH_FIELDS}
+        arrays.update(mean=mean, std=std)
+        errors[subset] = writeShards(arrays, join(trainDataDir, SHARD_SUBSETS[subset]), precision, codec,
+                                     nThreads=nThreads)
+    # Once both are written, so an interrupted compression can be repeated
+    removeMaterializedData(trainDataDir)
+    return errors
+
+
+def poolNormalization(parts):
+    """Mean and standard deviation of the union of the datasets, from the ones of each dataset, weighted by their
+    number of training patches."""
+    nPatches = sum(part['train'] for part in parts)
+    mean = sum(part['train'] * part['mean'] for part in parts) / nPatches
+    meanSq = sum(part['train'] * (part['std'] ** 2 + part['mean'] ** 2) for part in parts) / nPatches
+    return mean, math.sqrt(max(meanSq - mean ** 2, 0))
+
+
+def writeManifest(trainDataDirs, outDir):
+    """Combine several training datasets (which can be combinations too) into outDir, without copying them.
+    Returns the manifest written."""
+    parts = [part for trainDataDir in trainDataDirs for part in getTrainDataParts(trainDataDir)]
+    patchSizes = {part['patch_size'] for part in parts}
+    if len(patchSizes) > 1:
+        raise ValueError('The training datasets to combine must have the same patch size: %s found.'
+                         % ', '.join(str(size) for size in sorted(patchSizes)))
+    mean, std = poolNormalization(parts)
+    manifest = {'version': MANIFEST_VERSION,
+                'mean': mean,
+                'std': std,
+                'patch_size': patchSizes.pop(),
+                'parts': parts}
+    os.makedirs(outDir, exist_ok=True)
+    with open(join(outDir, TRAIN_DATA_MANIFEST_FN), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def openTrainData(trainDataDir, subset='train'):
+    """Patches pairs of a training dataset (X and Y), which are only read when indexed, and their normalization
+    (mean and std)."""
+    mean, std = getTrainDataNorm(trainDataDir)
+    data = {'mean': mean, 'std': std}
+    for field in PATCH_FIELDS:
+        parts = []
+        for part in getTrainDataParts(trainDataDir):
+            # Undo the normalization of the part and apply the combined one
+            scale, offset = part['std'] / std, (part['mean'] - mean) / std
+            parts.append((_openPart(part['path'], subset, field), scale, offset))
+        data[field] = ConcatenatedArray(parts)
+    return data
+
+
+def _openPart(path, subset, field):
+    """Patches of a field of a physical training dataset, normalized with its own mean and std."""
+    if isCoordinateBased(path):
+        coords = readCoordinates(path)
+        return PatchArray([str(location) for location in coords[PATCH_HALVES[field]]], coords[subset],
+                          int(coords['patch_size']), float(coords['mean']), float(coords['std']))
+    if isCompressed(path):
+        from cryocare.shards import ShardArray
+        return ShardArray(join(path, SHARD_SUBSETS[subset]), field)
+    return mapNpzArray(join(path, SUBSETS[subset]), field)
+
+
+def _writeNpz(fileName, arrays, chunkBytes=CHUNK_BYTES):
+    """Write a npz file as np.savez does, but streaming the ConcatenatedArray values in chunks."""
+    import numpy as np
+    tmpFile = '%s.%i.tmp' % (fileName, os.getpid())
+    with zipfile.ZipFile(tmpFile, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for name, value in arrays.items():
+            with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+                if isinstance(value, ConcatenatedArray):
+                    np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(value.dtype),
+                                                             'fortran_order': False,
+                                                             'shape': value.shape})
+                    # The next chunks are read while the current one is written
+                    for chunk in prefetch(value.iterChunks(chunkBytes)):
+                        f.write(np.ascontiguousarray(chunk).tobytes())
+                else:
+                    np.lib.format.write_array(f, np.asanyarray(value))
+    os.replace(tmpFile, fileName)
+
+
+def materializeTrainData(trainDataDir, outDir, chunkBytes=CHUNK_BYTES):
+    """Write the train and validation files of a combined training dataset in outDir, for the programs that can
+    only read one file of each. The patches are streamed, so the memory used is bounded."""
+    os.makedirs(outDir, exist_ok=True)
+    for subset, fileName in SUBSETS.items():
+        _writeNpz(join(outDir, fileName), openTrainData(trainDataDir, subset), chunkBytes)
+
+
+def removeMaterializedData(trainDataDir):
+    """Remove the files written by materializeTrainData, keeping the manifest, coordinates or shards."""
+    if needsMaterialization(trainDataDir):
+        for fileName in SUBSETS.values():
+            if exists(join(trainDataDir, fileName)):
+                os.remove(join(trainDataDir, fileName))
@@ -23,9 +23,16 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
-from os.path import join
-from pyworkflow.utils import createLink
-from cryocare.constants import TRAIN_DATA_FN, VALIDATION_DATA_FN, CRYOCARE_MODEL_TGZ
+import hashlib
+import json
+import os
+import shutil
+from os.path import basename, exists, join
+from cryocare.constants import CRYOCARE_MODEL_TGZ, MODEL_NORM_FN, MODEL_CONFIG_FN, MODEL_INFO_SUFFIX, \
+    MODEL_WEIGHTS_EXT, MODEL_WEIGHTS_BEST_FN
+
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+_modelInfoCache = {}
 
 
 def checkInputTomoSetsSize(evenTomoSet, oddTomoSet):
@@ -42,19 +49,176 @@ def checkInputTomoSetsSize(evenTomoSet, oddTomoSet):
 
     return message
 
-def makeDatasetSymLinks(prot, trainDataDir):
-    # The prediction is expecting the training and validation datasets to be in the same place as the training
-    # model, but they are located in the training data generation extra directory. Hence, a symbolic link will
-    # be created for each one
-    linkedTrainingDataFile = prot._getExtraPath(TRAIN_DATA_FN)
-    linkedValidationDataFile = prot._getExtraPath(VALIDATION_DATA_FN)
-    createLink(join(trainDataDir, TRAIN_DATA_FN), linkedTrainingDataFile)
-    createLink(join(trainDataDir, VALIDATION_DATA_FN), linkedValidationDataFile)
-
-
 def getModelName(prot):
     return prot._getExtraPath(CRYOCARE_MODEL_TGZ)
 
 
+def getModelInfoFile(modelFile):
+    """Sidecar json file containing the compact metadata of a cryoCARE model: normalization values, patch size,
+    U-Net config and the model hash."""
+    modelFile = str(modelFile)
+    baseName = modelFile[:-len('.tar.gz')] if modelFile.endswith('.tar.gz') else modelFile
+    return baseName + MODEL_INFO_SUFFIX
+
+
+def getFileHash(fileName):
+    sha = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class _HashingReader:
+    """File wrapper that hashes all the bytes read through it, so an archive can be hashed while it is being
+    read by tarfile."""
+    def __init__(self, f):
+        self._f = f
+        self.sha = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.sha.update(data)
+        self.size += len(data)
+        return data
+
+    def drain(self):
+        while self.read(HASH_CHUNK_SIZE):
+            pass
+
+
+def _isIndexedMember(memberName):
+    return memberName in (MODEL_NORM_FN, MODEL_CONFIG_FN) or memberName.endswith(MODEL_WEIGHTS_EXT)
+
+
+def genModelInfo(modelFile, patchSize=None):
+    """Build the index of a cryoCARE model .tar.gz file in a single streaming pass, without extracting it: member
+    list, hashes of the config, normalization and weights files, the parsed U-Net config and the normalization
+    values. The hash of the whole archive is computed in the same pass."""
+    import tarfile  # Only needed when a model is indexed
+    members, memberHashes = [], {}
+    norm, config = {}, {}
+    with open(modelFile, 'rb') as f:
+        reader = _HashingReader(f)
+        try:
+            with tarfile.open(fileobj=reader, mode='r|gz') as tar:
+                for member in tar:
+                    members.append({'name': member.name, 'size': member.size})
+                    memberName = basename(member.name)
+                    if not member.isfile() or not _isIndexedMember(memberName):
+                        continue
+                    memberSha = hashlib.sha256()
+                    content = b''
+                    fMember = tar.extractfile(member)
+                    for chunk in iter(lambda: fMember.read(HASH_CHUNK_SIZE), b''):
+                        memberSha.update(chunk)
+                        if not memberName.endswith(MODEL_WEIGHTS_EXT):
+                            content += chunk
+                    memberHashes[member.name] = memberSha.hexdigest()
+                    if memberName == MODEL_NORM_FN:
+                        norm = json.loads(content)
+                    elif memberName == MODEL_CONFIG_FN:
+                        config = json.loads(content)
+        except tarfile.TarError as e:
+            raise ValueError('%s is not a valid model archive: %s' % (modelFile, e))
+        reader.drain()  # Trailing padding of the archive
+    return {
+        'mean': norm.get('mean'),
+        'std': norm.get('std'),
+        'patch_size': patchSize,
+        'config': config,
+        'members': members,
+        'member_hashes': memberHashes,
+        'size': reader.size,
+        'hash': reader.sha.hexdigest()
+    }
+
+
+def checkModelInfo(modelInfo):
+    """Check that the files required to predict are present in the model index. A list of error messages is
+    returned."""
+    errors = []
+    memberNames = [basename(member['name']) for member in modelInfo.get('members', [])]
+    for requiredFile in (MODEL_CONFIG_FN, MODEL_NORM_FN, MODEL_WEIGHTS_BEST_FN):
+        if requiredFile not in memberNames:
+            errors.append('No %s file was found in the introduced training model.' % requiredFile)
+    if MODEL_NORM_FN in memberNames and (modelInfo['mean'] is None or modelInfo['std'] is None):
+        errors.append('The %s file of the introduced training model does not contain the mean and std values.'
+                      % MODEL_NORM_FN)
+    return errors
+
+
+def checkModelArchive(modelFile):
+    """Check that the config and normalization files of a model archive are there and can be read, stopping as
+    soon as they are found: the archive is neither hashed nor indexed, as it is when imported. A list of error
+    messages is returned."""
+    import tarfile  # Only needed when a model is checked
+    contents = {}
+    try:
+        with tarfile.open(modelFile, mode='r|gz') as tar:
+            for member in tar:
+                memberName = basename(member.name)
+                if member.isfile() and memberName in (MODEL_CONFIG_FN, MODEL_NORM_FN):
+                    contents[memberName] = json.load(tar.extractfile(member))
+                    if len(contents) == 2:
+                        break
+    except (tarfile.TarError, OSError, ValueError) as e:
+        return ['The training model introduced could not be read:\n%s' % e]
+    errors = ['No %s file was found in the introduced training model.' % requiredFile
+              for requiredFile in (MODEL_CONFIG_FN, MODEL_NORM_FN) if requiredFile not in contents]
+    norm = contents.get(MODEL_NORM_FN)
+    if norm is not None and (not isinstance(norm, dict) or norm.get('mean') is None or norm.get('std') is None):
+        errors.append('The %s file of the introduced training model does not contain the mean and std values.'
+                      % MODEL_NORM_FN)
+    return errors
+
+
+def readModelInfo(modelFile, patchSize=None):
+    """Read the model metadata from its sidecar file if it exists. It is generated from the model archive
+    otherwise."""
+    infoFile = getModelInfoFile(modelFile)
+    if exists(infoFile):
+        with open(infoFile) as f:
+            modelInfo = json.load(f)
+        if patchSize is not None:
+            modelInfo['patch_size'] = patchSize
+        if 'members' in modelInfo:
+            return modelInfo
+
+    # Validation and summary may ask for the same archive many times, so the index is cached in memory
+    st = os.stat(modelFile)
+    key = (os.path.realpath(modelFile), st.st_size, st.st_mtime)
+    if key not in _modelInfoCache:
+        _modelInfoCache[key] = genModelInfo(modelFile)
+    modelInfo = dict(_modelInfoCache[key])
+    modelInfo['patch_size'] = patchSize
+    return modelInfo
+
+
+def writeModelInfo(modelInfo, modelFile):
+    with open(getModelInfoFile(modelFile), 'w') as f:
+        json.dump(modelInfo, f, indent=2)
+
+
+def linkOrCopyFile(srcFile, dstFile):
+    """Hard link a file if possible (same filesystem), copying it otherwise."""
+    try:
+        os.link(os.path.realpath(srcFile), dstFile)
+    except OSError:
+        shutil.copyfile(srcFile, dstFile)
 
 
+def storeModel(modelFile, modelInfo, storeDir):
+    """Add a model to a site-wide store, where the models are named after their content hash. Thus, identical
+    models imported in several projects are stored only once. The stored model file is returned."""
+    modelHash = modelInfo['hash']
+    hashDir = join(storeDir, modelHash[:2])
+    storedModel = join(hashDir, modelHash + '.tar.gz')
+    if not exists(storedModel):
+        os.makedirs(hashDir, exist_ok=True)
+        tmpFile = '%s.%i.tmp' % (storedModel, os.getpid())
+        linkOrCopyFile(modelFile, tmpFile)
+        os.replace(tmpFile, storedModel)  # Atomic, so concurrent imports of the same model are safe
+        writeModelInfo(modelInfo, storedModel)
+    return storedModel
@@ -0,0 +1,216 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Read-only access to the volumes in the formats the tomograms may be stored in (MRC and its IMOD variants, SPIDER
+and multi-page TIFF), presented as NumPy memory maps or as views that read the slices on demand, so they are never
+copied to be read by the plugin. Scipion locations with a format suffix (e.g. tomo.mrc:mrc) are accepted."""
+import os
+import struct
+import threading
+from os.path import splitext, basename
+
+MRC = 'mrc'
+SPIDER = 'spi'
+TIFF = 'tif'
+# Extensions of each format. cryoCARE reads the MRC files regardless of their extension
+FORMAT_EXTENSIONS = {MRC: ('.mrc', '.mrcs', '.rec', '.st', '.ali', '.preali', '.map'),
+                     SPIDER: ('.spi', '.vol', '.xmp'),
+                     TIFF: ('.tif', '.tiff')}
+# Format suffixes of the Scipion locations
+FORMAT_SUFFIXES = {'mrc': MRC, 'mrcs': MRC, 'spi': SPIDER, 'vol': SPIDER, 'tif': TIFF, 'tiff': TIFF}
+# Words (1-based) of the SPIDER header
+SPI_NSLICE, SPI_NROW, SPI_IFORM, SPI_NSAM, SPI_LABBYT, SPI_PIXSIZ = 1, 2, 5, 12, 22, 38
+SPI_VOLUME_IFORMS = (3, )
+CHUNK_BYTES = 256 * 1024 ** 2
+
+
+def splitLocation(location):
+    """File name and format suffix (None if there is not one) of a location."""
+    fileName, sep, suffix = location.rpartition(':')
+    if sep and suffix.lower() in FORMAT_SUFFIXES:
+        return fileName, suffix.lower()
+    return location, None
+
+
+def getVolumePath(location):
+    """File of a location."""
+    return splitLocation(location)[0]
+
+
+def getVolumeFormat(location):
+    """Format of a location, from its suffix or from the file extension. MRC is assumed for unknown extensions."""
+    fileName, suffix = splitLocation(location)
+    if suffix:
+        return FORMAT_SUFFIXES[suffix]
+    ext = splitext(fileName)[1].lower()
+    for fmt, extensions in FORMAT_EXTENSIONS.items():
+        if ext in extensions:
+            return fmt
+    return MRC
+
+
+def isCryocareReadable(location):
+    """True if cryoCARE can read the file of the location as it is."""
+    return getVolumeFormat(location) == MRC
+
+
+def _readSpiderHeader(f):
+    """Byte order ('<' or '>'), shape (z, y, x), header bytes and pixel size of a SPIDER volume."""
+    head = f.read(SPI_PIXSIZ * 4)
+    for byteOrder in ('<', '>'):
+        words = struct.unpack('%s%if' % (byteOrder, SPI_PIXSIZ), head)
+        iform = words[SPI_IFORM - 1]
+        labbyt = words[SPI_LABBYT - 1]
+        if iform in SPI_VOLUME_IFORMS and labbyt > 0 and labbyt == int(labbyt):
+            shape = tuple(int(words[i - 1]) for i in (SPI_NSLICE, SPI_NROW, SPI_NSAM))
+            return byteOrder, shape, int(labbyt), words[SPI_PIXSIZ - 1] or None
+    raise ValueError('%s is not a SPIDER volume.' % f.name)
+
+
+class _TiffPages:
+    """Array-like view of the pages of a multi-page TIFF file, read when they are indexed (along z)."""
+
+    def __init__(self, tif):
+        self._tif = tif
+        self._lock = threading.Lock()  # The pages are read through a shared file handle
+        page = tif.pages[0]
+        self.shape = (len(tif.pages),) + tuple(page.shape)
+        self.dtype = page.dtype
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        import numpy as np
+        key = key if isinstance(key, tuple) else (key, )
+        zKey, rest = key[0], key[1:]
+        if isinstance(zKey, slice):
+            with self._lock:
+                pages = [self._tif.pages[i].asarray() for i in range(*zKey.indices(self.shape[0]))]
+            data = np.stack(pages) if pages else np.empty((0, ) + self.shape[1:], dtype=self.dtype)
+            return data[(slice(None), ) + rest]
+        with self._lock:
+            page = self._tif.pages[int(zKey)].asarray()
+        return page[rest]
+
+    def __array__(self, dtype=None):
+        import numpy as np
+        return np.asarray(self[:], dtype=dtype)
+
+
+class Volume:
+    """Read-only volume: data (z, y, x), memory-mapped or read on demand, and voxel size (x, y, z) in Å, if
+    known. To be used as a context manager."""
+
+    def __init__(self, location):
+        self.fileName = getVolumePath(location)
+        self.format = getVolumeFormat(location)
+        self.voxelSize = None
+        self._handle = None
+        if self.format == MRC:
+            import mrcfile
+            self._handle = mrcfile.mmap(self.fileName, mode='r', permissive=True)
+            self.data = self._handle.data
+            voxelSize = self._handle.voxel_size
+            self.voxelSize = tuple(float(v) for v in (voxelSize.x, voxelSize.y, voxelSize.z))
+        elif self.format == SPIDER:
+            import numpy as np
+            with open(self.fileName, 'rb') as f:
+                byteOrder, shape, labbyt, pixSize = _readSpiderHeader(f)
+            self.data = np.memmap(self.fileName, dtype=np.dtype(byteOrder + 'f4'), mode='r', offset=labbyt,
+                                  shape=shape)
+            if pixSize:
+                self.voxelSize = (pixSize, ) * 3
+        else:
+            import tifffile
+            try:
+                # Only if the pages are stored contiguous and uncompressed
+                self.data = tifffile.memmap(self.fileName, mode='r')
+            except ValueError:
+                self._handle = tifffile.TiffFile(self.fileName)
+                self.data = _TiffPages(self._handle)
+
+    @property
+    def shape(self):
+        return tuple(self.data.shape)
+
+    def close(self):
+        self.data = None
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def openVolume(location):
+    return Volume(location)
+
+
+def readVolumeDims(location):
+    """Dimensions (x, y, z) of a volume, read from its header, or None if it can not be read."""
+    fileName = getVolumePath(location)
+    fmt = getVolumeFormat(location)
+    try:
+        if fmt == MRC:
+            with open(fileName, 'rb') as f:
+                return struct.unpack('<3i', f.read(12))
+        if fmt == SPIDER:
+            with open(fileName, 'rb') as f:
+                return tuple(reversed(_readSpiderHeader(f)[1]))
+        with openVolume(location) as vol:
+            return tuple(reversed(vol.shape))
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def convertToMrc(location, outFile, chunkBytes=CHUNK_BYTES):
+    """Write a volume as a float32 MRC file, slab by slab. Only needed to pass the volumes cryoCARE can not read
+    to it."""
+    import mrcfile
+    import numpy as np
+    with openVolume(location) as vol:
+        nz, ny, nx = vol.shape
+        # Written to a temporary file, so a cached file is always complete
+        tmpFile = '%s.%i-%i.tmp' % (outFile, os.getpid(), threading.get_ident())
+        with mrcfile.new_mmap(tmpFile, shape=(nz, ny, nx), mrc_mode=2, overwrite=True) as mrcOut:
+            chunk = max(1, chunkBytes // (ny * nx * 4))
+            for z0 in range(0, nz, chunk):
+                mrcOut.data[z0:z0 + chunk] = np.asarray(vol.data[z0:z0 + chunk], dtype=np.float32)
+            if vol.voxelSize:
+                mrcOut.voxel_size = vol.voxelSize
+            mrcOut.update_header_stats()
+    os.replace(tmpFile, outFile)
+    return outFile
+
+
+def getMrcName(location):
+    """Base name of a location with the .mrc extension, as written by cryoCARE."""
+    return splitext(basename(getVolumePath(location)))[0] + '.mrc'